@@ -12,7 +12,8 @@ from lipidimea.params import DdaParams
 from lipidimea.msms.dda import (
     extract_dda_features,
     extract_dda_features_multiproc,
-    consolidate_dda_features
+    consolidate_dda_features,
+    cluster_dda_features
 )
 
 
@@ -40,7 +41,10 @@ def setup_dda_subparser(parser: argparse.ArgumentParser):
         "--n-proc",
         default=1,
         type=int,
-        help="set >1 to processes multiple data files in parallel (default=1)"
+        help=(
+            "set >1 to process data files in parallel, or to split up the processing of individual "
+            "data files when there are fewer data files than processes (default=1)"
+        )
     )
     parser.add_argument(
         "--no-consolidate",
@@ -56,15 +60,20 @@ def dda_run(args: argparse.Namespace):
     # load the parameters
     params = DdaParams.from_config(args.PARAMS_CONFIG)
     # extract the DDA features
-    if args.n_proc > 1:
+    if args.n_proc > 1 and len(args.DDA_MZA) >= args.n_proc:
         _ = extract_dda_features_multiproc(
             args.DDA_MZA, args.RESULTS_DB, params, n_proc=args.n_proc, debug_flag="text_pid"
         )
     else:
+        # fewer data files than processes, use the processes to split up each data file instead
         for dda_data_file in args.DDA_MZA:
             _ = extract_dda_features(
-                dda_data_file, args.RESULTS_DB, params, debug_flag="text"
+                dda_data_file, args.RESULTS_DB, params, 
+                debug_flag="text_pid" if args.n_proc > 1 else "text", n_proc=args.n_proc
             )
     # consolidate DDA features after extraction
     if args.consolidate:
-        consolidate_dda_features(args.RESULTS_DB, params, debug_flag="text")
\ No newline at end of file
+        consolidate_dda_features(args.RESULTS_DB, params, debug_flag="text")
+        # cluster DDA features across data files if configured
+        if params.consolidate_dda_feats.cluster_min_cosine is not None:
+            cluster_dda_features(args.RESULTS_DB, params, debug_flag="text")
\ No newline at end of file
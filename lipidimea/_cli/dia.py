@@ -47,7 +47,10 @@ def _setup_process_subparser(parser: argparse.ArgumentParser):
         "--n-proc",
         default=1,
         type=int,
-        help="set >1 to processes multiple data files in parallel (default=1)"
+        help=(
+            "set >1 to process data files in parallel, the work is split up by data file and by DIA "
+            "targets so this also helps with a single data file (default=1)"
+        )
     )
 
 
@@ -0,0 +1,384 @@
+"""
+lipidimea/msms/_peaks.py
+Dylan Ross (dylan.ross@pnnl.gov)
+
+    internal module with a batched gaussian peak fitting engine, fits many 1D traces
+    (chromatograms, ATDs) at once using array operations, and local maximum peak finding 
+    for sparse binned spectra
+"""
+
+
+from typing import List, Tuple, Any
+
+import numpy as np
+import numpy.typing as npt
+from scipy import signal
+from mzapy.peaks import find_peaks_1d_gauss, calc_gauss_psnr
+
+
+# type alias for the results of fitting a single trace: (means, heights, FWHMs, pSNRs)
+type GaussPeaks = Tuple[npt.NDArray[np.float64],
+                        npt.NDArray[np.float64],
+                        npt.NDArray[np.float64],
+                        npt.NDArray[np.float64]]
+
+
+# same as in mzapy.peaks._gauss: 0.3606 * FWHM^2 = 2 * sigma^2
+_FWHM_SQ_TO_2VAR: float = 0.3606
+
+
+def _gauss_and_jac(X: npt.NDArray[np.float64],
+                   P: npt.NDArray[np.float64]
+                   ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]] :
+    """
+    evaluate gaussian functions and their jacobians for a batch of traces
+
+    Parameters
+    ----------
+    X : ``numpy.ndarray(float)``
+        x data, shape: (n_traces, n_points)
+    P : ``numpy.ndarray(float)``
+        gaussian function parameters (mean, height, fwhm) for each trace, shape: (n_traces, 3)
+
+    Returns
+    -------
+    G : ``numpy.ndarray(float)``
+        gaussian function values, shape: (n_traces, n_points)
+    J : ``numpy.ndarray(float)``
+        partial derivatives of gaussian function values w.r.t. (mean, height, fwhm),
+        shape: (n_traces, n_points, 3)
+    """
+    mean, height, fwhm = P[:, 0:1], P[:, 1:2], P[:, 2:3]
+    d = X - mean
+    c = _FWHM_SQ_TO_2VAR * fwhm**2.
+    E = np.exp(-d**2. / c)
+    G = height * E
+    J = np.empty(X.shape + (3,))
+    J[:, :, 0] = G * 2. * d / c
+    J[:, :, 1] = E
+    J[:, :, 2] = G * 2. * d**2. / (c * fwhm)
+    return G, J
+
+
+def _fit_one_peak_batch(X: npt.NDArray[np.float64],
+                        Y: npt.NDArray[np.float64],
+                        M: npt.NDArray[np.bool_],
+                        fwhm_min: float,
+                        fwhm_max: float,
+                        max_iter: int = 100,
+                        tol: float = 1e-8
+                        ) -> npt.NDArray[np.float64] :
+    """
+    fit a single gaussian peak to each trace in a batch using bounded Levenberg-Marquardt, the
+    initial guess and bounds are the same as in ``mzapy.peaks._gauss_fit_one_peak``
+
+    Parameters
+    ----------
+    X : ``numpy.ndarray(float)``
+    Y : ``numpy.ndarray(float)``
+        x and y data, shape: (n_traces, n_points)
+    M : ``numpy.ndarray(bool)``
+        mask of valid (not padding) points, shape: (n_traces, n_points)
+    fwhm_min : ``float``
+    fwhm_max : ``float``
+        FWHM bounds
+    max_iter : ``int``, default=100
+        maximum number of LM iterations
+    tol : ``float``, default=1e-8
+        stop iterating on a trace once the relative change in its cost or parameters drops below this
+
+    Returns
+    -------
+    P : ``numpy.ndarray(float)``
+        fitted gaussian function parameters (mean, height, fwhm) for each trace, shape: (n_traces, 3)
+    """
+    n = X.shape[0]
+    rows = np.arange(n)
+    Ym = np.where(M, Y, -np.inf)
+    imax = np.argmax(Ym, axis=1)
+    lb = np.column_stack([np.where(M, X, np.inf).min(axis=1), np.zeros(n), np.full(n, fwhm_min)])
+    ub = np.column_stack([np.where(M, X, -np.inf).max(axis=1), np.full(n, np.inf), np.full(n, fwhm_max)])
+    P = np.column_stack([X[rows, imax], Ym[rows, imax], np.full(n, fwhm_min * 1.05)])
+    P = np.clip(P, lb, ub)
+    G, J = _gauss_and_jac(X, P)
+    R = np.where(M, Y - G, 0.)
+    cost = np.sum(R**2., axis=1)
+    lam = np.full(n, 1e-3)
+    active = np.ones(n, dtype=bool)
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        a = np.nonzero(active)[0]
+        Ja = J[a] * M[a, :, None]
+        JTJ = np.matmul(Ja.transpose(0, 2, 1), Ja)
+        JTr = np.matmul(Ja.transpose(0, 2, 1), R[a, :, None])[:, :, 0]
+        # solve the damped normal equations with the parameters scaled by the diagonal of JTJ
+        # (Marquardt), the parameters (mean, height, fwhm) differ by many orders of magnitude
+        d = np.sqrt(np.diagonal(JTJ, axis1=1, axis2=2))
+        d[d == 0] = 1.
+        A = JTJ / (d[:, :, None] * d[:, None, :]) + lam[a, None, None] * np.eye(3)
+        step = np.linalg.solve(A, (JTr / d)[:, :, None])[:, :, 0] / d
+        P_try = np.clip(P[a] + step, lb[a], ub[a])
+        G_try, J_try = _gauss_and_jac(X[a], P_try)
+        R_try = np.where(M[a], Y[a] - G_try, 0.)
+        cost_try = np.sum(R_try**2., axis=1)
+        better = cost_try < cost[a]
+        ab, aw = a[better], a[~better]
+        # convergence criteria are the same as the scipy.optimize.least_squares defaults (ftol, xtol)
+        converged = (
+            (np.abs(cost[ab] - cost_try[better]) <= tol * cost[ab]) 
+            | np.all(np.abs(P_try[better] - P[ab]) <= tol * (tol + np.abs(P[ab])), axis=1)
+        )
+        P[ab], G[ab], J[ab], R[ab], cost[ab] = P_try[better], G_try[better], J_try[better], R_try[better], cost_try[better]
+        lam[ab] = np.maximum(lam[ab] / 10., 1e-12)
+        lam[aw] *= 10.
+        active[ab[converged]] = False
+        # no step improves the fit
+        active[aw[lam[aw] > 1e12]] = False
+    return P
+
+
+def find_peaks_gauss_padded(X: npt.NDArray[np.float64],
+                            Y: npt.NDArray[np.float64],
+                            M: npt.NDArray[np.bool_],
+                            min_rel_height: float,
+                            min_abs_height: float,
+                            fwhm_min: float,
+                            fwhm_max: float,
+                            max_peaks: int
+                            ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64],
+                                       npt.NDArray[np.float64], npt.NDArray[np.float64]] :
+    """
+    find peaks in a batch of padded traces using the same successive gaussian fitting strategy as
+    ``mzapy.peaks.find_peaks_1d_gauss`` (with residuals truncated at 0): the most intense peak in
+    every trace is fitted at once, then the residuals are fitted for the next peak, until a peak
+    falls below the minimum height or the maximum number of peaks is reached. The pSNR of each peak
+    is computed the same way as ``mzapy.peaks.calc_gauss_psnr``.
+
+    Parameters
+    ----------
+    X : ``numpy.ndarray(float)``
+    Y : ``numpy.ndarray(float)``
+        x and y data, shape: (n_traces, n_points)
+    M : ``numpy.ndarray(bool)``
+        mask of valid (not padding) points, shape: (n_traces, n_points)
+    min_rel_height : ``float``
+        minimum height of peaks (relative to max y)
+    min_abs_height : ``float``
+        minimum absolute height
+    fwhm_min : ``float``
+    fwhm_max : ``float``
+        FWHM bounds
+    max_peaks : ``int``
+        maximum number of peaks to find
+
+    Returns
+    -------
+    means : ``numpy.ndarray(float)``
+    heights : ``numpy.ndarray(float)``
+    fwhms : ``numpy.ndarray(float)``
+    psnrs : ``numpy.ndarray(float)``
+        peak parameters and pSNRs, shape: (n_traces, max_peaks), NaN where there is no peak
+    """
+    n = X.shape[0]
+    means, heights, fwhms, psnrs = [np.full((n, max_peaks), np.nan) for _ in range(4)]
+    min_height = np.maximum(min_abs_height, min_rel_height * np.where(M, Y, -np.inf).max(axis=1))
+    n_valid = M.sum(axis=1)
+    Y_resid = np.where(M, Y, 0.)
+    active = np.nonzero(n_valid > 0)[0]
+    for k in range(max_peaks):
+        if len(active) == 0:
+            break
+        P = _fit_one_peak_batch(X[active], Y_resid[active], M[active], fwhm_min, fwhm_max)
+        ok = P[:, 1] >= min_height[active]
+        active, P = active[ok], P[ok]
+        means[active, k], heights[active, k], fwhms[active, k] = P[:, 0], P[:, 1], P[:, 2]
+        G, _ = _gauss_and_jac(X[active], P)
+        # pSNR against the original trace
+        R = np.where(M[active], G - Y[active], 0.)
+        psnrs[active, k] = P[:, 1] / np.sqrt(np.sum(R**2., axis=1) / n_valid[active])
+        # truncated residuals for fitting the next peak
+        Y_resid[active] = np.where(M[active], np.maximum(Y_resid[active] - G, 0.), 0.)
+    return means, heights, fwhms, psnrs
+
+
+def pad_traces(traces: List[Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]]
+               ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64], npt.NDArray[np.bool_]] :
+    """
+    pad a list of (x, y) traces with different lengths into 2D arrays
+
+    Parameters
+    ----------
+    traces : ``list(tuple(numpy.ndarray(float), numpy.ndarray(float)))``
+        (x, y) data for each trace
+
+    Returns
+    -------
+    X : ``numpy.ndarray(float)``
+    Y : ``numpy.ndarray(float)``
+        x and y data, shape: (n_traces, max trace length), padded with 0
+    M : ``numpy.ndarray(bool)``
+        mask of valid (not padding) points
+    """
+    n_pts = np.array([len(x) for x, _ in traces], dtype=int)
+    L = int(n_pts.max()) if len(traces) > 0 else 0
+    X, Y = np.zeros((len(traces), L)), np.zeros((len(traces), L))
+    M = np.arange(L)[None, :] < n_pts[:, None]
+    for i, (x, y) in enumerate(traces):
+        X[i, :n_pts[i]] = x
+        Y[i, :n_pts[i]] = y
+    return X, Y, M
+
+
+def fit_traces(traces: List[Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]],
+               fit_params: Any,
+               batch_size: int = 256
+               ) -> List[GaussPeaks] :
+    """
+    find and fit gaussian peaks in multiple traces (chromatograms, ATDs) and compute their pSNRs,
+    using the fitting engine selected in the parameters:
+
+    * ``"mzapy"`` -- fit each trace separately with ``mzapy.peaks.find_peaks_1d_gauss``
+    * ``"batch"`` -- fit traces together in batches with ``find_peaks_gauss_padded``
+
+    Parameters
+    ----------
+    traces : ``list(tuple(numpy.ndarray(float), numpy.ndarray(float)))``
+        (x, y) data for each trace
+    fit_params : ``ExtractAndFitChromsParams``
+        peak fitting parameters (min_rel_height, min_abs_height, fwhm, max_peaks, fit_engine)
+    batch_size : ``int``, default=256
+        number of traces to fit at a time with the batch engine, limits memory use
+
+    Returns
+    -------
+    peaks : ``list(tuple(numpy.ndarray(float), ...))``
+        peak means, heights, FWHMs and pSNRs for each trace
+    """
+    match fit_params.fit_engine:
+        case "mzapy":
+            peaks = []
+            for x, y in traces:
+                means, heights, fwhms = find_peaks_1d_gauss(x, y,
+                                                            fit_params.min_rel_height, fit_params.min_abs_height,
+                                                            fit_params.fwhm.min, fit_params.fwhm.max,
+                                                            fit_params.max_peaks, True)
+                psnrs = np.array([calc_gauss_psnr(x, y, pkparams) for pkparams in zip(means, heights, fwhms)])
+                peaks.append((means, heights, fwhms, psnrs))
+            return peaks
+        case "batch":
+            peaks = []
+            for i in range(0, len(traces), batch_size):
+                batch = find_peaks_gauss_padded(*pad_traces(traces[i:i + batch_size]),
+                                                fit_params.min_rel_height, fit_params.min_abs_height,
+                                                fit_params.fwhm.min, fit_params.fwhm.max,
+                                                fit_params.max_peaks)
+                for means, heights, fwhms, psnrs in zip(*batch):
+                    found = ~np.isnan(means)
+                    peaks.append((means[found], heights[found], fwhms[found], psnrs[found]))
+            return peaks
+        case _:
+            msg = f"fit_traces: unrecognized fit_engine ({fit_params.fit_engine}), must be 'mzapy' or 'batch'"
+            raise ValueError(msg)
+
+
+def find_peaks_localmax_sparse(bin_idx: npt.NDArray[np.int64], 
+                               bin_i: npt.NDArray[np.float64],
+                               n_bins: int, 
+                               x_min: float, 
+                               x_max: float, 
+                               min_rel_height: float, 
+                               min_abs_height: float, 
+                               fwhm_min: float, 
+                               fwhm_max: float, 
+                               min_dist: float
+                               ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64], npt.NDArray[np.float64]] :
+    """
+    find peaks in sparse binned data using the local maximum method, gives the same results as 
+    ``mzapy.peaks.find_peaks_1d_localmax`` on the dense data (``numpy.linspace(x_min, x_max, n_bins)``
+    with zeros in the unoccupied bins) without ever building the dense arrays. 
+
+    Only the occupied bins are kept, with a single zero in between runs of occupied bins that are not 
+    adjacent (and at either end). A single zero stands in for any number of them as far as finding 
+    local maxima, peak prominences and peak widths go, only the minimum distance between peaks 
+    depends on the actual number of bins in between so that filter uses the real bin indices. 
+
+    Parameters
+    ----------
+    bin_idx : ``numpy.ndarray(int)``
+        indices of the occupied bins (sorted, unique)
+    bin_i : ``numpy.ndarray(float)``
+        intensities in the occupied bins
+    n_bins : ``int``
+        total number of bins
+    x_min : ``float``
+    x_max : ``float``
+        x values for the first and last bins
+    min_rel_height : ``float``
+        minimum height of peaks (relative to max y)
+    min_abs_height : ``float``
+        minimum absolute height
+    fwhm_min : ``float``
+        minimum peak width (FWHM)
+    fwhm_max : ``float``
+        maximum peak width (FWHM)
+    min_dist : ``float``
+        minimum distance (in units of x) between consecutive peaks
+
+    Returns
+    -------
+    peak_means : ``numpy.ndarray(float)``
+        mean x values for peaks 
+    peak_heights : ``numpy.ndarray(float)``
+        heights for peaks
+    peak_fwhms : ``numpy.ndarray(float)``
+        widths (FWHM) for peaks
+    """
+    empty = np.array([], dtype=np.float64)
+    if len(bin_idx) == 0:
+        return empty, empty, empty
+    # same conversions from x units to bins as find_peaks_1d_localmax
+    bin_width = (x_max - x_min) / n_bins
+    min_bins = max(int(min_dist / bin_width), 1)
+    fwhm_min_bins, fwhm_max_bins = int(fwhm_min / bin_width), int(fwhm_max / bin_width)
+    min_height = max(min_rel_height * max(np.max(bin_i), 0.), min_abs_height)
+    # compact the data: a zero after each run of occupied bins followed by empty bins, and at the start 
+    is_gap = np.diff(bin_idx) > 1
+    ends = np.append(is_gap, bin_idx[-1] < n_bins - 1)
+    n_zeros = ends.cumsum()
+    pos = np.arange(len(bin_idx)) + n_zeros - ends + (1 if bin_idx[0] > 0 else 0)
+    y = np.zeros(pos[-1] + 1 + ends[-1])
+    y[pos] = bin_i
+    idx = np.full(len(y), -1, dtype=np.int64)
+    idx[pos] = bin_idx
+    # local maxima above the minimum height
+    peaks, props = signal.find_peaks(y, height=min_height)
+    heights = props['peak_heights']
+    # minimum distance between peaks (in bins), highest peaks take priority (same as scipy)
+    if min_bins > 1 and len(peaks) > 1:
+        keep = np.ones(len(peaks), dtype=bool)
+        peak_bins = idx[peaks]
+        for i in np.argsort(heights)[::-1]:
+            if not keep[i]:
+                continue
+            j = i - 1
+            while j >= 0 and peak_bins[i] - peak_bins[j] < min_bins:
+                keep[j] = False
+                j -= 1
+            j = i + 1
+            while j < len(peaks) and peak_bins[j] - peak_bins[i] < min_bins:
+                keep[j] = False
+                j += 1
+        peaks, heights = peaks[keep], heights[keep]
+    if len(peaks) == 0:
+        return empty, empty, empty
+    # peak widths (in bins)
+    widths = signal.peak_widths(y, peaks, rel_height=0.5)[0]
+    keep = (widths >= fwhm_min_bins) & (widths <= fwhm_max_bins)
+    peaks, heights, widths = peaks[keep], heights[keep], widths[keep]
+    # x values the same as numpy.linspace(x_min, x_max, n_bins)
+    peak_bins = idx[peaks]
+    peak_means = np.where(peak_bins == n_bins - 1, 
+                          x_max, 
+                          peak_bins * ((x_max - x_min) / (n_bins - 1) if n_bins > 1 else 0.) + x_min)
+    return peak_means, heights, bin_width * widths
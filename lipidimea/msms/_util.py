@@ -8,12 +8,18 @@ Dylan Ross (dylan.ross@pnnl.gov)
 
 import os
 import re
-from typing import Any, Callable, List, Dict
+from typing import Any, Callable, Iterable, Generator, Tuple
+import sqlite3
+import multiprocessing
+import multiprocessing.pool
+import threading
+from contextlib import contextmanager
+from queue import Empty, Full
 
 import numpy as np
 import numpy.typing as npt
 
-from lipidimea.typing import Spec, SpecStr
+from lipidimea.typing import Spec, SpecStr, ResultsDbPath, ResultsDbCursor
 
 
 
@@ -81,12 +87,6 @@ def str_to_ms2(s: SpecStr
     return np.array([ms_, is_])
 
 
-def apply_args_and_kwargs(fn: Callable, args: List[Any], kwargs: Dict[Any, Any]
-                          ) -> Any:
-    """ small helper that enables multiprocessing.Pool.starmap with kwargs """
-    return fn(*args, **kwargs)
-
-
 def ppm_from_delta_mz(delta_mz: float, mz: float
                       ) -> float:
     """
@@ -119,3 +119,140 @@ def tol_from_ppm(mz: float, ppm: float
     mz_tolerance : ``float``
     """
     return mz * ppm / 1e6
+
+
+# max number of batches of results that can be waiting in the queue for the results writer process, 
+# workers block on sending more once it is full so they cannot get too far ahead of the writer
+RESULTS_QUEUE_SIZE: int = 16
+# how often (seconds) to check that the results writer process is still alive while waiting on it 
+_WRITER_POLL_INTERVAL: float = 1.
+
+
+def results_writer(results_db: ResultsDbPath, 
+                   queue: multiprocessing.Queue, 
+                   add_batch: Callable[[ResultsDbCursor, Any], None]
+                   ) -> None :
+    """
+    the one process that writes to the results database during parallel extraction, takes batches of 
+    results off of the queue until it gets None and adds them to the results database using add_batch, 
+    whatever batches are waiting in the queue get added in a single transaction
+
+    Parameters
+    ----------
+    results_db : ``str``
+        path to DDA-DIA analysis results database
+    queue : ``multiprocessing.Queue``
+        queue that the worker processes put batches of results on
+    add_batch : ``func``
+        adds a batch of results to the database, takes a cursor and the batch as arguments
+    """
+    con = sqlite3.connect(results_db)
+    cur = con.cursor()
+    done = False
+    while not done:
+        batches = [queue.get()]
+        # grab any other batches that are already waiting so they go in the same transaction
+        while batches[-1] is not None:
+            try:
+                batches.append(queue.get_nowait())
+            except Empty:
+                break
+        for batch in batches:
+            if batch is None:
+                done = True
+            else:
+                add_batch(cur, batch)
+        con.commit()
+    con.close()
+
+
+def _check_results_writer(writer: multiprocessing.Process
+                          ) -> None :
+    """ raise a RuntimeError if the results writer process is not running anymore """
+    if not writer.is_alive():
+        msg = f"results writer process stopped before all results were sent (exit code: {writer.exitcode})"
+        raise RuntimeError(msg)
+
+
+@contextmanager
+def results_writer_process(results_db: ResultsDbPath, 
+                           add_batch: Callable[[ResultsDbCursor, Any], None]
+                           ) -> Generator[Tuple[multiprocessing.Queue, multiprocessing.Process], None, None] :
+    """
+    context manager that runs a ``results_writer`` process for the duration of the block, yields the 
+    (bounded) queue for sending it batches of results and the writer process itself. On leaving the block 
+    normally the writer gets told to stop, and waited on while it finishes adding whatever is still in the 
+    queue. If the block raises, the writer gets terminated instead. 
+
+    Parameters
+    ----------
+    results_db : ``str``
+        path to DDA-DIA analysis results database
+    add_batch : ``func``
+        adds a batch of results to the database, takes a cursor and the batch as arguments
+
+    Yields
+    ------
+    queue : ``multiprocessing.Queue``
+        queue for sending batches of results to the writer
+    writer : ``multiprocessing.Process``
+        the writer process
+    """
+    queue: multiprocessing.Queue = multiprocessing.Queue(maxsize=RESULTS_QUEUE_SIZE)
+    writer = multiprocessing.Process(target=results_writer, args=(results_db, queue, add_batch))
+    writer.start()
+    try:
+        yield queue, writer
+        # tell the writer to stop once it has added everything else in the queue, 
+        # without getting stuck on a full queue if the writer has gone away
+        while True:
+            _check_results_writer(writer)
+            try:
+                queue.put(None, timeout=_WRITER_POLL_INTERVAL)
+                break
+            except Full:
+                pass
+        writer.join()
+    except BaseException:
+        if writer.is_alive():
+            writer.terminate()
+        writer.join()
+        raise
+    if writer.exitcode != 0:
+        msg = f"results writer process failed (exit code: {writer.exitcode})"
+        raise RuntimeError(msg)
+
+
+def imap_unordered_with_writer(pool: multiprocessing.pool.Pool, 
+                               func: Callable, 
+                               iterable: Iterable[Any], 
+                               writer: multiprocessing.Process
+                               ) -> Generator[Any, None, None] :
+    """
+    ``pool.imap_unordered(func, iterable)`` for workers that send their results to a results writer 
+    process, checks that the writer is still running while waiting on the workers (so a failed writer 
+    shows up right away rather than once all of the work is done). After all of the results have come 
+    back, the pool gets closed and the workers are allowed to exit normally, which is when they finish 
+    sending anything left in their queue buffers to the writer. 
+    
+    NOTE: Leaving the with block of a pool terminates the workers, which can cut off results that they 
+          are still sending to the writer, so the pool should be exhausted through this generator first.
+    """
+    results = pool.imap_unordered(func, iterable)
+    while True:
+        try:
+            result = results.next(timeout=_WRITER_POLL_INTERVAL)
+        except StopIteration:
+            break
+        except multiprocessing.TimeoutError:
+            _check_results_writer(writer)
+            continue
+        yield result
+    pool.close()
+    # wait for the workers to exit in another thread so this one can keep checking on the writer
+    joiner = threading.Thread(target=pool.join, daemon=True)
+    joiner.start()
+    while joiner.is_alive():
+        joiner.join(_WRITER_POLL_INTERVAL)
+        if joiner.is_alive():
+            _check_results_writer(writer)
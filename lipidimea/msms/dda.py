@@ -8,37 +8,488 @@ Dylan Ross (dylan.ross@pnnl.gov)
 """
 
 
-from typing import List, Any, Set, Callable, Optional, Dict, Tuple, Union
+from typing import List, Any, Set, Callable, Optional, Dict, Tuple, Union, Generator, Iterable
 import sqlite3
 from time import time
 from itertools import repeat
+from functools import partial
 import multiprocessing
 import os
 import errno
+from bisect import bisect_left, bisect_right, insort
 
 import numpy as np
+import numpy.typing as npt
 from mzapy.dda import MsmsReaderDda, MsmsReaderDdaCachedMs1
-from mzapy.peaks import find_peaks_1d_gauss, find_peaks_1d_localmax, calc_gauss_psnr
 
 from lipidimea.typing import (
     ResultsDbConnection, ResultsDbCursor, ResultsDbPath, DdaReader, DdaChromFeat, DdaPrecursor,
     MzaFilePath, MzaFileId, Ms2
 )
 from lipidimea.msms._util import (
-    apply_args_and_kwargs, ppm_from_delta_mz, tol_from_ppm
+    ppm_from_delta_mz, tol_from_ppm, results_writer_process, imap_unordered_with_writer
 )
+from lipidimea.msms._peaks import fit_traces, find_peaks_localmax_sparse
 from lipidimea.util import (
-    add_data_file_to_db, debug_handler, AnalysisStep, update_analysis_log, check_analysis_log
+    add_data_file_to_db, debug_handler, AnalysisStep, update_analysis_log, check_analysis_log, 
+    results_db_has_table
 )
 from lipidimea.params import (
     DdaParams
 )
 
 
+# identifies compact MS1 cache files, and the version of their layout
+_MS1_CACHE_MAGIC = 0x31534D6C61646469
+_MS1_CACHE_VERSION = 1
+
+
+class _MsmsReaderDdaMmapMs1(MsmsReaderDda):
+    """
+    ``MsmsReaderDda`` with the MS1 scan data cached in a compact sidecar file next to the MZA file
+    (``<mza_file>.ms1_cache``), which gets built the first time a file is opened and then reused. 
+    
+    The cache stores all of the MS1 scans in a CSR-style layout (m/z and intensity as ``float32``, 
+    concatenated across all scans, with per-scan offsets) and is opened using ``numpy.memmap`` so 
+    the data is not actually loaded into the memory of the process. Multiple processes reading the 
+    same file share the cached data through the OS page cache instead of each holding their own 
+    copy like ``MsmsReaderDdaCachedMs1`` does, so caching can be used with multiprocessing.
+
+    Layout of the cache file: 
+
+    * header (``int64`` x 4): magic, layout version, number of scans, number of points
+    * MS1 scan numbers (``int64`` x n_scans), sorted
+    * scan offsets into the points arrays (``int64`` x n_scans + 1)
+    * m/z of points (``float32`` x n_points), sorted within each scan
+    * intensity of points (``float32`` x n_points)
+    """
+
+    def __init__(self, mza_file, drop_scans=None):
+        """
+        initialize the reader, building the MS1 cache file if needed
+    
+        Parameters
+        ----------
+        mza_file : ``str``
+            path to MZA file
+        drop_scans : ``list(int)``, optional
+            list of scans to drop from the file, can be None if there are not any to drop
+        """
+        super().__init__(mza_file, drop_scans=drop_scans)
+        self.ms1_cache_file = mza_file + ".ms1_cache"
+        try:
+            if not self._open_ms1_cache():
+                self._write_ms1_cache()
+                if not self._open_ms1_cache():
+                    msg = f"_MsmsReaderDdaMmapMs1: unable to open MS1 cache file ({self.ms1_cache_file})"
+                    raise RuntimeError(msg)
+        except BaseException:
+            # do not leave the MZA file open if the cache could not be set up (e.g. the directory is 
+            # not writable)
+            super().close()
+            raise
+
+    def _open_ms1_cache(self
+                        ) -> bool :
+        """ 
+        memory map the MS1 cache file, returns False if the file does not exist, is older than the 
+        MZA file, or does not contain all of the MS1 scans for this reader
+        """
+        if (not os.path.isfile(self.ms1_cache_file) 
+                or os.path.getmtime(self.ms1_cache_file) < os.path.getmtime(self.f)):
+            return False
+        header = np.fromfile(self.ms1_cache_file, dtype=np.int64, count=4)
+        if len(header) < 4 or header[0] != _MS1_CACHE_MAGIC or header[1] != _MS1_CACHE_VERSION:
+            return False
+        n_scans, n_points = int(header[2]), int(header[3])
+        offset = header.nbytes
+        arrays = {}
+        for name, dtype, size in [("scans", np.int64, n_scans), 
+                                  ("offsets", np.int64, n_scans + 1), 
+                                  ("mz", np.float32, n_points), 
+                                  ("i", np.float32, n_points)]:
+            arrays[name] = (
+                np.memmap(self.ms1_cache_file, dtype=dtype, mode="r", offset=offset, shape=(size,)) 
+                if size > 0 else np.zeros(0, dtype=dtype)
+            )
+            offset += size * np.dtype(dtype).itemsize
+        # every MS1 scan in this reader needs to be in the cache
+        idx = np.searchsorted(arrays["scans"], self.ms1_scans)
+        if np.any(idx >= n_scans) or np.any(arrays["scans"][np.minimum(idx, n_scans - 1)] != self.ms1_scans):
+            return False
+        self._ms1_cache_idx = idx
+        self._ms1_cache_offsets = arrays["offsets"]
+        self._ms1_cache_mz = arrays["mz"]
+        self._ms1_cache_i = arrays["i"]
+        return True
+
+    def _write_ms1_cache(self
+                         ) -> None :
+        """ 
+        write the MS1 cache file, goes to a temporary file first then gets renamed so that other 
+        processes never see a partially written cache file
+        """
+        scans = np.sort(self.ms1_scans).astype(np.int64)
+        sizes = np.array([self.arrays_mz.loc[scan, 'Data'].size for scan in scans], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        n_scans, n_points = len(scans), int(offsets[-1])
+        header = np.array([_MS1_CACHE_MAGIC, _MS1_CACHE_VERSION, n_scans, n_points], dtype=np.int64)
+        tmp_file = f"{self.ms1_cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "wb") as bf:
+                header.tofile(bf)
+                scans.tofile(bf)
+                offsets.tofile(bf)
+                # m/z and intensity arrays get filled in scan by scan 
+                mz_start = bf.tell()
+                bf.truncate(mz_start + 8 * n_points)
+            if n_points > 0:
+                cache_mz = np.memmap(tmp_file, dtype=np.float32, mode="r+", offset=mz_start, shape=(n_points,))
+                cache_i = np.memmap(tmp_file, dtype=np.float32, mode="r+", offset=mz_start + 4 * n_points, 
+                                    shape=(n_points,))
+                for scan, i0, i1 in zip(scans, offsets[:-1], offsets[1:]):
+                    smz = self.mz_full[np.asarray(self.arrays_mz.loc[scan, 'Data'][()]).astype(np.int64)]
+                    sin = np.asarray(self.arrays_i.loc[scan, 'Data'][()])
+                    srt = np.argsort(smz, kind="stable")
+                    cache_mz[i0:i1] = smz[srt]
+                    cache_i[i0:i1] = sin[srt]
+                cache_mz.flush()
+                cache_i.flush()
+                del cache_mz, cache_i
+            os.replace(tmp_file, self.ms1_cache_file)
+        finally:
+            # only left over if writing the cache failed partway
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+    def iter_ms1_scans(self, 
+                       scan_mask: Optional[npt.NDArray[np.bool_]] = None
+                       ) -> Generator[Tuple[float, npt.NDArray[np.float32], npt.NDArray[np.float32]], Any, None] :
+        """ 
+        yields (RT, m/z array, intensity array) for each MS1 scan, from the cache, scans that are 
+        excluded by scan_mask (if provided) are not read and come back with empty arrays 
+        """
+        scan_rts = self.metadata.loc[self.ms1_scans, 'RetentionTime']
+        empty = np.array([], dtype=np.float32)
+        for j, (k, rt) in enumerate(zip(self._ms1_cache_idx, scan_rts)):
+            if scan_mask is not None and not scan_mask[j]:
+                yield rt, empty, empty
+                continue
+            i0, i1 = self._ms1_cache_offsets[k], self._ms1_cache_offsets[k + 1]
+            yield rt, self._ms1_cache_mz[i0:i1], self._ms1_cache_i[i0:i1]
+
+    def close(self):
+        """
+        release the memory mapped MS1 cache then close connection to the MZA file
+        """
+        del self._ms1_cache_mz, self._ms1_cache_i, self._ms1_cache_offsets
+        super().close()
+
+    def get_chrom(self, mz, mz_tol):
+        """
+        Select a chromatogram (MS1 only) for a target m/z with specified tolerance
+
+        Parameters
+        ----------
+        mz : ``float``
+            target m/z
+        mz_tol : ``float``
+            m/z tolerance
+
+        Returns
+        -------
+        chrom_rts : ``np.ndarray(float)``
+        chrom_ins : ``np.ndarray(float)``
+            chromatogram retention time and intensity components 
+        """
+        rts, ins = [], []
+        for rt, smz, sin in self.iter_ms1_scans():
+            rts.append(rt)
+            ins.append(np.sum(sin[np.searchsorted(smz, mz - mz_tol, side="left"):
+                                  np.searchsorted(smz, mz + mz_tol, side="right")], dtype=np.float64))
+        return np.array([rts, ins])
+
+
+class _Ms2ScanIndex:
+    """
+    Index of the MS2 scans in a DDA data file, built once per file, for selecting the MS2 scans 
+    that go with a precursor without going through all of the scan metadata for every precursor.
+    The MS2 scans are stored sorted by precursor m/z along with the RT of the MS1 scan each one 
+    was triggered from, so the scans for a precursor m/z window come from a binary search and 
+    only those scans get checked against the RT window.
+
+    ``get_sparse_msms_spectrum`` selects scans and accumulates the binned spectrum the same way as 
+    ``MsmsReaderDda.get_msms_spectrum``, reading only the selected scans and keeping only the occupied 
+    m/z bins.
+    """
+
+    def __init__(self, rdr: MsmsReaderDda) -> None :
+        """
+        build the index from the scan metadata of a DDA reader
+
+        Parameters
+        ----------
+        rdr : ``mzapy.dda.MsmsReaderDda``
+            reader for the DDA data file
+        """
+        self.rdr = rdr
+        md = rdr.metadata
+        is_ms1 = (md['MSLevel'] == 1).to_numpy()
+        ms1_order = np.argsort(md.index.to_numpy()[is_ms1])
+        ms1_scans = md.index.to_numpy()[is_ms1][ms1_order]
+        ms1_rts = md['RetentionTime'].to_numpy()[is_ms1][ms1_order]
+        # RT of the (MS1) precursor scan for each scan, only keep scans that have an MS1 precursor scan
+        pre_scans = md['PrecursorScan'].to_numpy()
+        j = np.clip(np.searchsorted(ms1_scans, pre_scans), 0, max(len(ms1_scans) - 1, 0))
+        keep = (ms1_scans[j] == pre_scans) if len(ms1_scans) > 0 else np.zeros(len(md), dtype=bool)
+        pre_rts = np.where(keep, ms1_rts[j] if len(ms1_scans) > 0 else 0., np.nan)
+        pre_mzs = md['PrecursorMonoisotopicMz'].to_numpy()[keep]
+        # stable sort so scans with the same precursor m/z stay in file order
+        order = np.argsort(pre_mzs, kind='stable')
+        self.pre_mzs: npt.NDArray[np.float64] = pre_mzs[order]
+        self.pre_rts: npt.NDArray[np.float64] = pre_rts[keep][order]
+        self.scans: npt.NDArray[np.int64] = md.index.to_numpy()[keep][order]
+        # position of each scan in the file, to put selected scans back into file order
+        self.pos: npt.NDArray[np.int64] = np.nonzero(keep)[0][order]
+
+    def select_scans(self, 
+                     mz_min: float, 
+                     mz_max: float, 
+                     rt_min: float, 
+                     rt_max: float
+                     ) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.float64]] :
+        """
+        select MS2 scans with precursor m/z and precursor scan RT within bounds (inclusive)
+
+        Returns
+        -------
+        scans : ``numpy.ndarray(int)``
+        pre_mzs : ``numpy.ndarray(float)``
+            selected MS2 scans and their precursor m/zs, in file order
+        """
+        i0 = np.searchsorted(self.pre_mzs, mz_min, side='left')
+        i1 = np.searchsorted(self.pre_mzs, mz_max, side='right')
+        sel = i0 + np.nonzero((self.pre_rts[i0:i1] >= rt_min) & (self.pre_rts[i0:i1] <= rt_max))[0]
+        sel = sel[np.argsort(self.pos[sel])]
+        return self.scans[sel], self.pre_mzs[sel]
+
+    def get_sparse_msms_spectrum(self, mz, mz_tol, rt_min, rt_max, mz_bin_min, mz_bin_max, mz_bin_size):
+        """
+        Selects all MS2 scans with precursor m/z within tolerance of a target value and retention time 
+        between specified bounds, sums spectra together returning the accumulated spectrum and some 
+        metadata about how many scans were included and what precursor m/zs were included. Same as 
+        ``MsmsReaderDda.get_msms_spectrum`` except the accumulated spectrum only includes the occupied 
+        m/z bins, so the size of the spectrum depends on the number of points in the selected MS2 scans 
+        rather than on the width of the m/z range and the bin size.
+
+        Parameters
+        ----------
+        mz : ``float``
+            target m/z for precursor
+        mz_tol : ``float``
+            m/z tolerance for precursor
+        rt_min : ``float``
+            minimum RT for precursor
+        rt_max : ``float``
+            maximum RT for precursor
+        mz_bin_min : ``float``
+            minimum m/z for m/z binning
+        mz_bin_max : ``float``
+            maximum m/z for m/z binning
+        mz_bin_size : ``float``
+            size of bins for m/z binning
+
+        Returns
+        -------
+        bin_idx : ``np.ndarray(int)``
+            indices of the occupied m/z bins (sorted)
+        bin_i : ``np.ndarray(float)``
+            accumulated intensities in the occupied m/z bins
+        n_bins : ``int``
+            total number of m/z bins, bin i is at m/z ``numpy.linspace(mz_bin_min, mz_bin_max, n_bins)[i]``
+        n_ms2_scans : ``int``
+            number of ms2 scans in spectrum
+        scan_pre_mzs : ``list(float)``
+            list of precursor m/zs for selected MS/MS spectrum
+        """
+        scans, scan_pre_mzs = self.select_scans(mz - mz_tol, mz + mz_tol, rt_min, rt_max)
+        # m/z binning parameters
+        mz_bin_range = mz_bin_max - mz_bin_min
+        n_bins = int((mz_bin_max - mz_bin_min) / mz_bin_size) + 1
+        # bin the points from all of the MS2 scans
+        scan_idx, scan_i = [], []
+        for scan in scans:
+            mzbins = np.asarray(self.rdr.arrays_mz.loc[scan, 'Data'][()]).astype(np.int64)
+            intensities = np.asarray(self.rdr.arrays_i.loc[scan, 'Data'][()])
+            idx = np.rint((self.rdr.mz_full[mzbins] - mz_bin_min) / mz_bin_range * n_bins).astype(np.int64)
+            ok = (idx >= 0) & (idx < n_bins)
+            scan_idx.append(idx[ok])
+            scan_i.append(intensities[ok])
+        if len(scans) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float64), n_bins, 0, []
+        # accumulate MS2 scans together over only the occupied bins
+        bin_idx, inv = np.unique(np.concatenate(scan_idx), return_inverse=True)
+        bin_i = np.zeros(len(bin_idx))
+        # unbuffered, adds in the same order as going through the scan points one at a time
+        np.add.at(bin_i, inv, np.concatenate(scan_i))
+        return bin_idx, bin_i, n_bins, len(scans), scan_pre_mzs.tolist()
+
+
+def _iter_ms1_scans(rdr: DdaReader, 
+                    scan_mask: Optional[npt.NDArray[np.bool_]] = None
+                    ) -> Generator[Tuple[float, npt.NDArray[np.float64], npt.NDArray[np.float64]], Any, None] :
+    """
+    yields (RT, m/z array, intensity array) for each MS1 scan in the data file, in RT order, 
+    reading from the cached MS1 data if the reader has it or directly from the MZA file otherwise.
+    Scans that are excluded by scan_mask (if provided) are not read and come back with empty arrays.
+    """
+    if isinstance(rdr, _MsmsReaderDdaMmapMs1):
+        yield from rdr.iter_ms1_scans(scan_mask=scan_mask)
+        return
+    scan_rts = rdr.metadata.loc[rdr.ms1_scans, 'RetentionTime']
+    empty = np.array([])
+    for j, (scan, rt) in enumerate(zip(rdr.ms1_scans, scan_rts)):
+        if scan_mask is not None and not scan_mask[j]:
+            yield rt, empty, empty
+        elif isinstance(rdr, MsmsReaderDdaCachedMs1):
+            yield rt, rdr.arrays_mz_cached[scan], rdr.arrays_i_cached[scan]
+        else:
+            mzbins = np.asarray(rdr.arrays_mz.loc[scan, 'Data'][()])
+            intensities = np.asarray(rdr.arrays_i.loc[scan, 'Data'][()])
+            yield rt, rdr.mz_full[mzbins.astype(np.int64)], intensities
+
+
+def _extract_chroms(rdr: DdaReader,
+                    pre_mzs: npt.NDArray[np.float64],
+                    mz_ppm: float, 
+                    scan_mask: Optional[npt.NDArray[np.bool_]] = None
+                    ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]] :
+    """
+    extracts chromatograms (MS1) for many precursor m/zs at once in a single pass over the MS1 scans
+
+    Each scan is read only once, the intensities for all of the target m/z windows are computed from 
+    the cumulative sum of the scan intensities using binary searches of the (sorted) window edges 
+    against the scan m/z array. The m/z windows are inclusive on both ends, same as 
+    ``MsmsReaderDda.get_chrom``.
+
+    Parameters
+    ----------
+    rdr : ``DdaReader``
+        object for accessing DDA MSMS data from MZA
+    pre_mzs : ``numpy.ndarray(float)``
+        sorted precursor m/zs
+    mz_ppm : ``float``
+        m/z tolerance (in ppm) for extracting chromatograms
+    scan_mask : ``numpy.ndarray(bool)``, optional
+        which MS1 scans to read, shape: (n_scans,), intensities are 0 for the scans that are 
+        not read. All scans are read if not provided.
+
+    Returns
+    -------
+    chrom_rts : ``numpy.ndarray(float)``
+        retention time component shared by all of the chromatograms, shape: (n_scans,)
+    chrom_ins : ``numpy.ndarray(float)``
+        intensity components of the chromatograms, shape: (n_pre_mzs, n_scans)
+    """
+    mz_tols = tol_from_ppm(pre_mzs, mz_ppm)  # type: ignore
+    mz_mins, mz_maxs = pre_mzs - mz_tols, pre_mzs + mz_tols
+    n_scans = len(rdr.ms1_scans)
+    chrom_rts = np.zeros(n_scans)
+    chrom_ins = np.zeros((len(pre_mzs), n_scans))
+    for j, (rt, smz, sin) in enumerate(_iter_ms1_scans(rdr, scan_mask=scan_mask)):
+        chrom_rts[j] = rt
+        if len(smz) < 1:
+            continue
+        if np.any(smz[1:] < smz[:-1]):
+            # binary search needs the scan m/zs to be sorted 
+            srt = np.argsort(smz)
+            smz, sin = smz[srt], sin[srt]
+        csum = np.concatenate([[0.], np.cumsum(sin, dtype=np.float64)])
+        chrom_ins[:, j] = (
+            csum[np.searchsorted(smz, mz_maxs, side="right")] 
+            - csum[np.searchsorted(smz, mz_mins, side="left")]
+        )
+    return chrom_rts, chrom_ins
+
+
+def _ms2_trigger_rt_windows(rdr: DdaReader,
+                            pre_mzs: npt.NDArray[np.float64],
+                            scan_rts: npt.NDArray[np.float64],
+                            rt_tol: float, 
+                            mz_ppm: float = 0.
+                            ) -> npt.NDArray[np.bool_] :
+    """
+    find the MS1 scans that fall within RT windows around the times when each precursor m/z was 
+    selected for MS2 (MS2 scan RT +/- rt_tol)
+
+    Parameters
+    ----------
+    rdr : ``DdaReader``
+        object for accessing DDA MSMS data from MZA
+    pre_mzs : ``numpy.ndarray(float)``
+        sorted precursor m/zs (values from ``rdr.get_pre_mzs()`` or precursor m/z cluster centroids)
+    scan_rts : ``numpy.ndarray(float)``
+        RTs of the MS1 scans (sorted)
+    rt_tol : ``float``
+        RT margin on either side of each MS2 trigger time
+    mz_ppm : ``float``, default=0.
+        tolerance (in ppm) for matching precursor m/zs to MS2 scans, the default only matches 
+        exact precursor m/zs
+
+    Returns
+    -------
+    windows : ``numpy.ndarray(bool)``
+        whether each MS1 scan is within any of the windows for each precursor m/z, 
+        shape: (n_pre_mzs, n_scans)
+    """
+    ms2 = rdr.metadata.loc[rdr.ms2_scans]
+    trig_mzs = ms2['PrecursorMonoisotopicMz'].to_numpy()
+    order = np.argsort(trig_mzs, kind='stable')
+    trig_mzs, trig_rts = trig_mzs[order], ms2['RetentionTime'].to_numpy()[order]
+    windows = np.zeros((len(pre_mzs), len(scan_rts)), dtype=np.bool_)
+    # mark the start (+1) and end (-1) of each window then a cumulative sum gives the coverage, one 
+    # precursor m/z at a time reusing the same (one row) buffers so only the boolean windows are 
+    # ever allocated for all of the precursor m/zs at once
+    edges = np.zeros(len(scan_rts) + 1, dtype=np.int32)
+    cover = np.zeros(len(scan_rts) + 1, dtype=np.int32)
+    mz_tols = tol_from_ppm(pre_mzs, mz_ppm)  # type: ignore
+    i0s = np.searchsorted(trig_mzs, pre_mzs - mz_tols, side='left')
+    i1s = np.searchsorted(trig_mzs, pre_mzs + mz_tols, side='right')
+    for k, (i0, i1) in enumerate(zip(i0s, i1s)):
+        if i1 == i0:
+            continue
+        rts = trig_rts[i0:i1]
+        edges[:] = 0
+        np.add.at(edges, np.searchsorted(scan_rts, rts - rt_tol, side='left'), 1)
+        np.add.at(edges, np.searchsorted(scan_rts, rts + rt_tol, side='right'), -1)
+        np.cumsum(edges, out=cover)
+        np.greater(cover[:-1], 0, out=windows[k])
+    return windows
+
+
+def _chrom_rt_windows(rdr: DdaReader, 
+                      pre_mzs: npt.NDArray[np.float64], 
+                      params: DdaParams
+                      ) -> Optional[npt.NDArray[np.bool_]] :
+    """
+    MS1 scans to extract and fit for each (sorted) precursor m/z, the RT windows around when each 
+    precursor was selected for MS2 (see ``_ms2_trigger_rt_windows``), or None if chromatograms 
+    are extracted over all of the MS1 scans (``extract_and_fit_chroms.rt_tol`` not set)
+    """
+    if params.extract_and_fit_chroms.rt_tol is None:
+        return None
+    return _ms2_trigger_rt_windows(rdr, 
+                                   pre_mzs, 
+                                   rdr.metadata.loc[rdr.ms1_scans, 'RetentionTime'].to_numpy(), 
+                                   params.extract_and_fit_chroms.rt_tol, 
+                                   mz_ppm=params.precursor.cluster_ppm or 0.)
+
+
 def _extract_and_fit_chroms(rdr: DdaReader, 
                             pre_mzs: Set[float], 
                             params: DdaParams,
-                            debug_flag: Optional[str], debug_cb: Optional[Callable] 
+                            debug_flag: Optional[str], debug_cb: Optional[Callable], 
+                            windows: Optional[npt.NDArray[np.bool_]] = None
                             ) -> List[DdaChromFeat] :
     """
     extracts and fits chromatograms for a list of precursor m/zs 
@@ -56,6 +507,10 @@ def _extract_and_fit_chroms(rdr: DdaReader,
     debug_cb : ``func``
         callback function that takes the debugging message as an argument, can be None if
         debug_flag is not set to 'textcb' or 'textcb_pid'
+    windows : ``numpy.ndarray(bool)``, optional
+        precomputed MS2 trigger RT windows (from ``_chrom_rt_windows``) with one row per precursor 
+        m/z in sorted order, computed from the reader if not provided. Ignored if 
+        ``extract_and_fit_chroms.rt_tol`` is not set.
 
     Returns
     -------
@@ -70,20 +525,34 @@ def _extract_and_fit_chroms(rdr: DdaReader,
     chrom_feats: List[DdaChromFeat] = []
     t0 = time()
     n: int = len(pre_mzs)
-    for i, pre_mz in enumerate(pre_mzs): 
+    # extract all of the chromatograms in a single pass over the MS1 data
+    assert P.mz_ppm is not None
+    _pre_mzs = np.sort(np.array(list(pre_mzs), dtype=np.float64))
+    traces: List[Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]]
+    if P.rt_tol is not None:
+        # only extract and fit the parts of the chromatograms around when each precursor was 
+        # selected for MS2, MS1 scans that are not near any MS2 trigger do not get read at all
+        if windows is None:
+            windows = _chrom_rt_windows(rdr, _pre_mzs, params)
+        assert windows is not None and windows.shape[0] == n, "need one RT window row per precursor m/z"
+        chrom_rts, chrom_ins = _extract_chroms(rdr, _pre_mzs, P.mz_ppm, scan_mask=windows.any(axis=0))
+        traces = [(chrom_rts[win], ins[win]) for ins, win in zip(chrom_ins, windows)]
+    else:
+        chrom_rts, chrom_ins = _extract_chroms(rdr, _pre_mzs, P.mz_ppm)
+        traces = [(chrom_rts, ins) for ins in chrom_ins]
+    # skip chromatograms without any signal to fit (only possible with RT windows)
+    has_signal = [len(rts) > 1 and np.any(ins > 0) for rts, ins in traces] if P.rt_tol is not None else [True] * n
+    # try fitting chromatograms (up to n peaks each), also gives pSNR for each fitted peak
+    fits = iter(fit_traces([trace for trace, sig in zip(traces, has_signal) if sig], P))
+    for i, (pre_mz, sig) in enumerate(zip(_pre_mzs.tolist(), has_signal)): 
         msg = f"({i + 1}/{n}) precursor m/z: {pre_mz:.4f} -> "
-        # extract chromatogram
-        assert P.mz_ppm is not None
-        chrom = rdr.get_chrom(pre_mz, tol_from_ppm(pre_mz, P.mz_ppm))
-        # try fitting chromatogram (up to n peaks)
-        _pkrts, _pkhts, _pkwts = find_peaks_1d_gauss(*chrom, 
-                                                     P.min_rel_height, P.min_abs_height,  # type: ignore
-                                                     P.fwhm.min, P.fwhm.max,              # type: ignore
-                                                     P.max_peaks, True)                   # type: ignore
-        # calc pSNR for each fitted peak, make sure they meet a threshold
+        if not sig:
+            debug_handler(debug_flag, debug_cb, msg + 'no signal in MS2 trigger RT windows', pid)
+            continue
+        _pkrts, _pkhts, _pkwts, _psnrs = next(fits)
+        # make sure pSNR for each fitted peak meets a threshold
         pkrts, pkhts, pkwts, psnrs = [], [], [], []
-        for pkparams in zip(_pkrts, _pkhts, _pkwts):
-            psnr = calc_gauss_psnr(*chrom, pkparams) # type: ignore
+        for *pkparams, psnr in zip(_pkrts, _pkhts, _pkwts, _psnrs):
             if psnr > P.min_psnr:
                 pkrts.append(pkparams[0])
                 pkhts.append(pkparams[1])
@@ -130,16 +599,32 @@ def _consolidate_chrom_feats(chrom_feats: List[DdaChromFeat],
     pid = os.getpid()
     # consolidate features
     chrom_feats_consolidated: List[DdaChromFeat] = []
+    # keep (m/z, index) of the consolidated features sorted by m/z, then only the consolidated 
+    # features within the m/z tolerance window need to be checked for each feature (binary search)
+    # the tolerance is relative to the consolidated feature m/z (c): |m/z - c| <= ppm * c / 1e6
+    # so the window is m/z / (1 + ppm / 1e6) <= c <= m/z / (1 - ppm / 1e6), padded a little bit 
+    # here to be safe with floating point, the exact check happens inside the window 
+    mz_index: List[Tuple[float, int]] = []
+    win_lo: float = 1. / (1. + P.mz_ppm / 1e6) * (1. - 1e-9)
+    win_hi: float = 1. / (1. - P.mz_ppm / 1e6) * (1. + 1e-9)
     for feat in chrom_feats:
         add: bool = True
-        for i in range(len(chrom_feats_consolidated)):
+        in_window = sorted([
+            i for _, i in 
+            mz_index[bisect_left(mz_index, (feat[0] * win_lo, -1)):bisect_right(mz_index, (feat[0] * win_hi, len(mz_index)))]
+        ])
+        for i in in_window:
             fc_i: DdaChromFeat = chrom_feats_consolidated[i]
             delta_mz: float = abs(feat[0] - fc_i[0])
             if ppm_from_delta_mz(delta_mz, fc_i[0]) <= P.mz_ppm and abs(feat[1] - fc_i[1]) <= P.rt_tol:
                 add = False
                 if feat[2] > fc_i[2]:
                     chrom_feats_consolidated[i] = feat
+                    # update the m/z index for the replaced feature
+                    del mz_index[bisect_left(mz_index, (fc_i[0], i))]
+                    insort(mz_index, (feat[0], i))
         if add:
+            insort(mz_index, (feat[0], len(chrom_feats_consolidated)))
             chrom_feats_consolidated.append(feat)
     msg = (
         f"CONSOLIDATING CHROMATOGRAPHIC FEATURES: {len(chrom_feats)} features "
@@ -149,15 +634,79 @@ def _consolidate_chrom_feats(chrom_feats: List[DdaChromFeat],
     return chrom_feats_consolidated
 
 
-def _extract_and_fit_ms2_spectra(rdr: DdaReader,
-                                 dda_file_id: MzaFileId,
-                                 chrom_feats_consolidated: List[DdaChromFeat],
-                                 params: DdaParams,
-                                 debug_flag: Optional[str], debug_cb: Optional[Callable] 
-                                 ) -> Tuple[List[DdaPrecursor], List[Optional[Ms2]]] :
+# m/z spacing between isotopes (13C - 12C)
+_ISOTOPE_SPACING: float = 1.00336
+
+
+def _drop_isotope_chrom_feats(chrom_feats: List[DdaChromFeat], 
+                              params: DdaParams, 
+                              debug_flag: Optional[str], debug_cb: Optional[Callable] 
+                              ) -> List[DdaChromFeat] :
+    """
+    finds chromatographic features that are M+1 or M+2 isotopes of a more intense co-eluting 
+    feature (only singly charged), those features are dropped so that they do not get MS2 spectra 
+    extracted or end up as DIA targets. Uses the same m/z and RT tolerances as chromatographic 
+    feature consolidation.
+
+    Parameters
+    ----------
+    chrom_feats : ``list(tuple(...))``
+        list of chromatographic features (pre_mz, peak RT, peak height, peak FWHM, pSNR)
+    params : ``DdaParams``
+        DDA data processing parameters
+    debug_flag : ``str``
+        specifies how to dispatch debugging messages, None to do nothing
+    debug_cb : ``func``
+        callback function that takes the debugging message as an argument, can be None if
+        debug_flag is not set to 'textcb' or 'textcb_pid'
+
+    Returns
+    -------
+    chrom_feats_deisotoped : ``list(tuple(...))``
+        list of chromatographic features without the isotopes, in the same order
+    """
+    # unpack params
+    P = params.consolidate_chrom_feats
+    pid = os.getpid()
+    if len(chrom_feats) == 0:
+        return []
+    feats = np.array([feat[:3] for feat in chrom_feats], dtype=np.float64)
+    order = np.argsort(feats[:, 0], kind='stable')
+    mzs, rts, hts = feats[order, 0], feats[order, 1], feats[order, 2]
+    is_isotope = np.zeros(len(mzs), dtype=bool)
+    for n_c13 in (1, 2):
+        # all pairs of (monoisotopic, isotope) features within the m/z tolerance of the isotope spacing 
+        iso_mzs = mzs + n_c13 * _ISOTOPE_SPACING
+        mz_tols = tol_from_ppm(iso_mzs, P.mz_ppm)  # type: ignore
+        i0s = np.searchsorted(mzs, iso_mzs - mz_tols, side='left')
+        i1s = np.searchsorted(mzs, iso_mzs + mz_tols, side='right')
+        counts = i1s - i0s
+        mono = np.repeat(np.arange(len(mzs)), counts)
+        iso = np.repeat(i1s - counts.cumsum(), counts) + np.arange(counts.sum())
+        # isotopes co-elute with the monoisotopic feature and are less intense
+        match = (np.abs(rts[iso] - rts[mono]) <= P.rt_tol) & (hts[iso] < hts[mono])
+        is_isotope[iso[match]] = True
+    drop = np.zeros(len(chrom_feats), dtype=bool)
+    drop[order] = is_isotope
+    chrom_feats_deisotoped = [feat for feat, d in zip(chrom_feats, drop) if not d]
+    msg = (
+        f"DROPPING ISOTOPE CHROMATOGRAPHIC FEATURES: {len(chrom_feats)} features "
+        f"-> {len(chrom_feats_deisotoped)} features"
+    )
+    debug_handler(debug_flag, debug_cb, msg, pid)
+    return chrom_feats_deisotoped
+
+
+def _iter_ms2_spectra(rdr: DdaReader,
+                      dda_file_id: MzaFileId,
+                      chrom_feats_consolidated: List[DdaChromFeat],
+                      params: DdaParams,
+                      debug_flag: Optional[str], debug_cb: Optional[Callable], 
+                      ms2_index: _Ms2ScanIndex
+                      ) -> Generator[Tuple[DdaPrecursor, Optional[Ms2]], None, None] :
     """
     extracts MS2 spectra for consolidated chromatographic features, tries to fit spectra peaks,
-    returns query data for adding features to database
+    yields query data for adding features to database one feature at a time
 
     Parameters
     ----------
@@ -174,14 +723,16 @@ def _extract_and_fit_ms2_spectra(rdr: DdaReader,
     debug_cb : ``func``
         callback function that takes the debugging message as an argument, can be None if
         debug_flag is not set to 'textcb' or 'textcb_pid'
+    ms2_index : ``_Ms2ScanIndex``
+        index of the MS2 scans in the data file
 
-    Returns
-    -------
-    precursors : ``list(tuple(...))``
-        list of precursor info (as tuple) for each precursor
+    Yields
+    ------
+    precursor : ``tuple(...)``
+        precursor info (as tuple) 
             [None, int, float, float, float, float, float, int, Optional[int]]
-    spectra : ``list(numpy.ndarray(float) or None)``
-        list of tandem mass spectra (centroided, as 2D arrays) or None if no MS2 peaks were found
+    spectrum : ``numpy.ndarray(float) or None``
+        tandem mass spectrum (centroided, as 2D array) or None if no MS2 peaks were found
     """
     # unpack params
     P = params.extract_and_fit_ms2_spectra
@@ -192,8 +743,6 @@ def _extract_and_fit_ms2_spectra(rdr: DdaReader,
                   'EXTRACTING AND FITTING MS2 SPECTRA', 
                   pid)
     t0 = time()
-    precursors: List[DdaPrecursor] = []
-    spectra: List[Optional[Ms2]] = []
     n: int = len(chrom_feats_consolidated)
     for i, (fmz, frt, fht, fwt, fsnr) in enumerate(chrom_feats_consolidated):
         msg: str = f"({i + 1}/{n}) m/z: {fmz:.4f} RT: {frt:.2f} +/- {fwt:.2f} min ({fht:.1e}, {fsnr:.1f}) -> "
@@ -203,45 +752,181 @@ def _extract_and_fit_ms2_spectra(rdr: DdaReader,
         mz_bin_max: float = fmz + 5  # only extract MS2 spectrum up to precursor m/z + 5 Da
         # (try to) extract MS2 spectrum
         assert P.pre_mz_ppm is not None
-        ms2 = rdr.get_msms_spectrum(fmz, 
-                                    tol_from_ppm(fmz, P.pre_mz_ppm), 
-                                    rt_min, 
-                                    rt_max, 
-                                    P.mz_bin_min, 
-                                    mz_bin_max, 
-                                    P.mz_bin_size)
-        mz_bins, i_bins, n_scan_pre_mzs, scan_pre_mzs = ms2
+        ms2_args = (fmz, tol_from_ppm(fmz, P.pre_mz_ppm), rt_min, rt_max, P.mz_bin_min, mz_bin_max, P.mz_bin_size)
+        # sparse spectrum (only the occupied m/z bins) from the MS2 scans selected using the index
+        bin_idx, bin_i, n_bins, n_scan_pre_mzs, scan_pre_mzs = ms2_index.get_sparse_msms_spectrum(*ms2_args)
         msg += f"# MS2 scans: {n_scan_pre_mzs}"
         if n_scan_pre_mzs > 0:
             # find peaks
-            pkmzs, pkhts, pkwts = find_peaks_1d_localmax(mz_bins, i_bins,
-                                                         P.min_rel_height, P.min_abs_height, 
-                                                         P.fwhm.min, P.fwhm.max, 
-                                                         P.peak_min_dist)
+            pkmzs, pkhts, pkwts = find_peaks_localmax_sparse(bin_idx, bin_i, n_bins, 
+                                                             P.mz_bin_min, mz_bin_max, 
+                                                             P.min_rel_height, P.min_abs_height, 
+                                                             P.fwhm.min, P.fwhm.max, 
+                                                             P.peak_min_dist)
             if len(pkmzs) > 0:
-                precursors.append((None, dda_file_id, fmz, frt, fwt, fht, fsnr, n_scan_pre_mzs, len(pkmzs)))
-                spectra.append(np.array([pkmzs, pkhts]))  # type: ignore
+                debug_handler(debug_flag, 
+                              debug_cb, 
+                              msg + f"-> # MS2 peaks: {len(pkmzs)}", 
+                              pid)
+                yield (None, dda_file_id, fmz, frt, fwt, fht, fsnr, n_scan_pre_mzs, len(pkmzs)), np.array([pkmzs, pkhts])  # type: ignore
             else:
-                precursors.append((None, dda_file_id, fmz, frt, fwt, fht, fsnr, n_scan_pre_mzs, 0))
-                spectra.append(None)
-            debug_handler(debug_flag, 
-                          debug_cb, 
-                          msg + f"-> # MS2 peaks: {len(pkmzs)}", 
-                          pid)
+                debug_handler(debug_flag, 
+                              debug_cb, 
+                              msg + f"-> # MS2 peaks: {len(pkmzs)}", 
+                              pid)
+                yield (None, dda_file_id, fmz, frt, fwt, fht, fsnr, n_scan_pre_mzs, 0), None
         else:
-            precursors.append((None, dda_file_id, fmz, frt, fwt, fht, fsnr, n_scan_pre_mzs, None))
-            spectra.append(None)
             debug_handler(debug_flag, 
                           debug_cb, 
                           msg, 
                           pid)
+            yield (None, dda_file_id, fmz, frt, fwt, fht, fsnr, n_scan_pre_mzs, None), None
     debug_handler(debug_flag, 
                   debug_cb, 
                   f"EXTRACTING AND FITTING MS2 SPECTRA: elapsed: {time() - t0:.1f} s", 
                   pid)
+
+
+def _extract_and_fit_ms2_spectra(rdr: DdaReader,
+                                 dda_file_id: MzaFileId,
+                                 chrom_feats_consolidated: List[DdaChromFeat],
+                                 params: DdaParams,
+                                 debug_flag: Optional[str], debug_cb: Optional[Callable], 
+                                 ms2_index: Optional[_Ms2ScanIndex] = None
+                                 ) -> Tuple[List[DdaPrecursor], List[Optional[Ms2]]] :
+    """
+    extracts MS2 spectra for consolidated chromatographic features, tries to fit spectra peaks,
+    returns query data for adding features to database
+
+    Parameters
+    ----------
+    rdr : ``_MSMSReaderDDA``
+        object for accessing DDA MSMS data from MZA
+    dda_file_id : ``int``
+        file ID for DDA data file
+    chrom_feats_consolidated : ``list(tuple(...))``
+        list of consolidated chromatographic features (pre_mz, peak RT, peak FWHM, peak height, pSNR)
+    params : ``ExtractAndFitMS2SpectraParams``
+        parameters for mass spectum extraction and fitting
+    debug_flag : ``str``
+        specifies how to dispatch debugging messages, None to do nothing
+    debug_cb : ``func``
+        callback function that takes the debugging message as an argument, can be None if
+        debug_flag is not set to 'textcb' or 'textcb_pid'
+    ms2_index : ``_Ms2ScanIndex``, optional
+        index of the MS2 scans in the data file, gets built here if not provided
+
+    Returns
+    -------
+    precursors : ``list(tuple(...))``
+        list of precursor info (as tuple) for each precursor
+            [None, int, float, float, float, float, float, int, Optional[int]]
+    spectra : ``list(numpy.ndarray(float) or None)``
+        list of tandem mass spectra (centroided, as 2D arrays) or None if no MS2 peaks were found
+    """
+    if ms2_index is None:
+        ms2_index = _Ms2ScanIndex(rdr)  # type: ignore
+    precursors: List[DdaPrecursor] = []
+    spectra: List[Optional[Ms2]] = []
+    for precursor, spectrum in _iter_ms2_spectra(rdr, dda_file_id, chrom_feats_consolidated, params, 
+                                                 debug_flag, debug_cb, ms2_index=ms2_index):
+        precursors.append(precursor)
+        spectra.append(spectrum)
     return precursors, spectra
 
 
+class _DdaFeatureTable:
+    """
+    compact columnar storage for a batch of DDA features (precursors and their MS/MS spectra). 
+    The precursors are stored in a structured array with one field per column of the DDAPrecursors 
+    table (except dda_pre_id, which gets assigned when they are added to the database, and with -1 
+    in place of NULL for the nullable INT columns), and the spectra are concatenated into flat m/z 
+    and intensity arrays with per-precursor offsets. This is a lot smaller than lists of tuples and 
+    small arrays, which matters when sending features between processes, and the rows for inserting 
+    into the database can be generated in bulk. Features get packed into tables once, as their MS2 
+    spectra are extracted, and the tables go all the way to the database from there. The steps before 
+    that (chromatographic features and their consolidation) still work with lists of tuples.
+    """
+
+    precursor_dtype = np.dtype([
+        ("dfile_id", np.int64), 
+        ("mz", np.float64), 
+        ("rt", np.float64), 
+        ("rt_fwhm", np.float64), 
+        ("rt_pkht", np.float64), 
+        ("rt_psnr", np.float64), 
+        ("ms2_n_scans", np.int64), 
+        ("ms2_n_peaks", np.int64),
+    ])
+
+    def __init__(self, 
+                 precursors: npt.NDArray[np.void], 
+                 frag_mzs: npt.NDArray[np.float64], 
+                 frag_iis: npt.NDArray[np.float64], 
+                 offsets: npt.NDArray[np.int64]
+                 ) -> None :
+        """
+        Parameters
+        ----------
+        precursors : ``numpy.ndarray``
+            precursor info, structured array with ``precursor_dtype``, shape: (n_precursors,)
+        frag_mzs : ``numpy.ndarray(float)``
+        frag_iis : ``numpy.ndarray(float)``
+            m/z and intensity of all fragments (concatenated spectra), shape: (n_fragments,)
+        offsets : ``numpy.ndarray(int)``
+            the fragments for precursor i are frag_mzs[offsets[i]:offsets[i + 1]], 
+            shape: (n_precursors + 1,)
+        """
+        self.precursors = precursors
+        self.frag_mzs = frag_mzs
+        self.frag_iis = frag_iis
+        self.offsets = offsets
+
+    @classmethod
+    def from_features(cls, 
+                      features: Iterable[Tuple[DdaPrecursor, Optional[Ms2]]]
+                      ) -> "_DdaFeatureTable" :
+        """ build a feature table from (precursor, spectrum) pairs, e.g. from ``_iter_ms2_spectra`` """
+        rows, spec_mzs, spec_iis, counts = [], [], [], [0]
+        for (_, *pre), spec in features:
+            # NULL -> -1 for ms2_n_scans and ms2_n_peaks
+            rows.append(tuple(pre[:6]) + tuple(-1 if _ is None else _ for _ in pre[6:]))
+            if spec is None:
+                counts.append(0)
+            else:
+                spec_mzs.append(spec[0])
+                spec_iis.append(spec[1])
+                counts.append(spec.shape[1])
+        return cls(
+            np.array(rows, dtype=cls.precursor_dtype),
+            np.concatenate(spec_mzs) if spec_mzs else np.array([], dtype=np.float64),
+            np.concatenate(spec_iis) if spec_iis else np.array([], dtype=np.float64),
+            np.cumsum(counts, dtype=np.int64)
+        )
+
+    def __len__(self) -> int :
+        return len(self.precursors)
+
+    def __iter__(self) -> Generator[Tuple[DdaPrecursor, Optional[Ms2]], None, None] :
+        """ yields (precursor, spectrum) pairs, the same as they were before going into the table """
+        for pre, i0, i1 in zip(self.precursor_rows(), self.offsets[:-1].tolist(), self.offsets[1:].tolist()):
+            yield (None, *pre), (np.array([self.frag_mzs[i0:i1], self.frag_iis[i0:i1]]) if i1 > i0 else None)  # type: ignore
+
+    def precursor_rows(self) -> List[Tuple[Any, ...]] :
+        """ precursor info as tuples of python values (without dda_pre_id), -1 -> None """
+        return [
+            tuple(pre[:6]) + tuple(None if _ < 0 else _ for _ in pre[6:]) 
+            for pre in self.precursors.tolist()
+        ]
+
+    def fragment_rows(self, 
+                      first_id: int
+                      ) -> Iterable[Tuple[None, int, float, float]] :
+        """ rows for the DDAFragments table, with the precursors getting sequential IDs from first_id """
+        pre_ids = np.repeat(np.arange(first_id, first_id + len(self)), np.diff(self.offsets))
+        return zip(repeat(None), pre_ids.tolist(), self.frag_mzs.tolist(), self.frag_iis.tolist())
+
+
 def _add_precursors_and_fragments_to_db(cur: ResultsDbCursor, 
                                         precursors: List[DdaPrecursor], 
                                         spectra: List[Optional[Ms2]],
@@ -266,18 +951,284 @@ def _add_precursors_and_fragments_to_db(cur: ResultsDbCursor,
     """
     pid = os.getpid()
     debug_handler(debug_flag, debug_cb, f'ADDING {len(precursors)} DDA FEATURES TO DATABASE', pid)
+    _insert_dda_feature_table(cur, _DdaFeatureTable.from_features(zip(precursors, spectra)))
+
+
+def _insert_dda_feature_table(cur: ResultsDbCursor, 
+                              table: _DdaFeatureTable
+                              ) -> None :
+    """
+    inserts a table of precursors and their fragments into the database, committing is left up to the 
+    caller. The range of dda_pre_id values for the table is allocated up front so that the fragments can 
+    be linked to their precursors without inserting the precursors one at a time, this happens in the 
+    same transaction as the inserts (one gets started, taking the write lock, if the caller does not 
+    already have one open) so no other connection can take the same IDs.
+    """
     qry_pre = """--beginsql
         INSERT INTO DDAPrecursors VALUES (?,?,?,?,?,?,?,?,?)
     --endsql"""
     qry_frag = """--beginsql
         INSERT INTO DDAFragments VALUES (?,?,?,?)
     --endsql"""
-    for pre, spec in zip(precursors, spectra):
-        cur.execute(qry_pre, pre)
-        pre_id = cur.lastrowid
-        if spec is not None:
-            for msms_mz, msms_i in spec.T:  # type: ignore
-                cur.execute(qry_frag, (None, pre_id, msms_mz, msms_i))
+    qry_max_id = """--beginsql
+        SELECT COALESCE(MAX(dda_pre_id), 0) FROM DDAPrecursors
+    --endsql"""
+    if not cur.connection.in_transaction:
+        cur.execute("BEGIN IMMEDIATE")
+    first_id: int = cur.execute(qry_max_id).fetchone()[0] + 1
+    cur.executemany(qry_pre, [(first_id + i, *pre) for i, pre in enumerate(table.precursor_rows())])
+    cur.executemany(qry_frag, table.fragment_rows(first_id))
+
+
+def _iter_feature_tables(features: Iterable[Tuple[DdaPrecursor, Optional[Ms2]]],
+                         chunk_size: int = 1000
+                         ) -> Generator[_DdaFeatureTable, None, None] :
+    """
+    packs features (precursors paired with their MS/MS spectra, e.g. from ``_iter_ms2_spectra``) into 
+    tables of at most chunk_size features as they come in, so only one chunk needs to be held in memory 
+    at a time
+    """
+    chunk: List[Tuple[DdaPrecursor, Optional[Ms2]]] = []
+    for feature in features:
+        chunk.append(feature)
+        if len(chunk) == chunk_size:
+            yield _DdaFeatureTable.from_features(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        yield _DdaFeatureTable.from_features(chunk)
+
+
+def _init_dda_reader(dda_data_file: MzaFilePath,
+                     cache_ms1: bool,
+                     drop_scans: Optional[List[int]], 
+                     debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None
+                     ) -> DdaReader :
+    """ 
+    initialize the appropriate DDA reader depending on whether MS1 data is cached, falls back to the 
+    uncached reader if the MS1 cache file cannot be written (e.g. the data directory is read-only)
+    """
+    if cache_ms1:
+        try:
+            return _MsmsReaderDdaMmapMs1(dda_data_file, drop_scans=drop_scans)
+        except OSError as e:
+            msg = f"unable to set up MS1 cache ({e}), reading MS1 data from the MZA file instead"
+            debug_handler(debug_flag, debug_cb, msg, os.getpid())
+    return MsmsReaderDda(dda_data_file, drop_scans=drop_scans)
+
+
+def _cluster_pre_mzs(pre_mzs: Set[float], 
+                     mz_ppm: float
+                     ) -> Set[float] :
+    """
+    cluster precursor m/zs that are within a ppm tolerance of one another, in a single sweep over 
+    the sorted m/zs, and return the cluster centroids (mean m/z). Each cluster spans at most mz_ppm 
+    (relative to its lowest m/z) so that all of the members are within mz_ppm of the centroid. 
+
+    Parameters
+    ----------
+    pre_mzs : ``set(float)``
+        precursor m/zs
+    mz_ppm : ``float``
+        m/z tolerance (in ppm) for clustering
+
+    Returns
+    -------
+    centroids : ``set(float)``
+        centroid m/zs of the precursor m/z clusters
+    """
+    mzs = np.sort(np.array(list(pre_mzs), dtype=np.float64))
+    centroids = set()
+    i = 0
+    while i < len(mzs):
+        # the cluster extends as far as the tolerance from its lowest m/z 
+        j = int(np.searchsorted(mzs, mzs[i] + tol_from_ppm(mzs[i], mz_ppm), side='right'))
+        centroids.add(float(np.mean(mzs[i:j])))
+        i = j
+    return centroids
+
+
+def _split_pre_mzs(pre_mzs: Set[float], 
+                   n_chunks: int
+                   ) -> List[Set[float]] :
+    """ 
+    split precursor m/zs into (at most) n_chunks m/z-contiguous chunks of roughly equal size, 
+    empty chunks are not included 
+    """
+    return [set(chunk.tolist()) for chunk in np.array_split(np.sort(list(pre_mzs)), n_chunks) if len(chunk) > 0]
+
+
+# DDA reader owned by each worker process when running extract_dda_features with n_proc > 1,
+# gets set up by _init_dda_worker when the worker process starts
+_WORKER_RDR: Optional[DdaReader] = None
+# index of the MS2 scans for the worker reader, gets built the first time the worker extracts MS2 spectra
+_WORKER_MS2_INDEX: Optional[_Ms2ScanIndex] = None
+
+
+def _init_dda_worker(dda_data_file: MzaFilePath,
+                     cache_ms1: bool,
+                     drop_scans: Optional[List[int]]
+                     ) -> None :
+    """ worker process initializer, sets up the reader this worker uses for all of its chunks """
+    global _WORKER_RDR, _WORKER_MS2_INDEX
+    _WORKER_RDR = _init_dda_reader(dda_data_file, cache_ms1, drop_scans)
+    _WORKER_MS2_INDEX = None
+
+
+def _extract_and_fit_chroms_worker(pre_mzs: Set[float], 
+                                   windows: Optional[npt.NDArray[np.bool_]],
+                                   params: DdaParams,
+                                   debug_flag: Optional[str], debug_cb: Optional[Callable] 
+                                   ) -> List[DdaChromFeat] :
+    """ 
+    runs _extract_and_fit_chroms on a chunk of precursor m/zs (and the rows of the MS2 trigger RT 
+    windows for those m/zs) using the reader for this worker 
+    """
+    assert _WORKER_RDR is not None, "DDA worker reader was not initialized"
+    return _extract_and_fit_chroms(_WORKER_RDR, pre_mzs, params, debug_flag, debug_cb, windows=windows)
+
+
+def _extract_and_fit_ms2_spectra_worker(dda_file_id: MzaFileId,
+                                        chrom_feats_consolidated: List[DdaChromFeat],
+                                        params: DdaParams,
+                                        debug_flag: Optional[str], debug_cb: Optional[Callable] 
+                                        ) -> _DdaFeatureTable :
+    """ 
+    runs _iter_ms2_spectra on a chunk of features using the reader for this worker, the features 
+    are packed into a table to keep the result that gets sent back to the main process small
+    """
+    global _WORKER_MS2_INDEX
+    assert _WORKER_RDR is not None, "DDA worker reader was not initialized"
+    if _WORKER_MS2_INDEX is None:
+        _WORKER_MS2_INDEX = _Ms2ScanIndex(_WORKER_RDR)  # type: ignore
+    return _DdaFeatureTable.from_features(
+        _iter_ms2_spectra(_WORKER_RDR, dda_file_id, chrom_feats_consolidated, params, 
+                          debug_flag, debug_cb, ms2_index=_WORKER_MS2_INDEX)
+    )
+
+
+def _extract_dda_features_parallel(dda_data_file: MzaFilePath,
+                                   dda_file_id: MzaFileId,
+                                   pre_mzs: Set[float],
+                                   windows: Optional[npt.NDArray[np.bool_]],
+                                   params: DdaParams,
+                                   n_proc: int,
+                                   cache_ms1: bool, 
+                                   drop_scans: Optional[List[int]],
+                                   debug_flag: Optional[str], debug_cb: Optional[Callable], 
+                                   chunk_size: int = 1000
+                                   ) -> Generator[_DdaFeatureTable, None, None] :
+    """
+    runs the chromatogram and MS2 spectrum extraction steps for a single DDA data file using a 
+    pool of worker processes, each owning its own reader. The precursor m/zs are split into 
+    m/z-contiguous chunks for extracting and fitting chromatograms, each chunk gets only its rows of 
+    the MS2 trigger RT windows (from ``_chrom_rt_windows``, computed once for all of the precursor 
+    m/zs) so the workers only read the MS1 scans that their own m/zs need. The chromatographic features 
+    from all chunks are merged and consolidated, then the consolidated features get split up 
+    again (into chunks of at most chunk_size) for extracting MS2 spectra. The tables of precursors 
+    and their spectra from the workers are yielded as the chunks complete, in the same order as 
+    running serially.
+    """
+    with multiprocessing.Pool(processes=n_proc, 
+                              initializer=_init_dda_worker, 
+                              initargs=(dda_data_file, cache_ms1, drop_scans)) as p:
+        # extract chromatographic features, chunks come back in m/z order
+        pre_mz_chunks = _split_pre_mzs(pre_mzs, n_proc)
+        # chunks are m/z-contiguous so their RT windows are consecutive blocks of rows
+        bounds = np.cumsum([0] + [len(chunk) for chunk in pre_mz_chunks])
+        chrom_feats: List[DdaChromFeat] = [
+            feat 
+            for chunk_feats in p.starmap(_extract_and_fit_chroms_worker, 
+                                         [(chunk, None if windows is None else windows[b0:b1], 
+                                           params, debug_flag, debug_cb) 
+                                          for chunk, b0, b1 in zip(pre_mz_chunks, bounds[:-1], bounds[1:])])
+            for feat in chunk_feats
+        ]
+        # consolidate chromatographic features
+        chrom_feats_consolidated = _consolidate_chrom_feats(chrom_feats, params, debug_flag, debug_cb)
+        if params.consolidate_chrom_feats.drop_isotopes:
+            chrom_feats_consolidated = _drop_isotope_chrom_feats(chrom_feats_consolidated, params, 
+                                                                 debug_flag, debug_cb)
+        # extract MS2 spectra
+        n_feats: int = len(chrom_feats_consolidated)
+        n_chunks: int = max(n_proc, -(-n_feats // chunk_size))
+        chunks = [_.tolist() for _ in np.array_split(np.arange(n_feats), n_chunks) if len(_) > 0]
+        yield from p.imap(
+            partial(_extract_and_fit_ms2_spectra_worker, dda_file_id, 
+                    params=params, debug_flag=debug_flag, debug_cb=debug_cb), 
+            [[chrom_feats_consolidated[i] for i in chunk] for chunk in chunks]
+        )
+    # NOTE: The readers owned by the workers are opened read-only and go away along with the worker 
+    #       processes when the pool gets cleaned up, so there is no need to close them explicitly.
+
+
+def _iter_dda_feature_tables(dda_data_file: MzaFilePath, 
+                             dda_file_id: MzaFileId, 
+                             params: DdaParams, 
+                             cache_ms1: bool, 
+                             drop_scans: Optional[List[int]], 
+                             n_proc: int, 
+                             debug_flag: Optional[str], debug_cb: Optional[Callable], 
+                             chunk_size: int = 1000
+                             ) -> Generator[_DdaFeatureTable, None, None] :
+    """
+    runs all of the DDA feature extraction steps on a DDA data file (see ``extract_dda_features`` for the
+    parameters), yields the precursors paired with their MS/MS spectra as they are extracted, packed into 
+    tables of at most chunk_size features. The reader gets closed once all of them have been yielded.
+    """
+    # initialize the MSMS reader 
+    # (this also builds the MS1 cache if needed, before any worker processes get started)
+    rdr: DdaReader = _init_dda_reader(dda_data_file, cache_ms1, drop_scans, debug_flag, debug_cb)
+    # if the MS1 cache could not be set up then the workers (if any) should not try again
+    cache_ms1 = isinstance(rdr, _MsmsReaderDdaMmapMs1)
+    # get the list of precursor m/zs
+    pre_mzs: Set[float] = rdr.get_pre_mzs()  # type: ignore
+    # limit to a specified range 
+    pre_mzs = set([_ for _ in pre_mzs if (_ >= params.precursor.precursor_mz.min and _ <= params.precursor.precursor_mz.max)])
+    debug_handler(debug_flag, debug_cb, f"# precursor m/zs: {len(pre_mzs)}")
+    if params.precursor.cluster_ppm is not None and len(pre_mzs) > 0:
+        # extract one chromatogram per cluster of (nearly) identical precursor m/zs
+        n_pre_mzs = len(pre_mzs)
+        pre_mzs = _cluster_pre_mzs(pre_mzs, params.precursor.cluster_ppm)
+        msg = f"# precursor m/z clusters: {len(pre_mzs)} ({n_pre_mzs / len(pre_mzs):.2f}x reduction)"
+        debug_handler(debug_flag, debug_cb, msg)
+    if n_proc > 1:
+        # map the precursor m/zs to the MS1 scans they need once, up front, rather than in every worker
+        windows = _chrom_rt_windows(rdr, np.sort(np.array(list(pre_mzs), dtype=np.float64)), params)
+        # worker processes each have their own reader, do not need this one anymore
+        rdr.close()
+        yield from _extract_dda_features_parallel(dda_data_file, 
+                                                  dda_file_id, 
+                                                  pre_mzs, 
+                                                  windows,
+                                                  params, 
+                                                  n_proc, 
+                                                  cache_ms1, 
+                                                  drop_scans, 
+                                                  debug_flag, debug_cb, 
+                                                  chunk_size=chunk_size)
+        return
+    # extract chromatographic features
+    chrom_feats: List[DdaChromFeat] = _extract_and_fit_chroms(rdr, 
+                                                              pre_mzs, 
+                                                              params,
+                                                              debug_flag, debug_cb)
+    # consolidate chromatographic features
+    chrom_feats_consolidated: List[DdaChromFeat] = _consolidate_chrom_feats(chrom_feats, 
+                                                                            params, 
+                                                                            debug_flag, debug_cb)
+    if params.consolidate_chrom_feats.drop_isotopes:
+        chrom_feats_consolidated = _drop_isotope_chrom_feats(chrom_feats_consolidated, params, 
+                                                             debug_flag, debug_cb)
+    # extract MS2 spectra (lazily, as they get consumed)
+    yield from _iter_feature_tables(_iter_ms2_spectra(rdr, 
+                                                      dda_file_id,
+                                                      chrom_feats_consolidated, 
+                                                      params, 
+                                                      debug_flag, debug_cb, 
+                                                      ms2_index=_Ms2ScanIndex(rdr)),  # type: ignore
+                                    chunk_size=chunk_size)
+    # do not need the reader anymore
+    rdr.close()
 
 
 def extract_dda_features(dda_data_file: Union[MzaFilePath, MzaFileId], 
@@ -285,7 +1236,8 @@ def extract_dda_features(dda_data_file: Union[MzaFilePath, MzaFileId],
                          params: DdaParams, 
                          cache_ms1: bool = True, 
                          debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None, 
-                         drop_scans: Optional[List[int]] = None
+                         drop_scans: Optional[List[int]] = None,
+                         n_proc: int = 1
                          ) -> int :
     """
     Extract features from a raw DDA data file, store them in a database (initialized using ``create_dda_ids_db`` function)
@@ -301,17 +1253,23 @@ def extract_dda_features(dda_data_file: Union[MzaFilePath, MzaFileId],
         DDA data analysis parameters dict
     cache_ms1 : ``bool``, default=True
         Cache MS1 scan data to reduce disk access. This significantly speeds up extracting the 
-        precursor chromatograms, but comes at the cost of very high memory usage. Should work 
-        fine with a single process on most machines with 16 GB RAM (in testing the memory 
-        footprint of this data is like 10-15 GB) but using multiple processes will quickly use 
-        up all of the RAM and start swapping which completely negates the performance gains from 
-        caching. Machines with more RAM can support more processes doing this caching at the same
-        time, and rule of thumb would be 1 process per 16 GB RAM. 
+        precursor chromatograms. The MS1 data is written once into a compact sidecar file next to 
+        the DDA data file (``<dda_data_file>.ms1_cache``, float32 m/z and intensity) which is then
+        memory mapped rather than loaded, so the memory footprint is small and multiple processes 
+        reading the same cache share it through the OS page cache. The first run on a data file 
+        pays the cost of writing the cache file, subsequent runs reuse it. 
     debug_flag : ``str``, optional
         specifies how to dispatch debugging messages, None to do nothing
     debug_cb : ``func``, optional
         callback function that takes the debugging message as an argument, can be None if
         debug_flag is not set to 'textcb' or 'textcb_pid'
+    drop_scans : ``list(int)``, optional
+        list of scans to drop from the file, can be None if there are not any to drop
+    n_proc : ``int``, default=1
+        number of processes to use for extracting features from this data file, set >1 to split 
+        the precursor m/zs into m/z-contiguous chunks that get processed in parallel (each worker 
+        process has its own reader). This is useful for large DDA data files, use 
+        ``extract_dda_features_multiproc`` instead to process multiple files in parallel. 
 
     Returns
     -------
@@ -332,8 +1290,7 @@ def extract_dda_features(dda_data_file: Union[MzaFilePath, MzaFileId],
             dda_file_id: int = dda_data_file
         case str():
             # initialize a connection to results database
-            # increase timeout to avoid errors from database locked by another process
-            con: ResultsDbConnection = sqlite3.connect(results_db, timeout=60)  
+            con: ResultsDbConnection = sqlite3.connect(results_db)
             cur: ResultsDbCursor = con.cursor()
             # add the MZA data file to the database and get a file identifier for it
             dda_file_id: int = add_data_file_to_db(cur, "LC-MS/MS (DDA)", dda_data_file)
@@ -344,49 +1301,25 @@ def extract_dda_features(dda_data_file: Union[MzaFilePath, MzaFileId],
             #       repeated later on to add the extracted features. The reason for doing it this way rather 
             #       than just opening a connection once and leaving it open until we are done with it is that
             #       the process of feature extraction takes a really long time and it seems pretty unnecessary 
-            #       to sit with an open database connection that will not be used for a long time. This is 
-            #       also important because this function might be running on multiple processes at one time
-            #       so might as well keep the database as free as possible when access is not needed. 
+            #       to sit with an open database connection that will not be used for a long time. 
         case _:
             msg = f"extract_dda_features: invalid type for dda_data_file ({type(dda_data_file)})"
             raise ValueError(msg)
-    # initialize the MSMS reader
-    rdr: DdaReader = (
-        MsmsReaderDdaCachedMs1(dda_data_file, drop_scans=drop_scans) 
-        if cache_ms1 
-        else MsmsReaderDda(dda_data_file, drop_scans=drop_scans)
-    )
-    # get the list of precursor m/zs
-    pre_mzs: Set[float] = rdr.get_pre_mzs()  # type: ignore
-    # limit to a specified range 
-    pre_mzs = set([_ for _ in pre_mzs if (_ >= params.precursor.precursor_mz.min and _ <= params.precursor.precursor_mz.max)])
-    debug_handler(debug_flag, debug_cb, f"# precursor m/zs: {len(pre_mzs)}")
-    # extract chromatographic features
-    chrom_feats: List[DdaChromFeat] = _extract_and_fit_chroms(rdr, 
-                                                              pre_mzs, 
-                                                              params,
-                                                              debug_flag, debug_cb)
-    # consolidate chromatographic features
-    chrom_feats_consolidated: List[DdaChromFeat] = _consolidate_chrom_feats(chrom_feats, 
-                                                                            params, 
-                                                                            debug_flag, debug_cb)
-    # extract MS2 spectra
-    precursors, spectra = _extract_and_fit_ms2_spectra(rdr, 
-                                                       dda_file_id,
-                                                       chrom_feats_consolidated, 
-                                                       params, 
-                                                       debug_flag, debug_cb)
-    precursors: List[DdaPrecursor]
-    n_precursors = len(precursors)
-    spectra: List[Optional[Ms2]]
-    # do not need the reader anymore
-    rdr.close()
-    # initialize connection to DDA ids database
-    # increase timeout to avoid errors from database locked by another process
-    con: ResultsDbConnection = sqlite3.connect(results_db, timeout=60)  
+    # extract features and add them to the database as they come in
+    tables = _iter_dda_feature_tables(dda_data_file, dda_file_id, params, cache_ms1, drop_scans, n_proc,  # type: ignore
+                                      debug_flag, debug_cb)
+    con: ResultsDbConnection = sqlite3.connect(results_db)
     cur: ResultsDbCursor = con.cursor()
-    # add precursors and MS/MS spectra to database
-    _add_precursors_and_fragments_to_db(cur, precursors, spectra, debug_flag, debug_cb)
+    # add precursors and MS/MS spectra to database as they are extracted
+    # NOTE: The connection stays open while the MS2 spectra are being extracted, but each table of 
+    #       features is written and committed in its own transaction so the database is only locked 
+    #       while a table is actually being written.
+    n_precursors: int = 0
+    for table in tables:
+        _insert_dda_feature_table(cur, table)
+        con.commit()
+        n_precursors += len(table)
+    debug_handler(debug_flag, debug_cb, f'ADDED {n_precursors} DDA FEATURES TO DATABASE', pid)
     # update the analysis log
     update_analysis_log(
         cur, 
@@ -403,15 +1336,51 @@ def extract_dda_features(dda_data_file: Union[MzaFilePath, MzaFileId],
     return n_precursors
     
 
+# queue for sending DDA features to the results writer process during extract_dda_features_multiproc, 
+# gets set up by _init_dda_file_worker when the worker process starts
+_WORKER_QUEUE: Optional[multiprocessing.Queue] = None
+
+
+def _init_dda_file_worker(queue: multiprocessing.Queue
+                          ) -> None :
+    """ worker process initializer for extract_dda_features_multiproc, sets up the results queue """
+    global _WORKER_QUEUE
+    _WORKER_QUEUE = queue
+
+
+def _extract_dda_features_file_worker(file: Tuple[MzaFilePath, MzaFileId], 
+                                      params: DdaParams, 
+                                      cache_ms1: bool, 
+                                      debug_flag: Optional[str], debug_cb: Optional[Callable], 
+                                      chunk_size: int = 1000
+                                      ) -> Tuple[MzaFilePath, int] :
+    """
+    extracts features from one DDA data file (dda_data_file, dda_file_id) and sends them to the results
+    writer process in feature tables (of at most chunk_size features), returns the DDA data file and the 
+    number of features extracted
+    """
+    assert _WORKER_QUEUE is not None, "DDA file worker was not initialized"
+    dda_data_file, dda_file_id = file
+    debug_handler(debug_flag, debug_cb, f"EXTRACTING DDA FEATURES, file: {dda_data_file}", os.getpid())
+    n_precursors: int = 0
+    for table in _iter_dda_feature_tables(dda_data_file, dda_file_id, params, cache_ms1, None, 1, 
+                                          debug_flag, debug_cb, chunk_size=chunk_size):
+        _WORKER_QUEUE.put(table)
+        n_precursors += len(table)
+    return dda_data_file, n_precursors
+
+
 def extract_dda_features_multiproc(dda_data_files: List[MzaFilePath], 
                                    results_db: ResultsDbPath, 
                                    params: DdaParams, 
                                    n_proc: int,
-                                   cache_ms1: bool = False, 
+                                   cache_ms1: bool = True, 
                                    debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None
                                    ) -> Dict[str, int] :
     """
-    extracts dda features from multiple DDA files in parallel
+    extracts dda features from multiple DDA files in parallel, one file per worker process. Workers do
+    not write to the results database, they send the features to a single writer process which adds
+    them in large transactions.
 
     Parameters
     ----------
@@ -423,10 +1392,10 @@ def extract_dda_features_multiproc(dda_data_files: List[MzaFilePath],
         parameters for the various steps of DDA feature extraction
     n_proc : ``int``
         number of CPU threads to use (number of processes)
-    cache_ms1 : ``bool``, default=False
-        Cache MS1 scan data to reduce disk access. This should be turned off when using 
-        multiprocessing on most machines. See entry in ``extract_dda_features`` 
-        docstring for a more detailed explanation.
+    cache_ms1 : ``bool``, default=True
+        Cache MS1 scan data to reduce disk access. The cache is memory mapped so it is fine to 
+        use with multiprocessing. See entry in ``extract_dda_features`` docstring for a more 
+        detailed explanation.
     debug_flag : ``str``, optional
         specifies how to dispatch debugging messages, None to do nothing
     debug_cb : ``func``, optional
@@ -438,14 +1407,194 @@ def extract_dda_features_multiproc(dda_data_files: List[MzaFilePath],
     dda_features_per_file : ``dict(str:int)``
         dictionary with the number of DDA features mapped to input DDA data files
     """
-    n_proc = min(n_proc, len(dda_data_files))  # no need to use more processes than the number of inputs
-    args = [(dda_data_file, results_db, params) for dda_data_file in dda_data_files]
-    args_for_starmap = zip(repeat(extract_dda_features), args, repeat({'cache_ms1': cache_ms1, 
-                                                                       'debug_flag': debug_flag, 
-                                                                       'debug_cb': debug_cb}))
-    with multiprocessing.Pool(processes=n_proc) as p:
-        feat_counts = p.starmap(apply_args_and_kwargs, args_for_starmap)
-    return {k: v for k, v in zip(dda_data_files, feat_counts)}
+    # ensure the results database exists
+    if not os.path.isfile(results_db):
+        raise FileNotFoundError(errno.ENOENT, 
+                                os.strerror(errno.ENOENT), 
+                                results_db)
+    # add all of the DDA data files to the database up front
+    con: ResultsDbConnection = sqlite3.connect(results_db)
+    cur: ResultsDbCursor = con.cursor()
+    dda_file_ids: List[MzaFileId] = [
+        add_data_file_to_db(cur, "LC-MS/MS (DDA)", dda_data_file) for dda_data_file in dda_data_files
+    ]
+    con.commit()
+    feat_counts: Dict[str, int] = {dda_data_file: 0 for dda_data_file in dda_data_files}
+    n_proc = max(1, min(n_proc, len(dda_data_files)))  # no need to use more processes than the number of inputs
+    # the results writer process is the only process that writes to the results database until the
+    # pool of workers is done 
+    with results_writer_process(results_db, _insert_dda_feature_table) as (queue, writer):
+        with multiprocessing.Pool(processes=n_proc, 
+                                  initializer=_init_dda_file_worker, 
+                                  initargs=(queue,)) as p:
+            file_results = imap_unordered_with_writer(
+                p, 
+                partial(_extract_dda_features_file_worker, params=params, cache_ms1=cache_ms1, 
+                        debug_flag=debug_flag, debug_cb=debug_cb), 
+                list(zip(dda_data_files, dda_file_ids)), 
+                writer
+            )
+            for dda_data_file, n_precursors in file_results:
+                feat_counts[dda_data_file] = n_precursors
+                debug_handler(debug_flag, debug_cb, 
+                              f"{dda_data_file}: ADDED {n_precursors} DDA FEATURES TO DATABASE")
+    # update the analysis log, once for each DDA data file
+    for dda_data_file, dda_file_id in zip(dda_data_files, dda_file_ids):
+        update_analysis_log(
+            cur, 
+            AnalysisStep.DDA_EXT,
+            {
+                "DDA file ID": dda_file_id,
+                "precursors": feat_counts[dda_data_file]
+            }
+        )
+    con.commit()
+    con.close()
+    return feat_counts
+
+
+def _group_dda_features(mzs: npt.NDArray[np.float64], 
+                        rts: npt.NDArray[np.float64], 
+                        mz_ppm: float, 
+                        rt_tol: float, 
+                        linked: Optional[Callable[[int, int], bool]] = None
+                        ) -> npt.NDArray[np.int64] :
+    """
+    group DDA features with similar m/z and RT, features are linked if they are within the m/z and RT 
+    tolerances of each other and the groups are the connected components of those links (union-find)
+
+    Parameters
+    ----------
+    mzs : ``numpy.ndarray(float)``
+    rts : ``numpy.ndarray(float)``
+        feature m/zs and RTs
+    mz_ppm : ``float``
+        m/z tolerance (ppm)
+    rt_tol : ``float``
+        RT tolerance
+    linked : ``func``, optional
+        additional check for whether a pair of features (indices into mzs/rts) within the m/z and RT 
+        tolerances should be linked, only gets called for those pairs
+    
+    Returns
+    -------
+    group_ids : ``numpy.ndarray(int)``
+        group ID for each feature (index of one member of the group), same order as input
+    """
+    parent: List[int] = list(range(len(mzs)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            # path halving
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    # with the features sorted by m/z only the features up to the upper m/z tolerance bound 
+    # of each feature need to be checked for links
+    order = np.argsort(mzs, kind="stable")
+    mzs_srt = mzs[order]
+    rts_srt = rts[order]
+    ubs = np.searchsorted(mzs_srt, mzs_srt + tol_from_ppm(mzs_srt, mz_ppm), side="right")
+    idx: List[int] = order.tolist()
+    for i, ub in enumerate(ubs.tolist()):
+        for j in (i + 1 + np.nonzero(np.abs(rts_srt[i + 1:ub] - rts_srt[i]) <= rt_tol)[0]).tolist():
+            ri, rj = find(idx[i]), find(idx[j])
+            if ri != rj and (linked is None or linked(idx[i], idx[j])):
+                parent[max(ri, rj)] = min(ri, rj)
+    return np.array([find(i) for i in range(len(mzs))], dtype=np.int64)
+
+
+def _consensus_ms2_spectrum(fmzs: npt.NDArray[np.float64], 
+                            fints: npt.NDArray[np.float64], 
+                            mz_tol: float
+                            ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]] :
+    """
+    merge centroided MS2 spectra (fragments from all of the spectra concatenated) into a single 
+    consensus centroided spectrum. Fragments are sorted by m/z and any that are within mz_tol of the 
+    next fragment get merged, intensities are summed (same as accumulating the scans together) and 
+    the m/z is the intensity-weighted mean.
+
+    Parameters
+    ----------
+    fmzs : ``numpy.ndarray(float)``
+    fints : ``numpy.ndarray(float)``
+        fragment m/zs and intensities from all of the spectra
+    mz_tol : ``float``
+        m/z tolerance for merging fragments
+
+    Returns
+    -------
+    mzs : ``numpy.ndarray(float)``
+    iis : ``numpy.ndarray(float)``
+        consensus spectrum, sorted by m/z
+    """
+    if len(fmzs) == 0:
+        return np.array([], dtype=np.float64), np.array([], dtype=np.float64)
+    order = np.argsort(fmzs, kind='stable')
+    fmzs, fints = fmzs[order], fints[order]
+    starts = np.concatenate([[0], np.nonzero(np.diff(fmzs) > mz_tol)[0] + 1])
+    iis = np.add.reduceat(fints, starts)
+    mzs = np.add.reduceat(fmzs * fints, starts) / np.where(iis > 0, iis, 1.)
+    # fall back on the plain mean for any groups without intensity
+    no_i = iis <= 0
+    if np.any(no_i):
+        mzs[no_i] = (np.add.reduceat(fmzs, starts) / np.diff(np.append(starts, len(fmzs))))[no_i]
+    return mzs, iis
+
+
+def _merge_dda_feature_spectra(cur: ResultsDbCursor, 
+                               merge_fids: List[Tuple[int, List[int]]], 
+                               mz_tol: float
+                               ) -> None :
+    """
+    replaces the fragments of each kept feature with the consensus spectrum from all of the features 
+    in its group and updates the MS2 scan and peak counts for the kept feature accordingly. The other 
+    features in the group (and their fragments) still need to be dropped afterwards. 
+
+    Parameters
+    ----------
+    cur : ``sqlite3.Cursor``
+        cursor for making queries into the results database
+    merge_fids : ``list(tuple(int, list(int)))``
+        ID of the feature to keep and IDs of all of the features to merge into it, for each group
+    mz_tol : ``float``
+        m/z tolerance for merging fragments
+    """
+    # pull all of the fragments for the features being merged in one query
+    cur.execute("CREATE TEMP TABLE _MergeDDAPrecursors (dda_pre_id INTEGER PRIMARY KEY, keep_id INT NOT NULL)")
+    cur.executemany("INSERT INTO _MergeDDAPrecursors VALUES (?,?)", 
+                    [(fid, keep_fid) for keep_fid, fids in merge_fids for fid in fids])
+    qry_sel = """--beginsql
+        SELECT keep_id, fmz, fint FROM DDAFragments JOIN _MergeDDAPrecursors USING(dda_pre_id) 
+        ORDER BY keep_id
+    --endsql"""
+    frags = np.array(cur.execute(qry_sel).fetchall(), dtype=np.float64).reshape(-1, 3)
+    qry_n_scans = """--beginsql
+        SELECT keep_id, SUM(ms2_n_scans) FROM DDAPrecursors JOIN _MergeDDAPrecursors USING(dda_pre_id) 
+        GROUP BY keep_id
+    --endsql"""
+    n_scans: Dict[int, int] = dict(cur.execute(qry_n_scans).fetchall())
+    qry_del = """--beginsql
+        DELETE FROM DDAFragments WHERE dda_pre_id IN (SELECT dda_pre_id FROM _MergeDDAPrecursors)
+    --endsql"""
+    cur.execute(qry_del)
+    cur.execute("DROP TABLE _MergeDDAPrecursors")
+    # fragments come back grouped by the ID of the kept feature
+    keep_ids = frags[:, 0].astype(np.int64)
+    i0s = np.searchsorted(keep_ids, [keep_fid for keep_fid, _ in merge_fids], side='left')
+    i1s = np.searchsorted(keep_ids, [keep_fid for keep_fid, _ in merge_fids], side='right')
+    frag_rows: List[Tuple[None, int, float, float]] = []
+    pre_rows: List[Tuple[int, int, int]] = []
+    for (keep_fid, _), i0, i1 in zip(merge_fids, i0s, i1s):
+        mzs, iis = _consensus_ms2_spectrum(frags[i0:i1, 1], frags[i0:i1, 2], mz_tol)
+        frag_rows += zip(repeat(None), repeat(keep_fid), mzs.tolist(), iis.tolist())
+        pre_rows.append((n_scans[keep_fid], len(mzs), keep_fid))
+    cur.executemany("INSERT INTO DDAFragments VALUES (?,?,?,?)", frag_rows)
+    qry_upd = """--beginsql
+        UPDATE DDAPrecursors SET ms2_n_scans=?, ms2_n_peaks=? WHERE dda_pre_id=?
+    --endsql"""
+    cur.executemany(qry_upd, pre_rows)
 
 
 def consolidate_dda_features(results_db: ResultsDbPath, 
@@ -453,14 +1602,17 @@ def consolidate_dda_features(results_db: ResultsDbPath,
                              debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None
                              ) -> Tuple[int, int] :
     """
-    consolidates DDA features from lipid IDs database based on feature m/z and RT using the following criteria:
+    consolidates DDA features from lipid IDs database based on feature m/z and RT using the following criteria
+    (features are grouped if they are linked through other features within the m/z and RT tolerances):
 
     * for groups of features having very similar m/z and RT, if none have MS2 scans then only the feature with 
       the highest intensity in each group is kept
     * if at least one feature in a group has MS2 scans, then features in that group that do not have MS2 scans 
       are dropped
-    * TODO (Dylan Ross) if more than one feature in a group has MS2 scans, then merge those MS2 scans and merge 
-      the features, see comment below for details
+    * if more than one feature in a group has MS2 scans and ``merge_ms2`` is set, then those features are merged 
+      into the one with the highest intensity, with a consensus spectrum made from all of their fragments 
+      (see ``_consensus_ms2_spectrum``, fragments are merged within the MS2 minimum peak distance), 
+      otherwise all of the features with MS2 scans are kept
 
     Parameters
     ----------
@@ -494,29 +1646,26 @@ def consolidate_dda_features(results_db: ResultsDbPath,
     # check that DDA feature extraction has been completed first
     check_analysis_log(cur, AnalysisStep.DDA_EXT)
     # step 1, create groups of features based on similar m/z and RT
+    t_group = time()
     qry_sel = """--beginsql
         SELECT dda_pre_id, mz, rt, rt_pkht, ms2_n_scans FROM DDAPrecursors
     --endsql"""
-    grouped: List[List[Any]] = []
-    n_dda_features: int = 0
-    for d in cur.execute(qry_sel).fetchall():
-        n_dda_features += 1
-        _, mz, rt, *_ = d
-        add = True
-        mzt = tol_from_ppm(mz, P.mz_ppm)
-        for i in range(len(grouped)):
-            for _, mz_i, rt_i, *_ in grouped[i]:
-                if abs(mz - mz_i) <= mzt and abs(rt - rt_i) <= P.rt_tol:
-                    grouped[i].append(d)
-                    add = False
-                    break
-            if not add:
-                break
-        if add:
-            grouped.append([d])
+    feats: List[Tuple[int, float, float, float, int]] = cur.execute(qry_sel).fetchall()
+    n_dda_features: int = len(feats)
+    group_ids = _group_dda_features(np.array([_[1] for _ in feats], dtype=np.float64), 
+                                    np.array([_[2] for _ in feats], dtype=np.float64), 
+                                    P.mz_ppm, P.rt_tol)
+    grouped: Dict[int, List[Tuple[int, float, float, float, int]]] = {}
+    for gid, d in zip(group_ids.tolist(), feats):
+        grouped.setdefault(gid, []).append(d)
+    debug_handler(debug_flag, debug_cb, 
+                  f"CONSOLIDATING DDA FEATURES: grouping: {len(grouped)} groups, elapsed: {time() - t_group:.1f} s")
     # step 2, determine which features to drop
+    t_select = time()
     drop_fids: List[int] = []
-    for group in grouped:
+    # (ID of the feature to keep, IDs of all features with MSMS in the group) for groups to merge
+    merge_fids: List[Tuple[int, List[int]]] = []
+    for group in grouped.values():
         if len(group) > 1:
             # only consider groups with multiple features in them
             if sum([_[4] for _ in group]) > 0:
@@ -525,21 +1674,12 @@ def consolidate_dda_features(results_db: ResultsDbPath,
                     if feat[4] < 1:
                         # drop any features in the group that do not have MSMS
                         drop_fids.append(feat[0])
-                        # TODO (Dylan Ross): There is a potential here for redundant features that have 
-                        #                    MSMS spectra because all such features in a group are kept. 
-                        #                    I do want to change this, but since the main thing that this
-                        #                    function does is drop rows from the database, it will take 
-                        #                    additional logic to properly merge the spectra together and
-                        #                    update the database accordingly. Also, with this change this
-                        #                    first conditional checking for features that contain spectra
-                        #                    would become unnecessary and everything could be handled in 
-                        #                    the else branch below
-                        # TODO (Dylan Ross): P.S. This is not a problem with the current implementation
-                        #                    because all precursors with MS2 spectra are retained, but if 
-                        #                    the above change is made, then there will need to be some logic
-                        #                    for dealing with entries in DDAFragments that no longer point
-                        #                    to an entry in DDAPrecursors after some DDA precursors are 
-                        #                    dropped or merged.
+                ms2_feats = [feat for feat in group if feat[4] > 0]
+                if P.merge_ms2 and len(ms2_feats) > 1:
+                    # merge the features that have MSMS into the one with the highest intensity
+                    keep_fid = max(ms2_feats, key=lambda feat: feat[3])[0]
+                    merge_fids.append((keep_fid, [feat[0] for feat in ms2_feats]))
+                    drop_fids += [feat[0] for feat in ms2_feats if feat[0] != keep_fid]
             else:
                 # none of the features have MSMS
                 # only keep the feature with the highest intensity of the group
@@ -564,13 +1704,43 @@ def consolidate_dda_features(results_db: ResultsDbPath,
                         # drop all of these features if we are not keeping features that lack MS2 scans
                         drop_fids.append(ffid)
     n_post: int = n_dda_features - len(drop_fids)                        
+    msg = (
+        f"CONSOLIDATING DDA FEATURES: selecting: {len(drop_fids)} to drop, "
+        f"{len(merge_fids)} groups to merge, elapsed: {time() - t_select:.1f} s"
+    )
+    debug_handler(debug_flag, debug_cb, msg)
+    # step 2.5, merge MS2 spectra for groups of features that all have MSMS
+    if len(merge_fids) > 0:
+        t_merge = time()
+        _merge_dda_feature_spectra(cur, merge_fids, params.extract_and_fit_ms2_spectra.peak_min_dist)
+        debug_handler(debug_flag, debug_cb, f"CONSOLIDATING DDA FEATURES: merging: elapsed: {time() - t_merge:.1f} s")
     debug_handler(debug_flag, debug_cb, f"CONSOLIDATING DDA FEATURES: {n_dda_features} features -> {n_post} features")
     # step 3, drop features from database
+    # stage the IDs in a temporary table then drop them all with a single statement
+    t_drop = time()
+    cur.execute("CREATE TEMP TABLE _DropDDAPrecursors (dda_pre_id INTEGER PRIMARY KEY)")
+    cur.executemany("INSERT INTO _DropDDAPrecursors VALUES (?)", [(fid,) for fid in drop_fids])
     qry_drop = """--beginsql
-        DELETE FROM DDAPrecursors WHERE dda_pre_id=?
+        DELETE FROM DDAPrecursors WHERE dda_pre_id IN (SELECT dda_pre_id FROM _DropDDAPrecursors)
     --endsql"""
-    for fid in drop_fids:
-        cur.execute(qry_drop, (fid,))
+    cur.execute(qry_drop)
+    # also drop any fragments that belonged to the dropped features (from merged groups)
+    qry_drop_frag = """--beginsql
+        DELETE FROM DDAFragments WHERE dda_pre_id IN (SELECT dda_pre_id FROM _DropDDAPrecursors)
+    --endsql"""
+    cur.execute(qry_drop_frag)
+    # and any cluster mappings (from cluster_dda_features) that the dropped features were part of, 
+    # as members or as representatives, members of a cluster that lost its representative are back 
+    # to being their own representatives
+    if results_db_has_table(cur, "DDAPrecursorClusters"):
+        qry_drop_clust = """--beginsql
+            DELETE FROM DDAPrecursorClusters 
+            WHERE dda_pre_id IN (SELECT dda_pre_id FROM _DropDDAPrecursors) 
+                OR cluster_id IN (SELECT dda_pre_id FROM _DropDDAPrecursors)
+        --endsql"""
+        cur.execute(qry_drop_clust)
+    cur.execute("DROP TABLE _DropDDAPrecursors")
+    debug_handler(debug_flag, debug_cb, f"CONSOLIDATING DDA FEATURES: dropping: elapsed: {time() - t_drop:.1f} s")
     # update the analysis log
     update_analysis_log(
         cur, 
@@ -587,6 +1757,145 @@ def consolidate_dda_features(results_db: ResultsDbPath,
     return n_dda_features, n_post
 
     
+def _sparse_ms2_vectors(pre_ids: npt.NDArray[np.int64], 
+                        fmzs: npt.NDArray[np.float64], 
+                        fints: npt.NDArray[np.float64], 
+                        mz_bin_size: float
+                        ) -> Dict[int, Tuple[npt.NDArray[np.int64], npt.NDArray[np.float64]]] :
+    """
+    bin MS2 spectra (fragments from DDAFragments) into sparse vectors normalized to unit length, 
+    returns a dict of DDA precursor ID -> (occupied m/z bins (sorted), normalized intensities)
+    """
+    if len(pre_ids) == 0:
+        return {}
+    bins = np.rint(fmzs / mz_bin_size).astype(np.int64)
+    # sum intensities for the same (precursor, m/z bin)
+    keys, inv = np.unique(np.column_stack([pre_ids, bins]), axis=0, return_inverse=True)
+    iis = np.zeros(len(keys))
+    np.add.at(iis, inv.ravel(), fints)
+    # keys are sorted by precursor ID then m/z bin
+    vectors = {}
+    starts = np.concatenate([[0], np.nonzero(np.diff(keys[:, 0]))[0] + 1, [len(keys)]])
+    for i0, i1 in zip(starts[:-1].tolist(), starts[1:].tolist()):
+        norm = np.sqrt(np.sum(iis[i0:i1]**2))
+        if norm > 0:
+            vectors[int(keys[i0, 0])] = (keys[i0:i1, 1], iis[i0:i1] / norm)
+    return vectors
+
+
+def _cosine_similarity(a: Tuple[npt.NDArray[np.int64], npt.NDArray[np.float64]], 
+                       b: Tuple[npt.NDArray[np.int64], npt.NDArray[np.float64]]
+                       ) -> float :
+    """ cosine similarity between two sparse vectors from ``_sparse_ms2_vectors`` """
+    _, ia, ib = np.intersect1d(a[0], b[0], assume_unique=True, return_indices=True)
+    return float(np.dot(a[1][ia], b[1][ib]))
+
+
+def cluster_dda_features(results_db: ResultsDbPath, 
+                         params: DdaParams, 
+                         debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None
+                         ) -> Tuple[int, int] :
+    """
+    clusters DDA features across all of the data files in the results database: features are linked if 
+    they are within the m/z and RT tolerances of each other and their MS2 spectra have a cosine similarity 
+    of at least ``cluster_min_cosine``, and the clusters are the connected components of those links. 
+    Spectra are compared as sparse vectors binned at the MS2 minimum peak distance, and only for pairs of 
+    features that pass the m/z and RT check so not every pair of features gets compared. 
+
+    The most intense feature in each cluster is its representative and the mapping from features to 
+    representatives is stored in the DDAPrecursorClusters table (replacing anything already in there), 
+    DIA feature extraction uses one target per cluster. Features without MS2 peaks are each their own 
+    cluster. 
+
+    Parameters
+    ----------
+    results_db : ``str``
+        path to DDA-DIA analysis results database
+    params : ``DdaParams``
+        DDA data analysis parameters 
+    debug_flag : ``str``, optional
+        specifies how to dispatch debugging messages, None to do nothing
+    debug_cb : ``func``, optional
+        callback function that takes the debugging message as an argument, can be None if
+        debug_flag is not set to 'textcb' or 'textcb_pid'
+    
+    Returns
+    -------
+    n_features : ``int``
+    n_clusters : ``int``
+        return the number of features and the number of clusters 
+    """
+    # unpack parameters
+    P = params.consolidate_dda_feats
+    assert P.cluster_min_cosine is not None, "cluster_min_cosine must be set to cluster DDA features"
+    # ensure the results database exists
+    if not os.path.isfile(results_db):    
+        raise FileNotFoundError(errno.ENOENT, 
+                                os.strerror(errno.ENOENT), 
+                                results_db)
+    con: ResultsDbConnection = sqlite3.connect(results_db)
+    cur: ResultsDbCursor = con.cursor()
+    # check that DDA feature consolidation has been completed first
+    check_analysis_log(cur, AnalysisStep.DDA_CONS)
+    t0 = time()
+    qry_sel_pre = """--beginsql
+        SELECT dda_pre_id, mz, rt, rt_pkht FROM DDAPrecursors WHERE ms2_n_peaks > 0
+    --endsql"""
+    feats = cur.execute(qry_sel_pre).fetchall()
+    qry_sel_frag = """--beginsql
+        SELECT dda_pre_id, fmz, fint FROM DDAFragments JOIN DDAPrecursors USING(dda_pre_id) 
+        WHERE ms2_n_peaks > 0
+    --endsql"""
+    frags = np.array(cur.execute(qry_sel_frag).fetchall(), dtype=np.float64).reshape(-1, 3)
+    vectors = _sparse_ms2_vectors(frags[:, 0].astype(np.int64), frags[:, 1], frags[:, 2], 
+                                  params.extract_and_fit_ms2_spectra.peak_min_dist)
+    pre_ids = [feat[0] for feat in feats]
+    n_compared = 0
+
+    def linked(i: int, j: int) -> bool:
+        nonlocal n_compared
+        a, b = vectors.get(pre_ids[i]), vectors.get(pre_ids[j])
+        if a is None or b is None:
+            return False
+        n_compared += 1
+        return _cosine_similarity(a, b) >= P.cluster_min_cosine  # type: ignore
+    
+    group_ids = _group_dda_features(np.array([feat[1] for feat in feats], dtype=np.float64), 
+                                    np.array([feat[2] for feat in feats], dtype=np.float64), 
+                                    P.mz_ppm, P.cluster_rt_tol, linked=linked)
+    # the representative for each cluster is the feature with the highest intensity
+    reps: Dict[int, Tuple[float, int]] = {}
+    for gid, (fid, _, _, fht) in zip(group_ids.tolist(), feats):
+        if gid not in reps or fht > reps[gid][0]:
+            reps[gid] = (fht, fid)
+    mapping = [(fid, reps[gid][1]) for gid, (fid, *_) in zip(group_ids.tolist(), feats)]
+    # features without MS2 peaks are their own clusters
+    qry_sel_no_ms2 = """--beginsql
+        SELECT dda_pre_id, dda_pre_id FROM DDAPrecursors WHERE ms2_n_peaks IS NULL OR ms2_n_peaks < 1
+    --endsql"""
+    mapping += cur.execute(qry_sel_no_ms2).fetchall()
+    n_features, n_clusters = len(mapping), len(set(_[1] for _ in mapping))
+    cur.execute("DELETE FROM DDAPrecursorClusters")
+    cur.executemany("INSERT INTO DDAPrecursorClusters VALUES (?,?)", mapping)
+    msg = (
+        f"CLUSTERING DDA FEATURES: {n_features} features -> {n_clusters} clusters "
+        f"({n_compared} spectra compared), elapsed: {time() - t0:.1f} s"
+    )
+    debug_handler(debug_flag, debug_cb, msg)
+    # update the analysis log
+    update_analysis_log(
+        cur, 
+        AnalysisStep.DDA_CLUST,
+        {
+            "DDA precursors": n_features,
+            "DDA precursor clusters": n_clusters
+        }
+    )
+    con.commit()
+    con.close()
+    return n_features, n_clusters
+
+    
 # TODO (Dylan Ross): Add a function that goes through the DDA precursors and drops the ones in the 
 #                    top/bottom X% in terms of the peak FWHMs. The precursor features that have very
 #                    large or very small FWHMs are probably not good features and getting rid of them
@@ -6,22 +6,26 @@ Dylan Ross (dylan.ross@pnnl.gov)
 """
 
 
-from typing import List, Tuple, Union, Optional, Callable, Dict
+from typing import List, Tuple, Union, Optional, Callable, Dict, Any
 import sqlite3
 import os
 import errno
-from itertools import repeat
+from functools import partial
+from collections import OrderedDict
 import multiprocessing
+import multiprocessing.util
 
 import numpy as np
 import numpy.typing as npt
 from scipy import spatial
 from mzapy import MZA
-from mzapy.peaks import find_peaks_1d_gauss, find_peaks_1d_localmax, calc_gauss_psnr
+from mzapy.peaks import find_peaks_1d_localmax
 
-from lipidimea.msms._util import apply_args_and_kwargs, tol_from_ppm
+from lipidimea.msms._util import tol_from_ppm, results_writer_process, imap_unordered_with_writer
+from lipidimea.msms._peaks import fit_traces
 from lipidimea.util import (
-    debug_handler, add_data_file_to_db, AnalysisStep, update_analysis_log, check_analysis_log
+    debug_handler, add_data_file_to_db, AnalysisStep, update_analysis_log, check_analysis_log, 
+    results_db_has_table
 )
 from lipidimea.params import (
     DiaParams
@@ -114,22 +118,223 @@ def _decon_distance(pre_data: Union[Xic, Atd],
     return dist_funcs[dist_func](y_pre, y_frg)
 
 
-def _deconvolute_ms2_peaks(rdr: MZA, 
+def _sum_by(xs: npt.NDArray[np.float64], 
+            iis: npt.NDArray[np.float64]
+            ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]] :
+    """ sum up intensities by unique x values (sorted), like ``df.groupby(x).intensity.sum()`` """
+    ux, inv = np.unique(xs, return_inverse=True)
+    return ux, np.bincount(inv, weights=iis, minlength=len(ux))
+
+
+def _bin_ms2_traces(mzs: npt.NDArray[np.float64], 
+                    xs: npt.NDArray[np.float64], 
+                    iis: npt.NDArray[np.float64], 
+                    mz_bounds: List[Tuple[float, float]]
+                    ) -> List[Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]] :
+    """
+    build traces (XICs or ATDs) for multiple m/z windows from one set of extracted data points, 
+    the points are sorted by m/z once then the points for each window (inclusive bounds) are 
+    summed up by x (RT or DT), the same as extracting each trace separately
+
+    Parameters
+    ----------
+    mzs : ``numpy.ndarray(float)``
+    xs : ``numpy.ndarray(float)``
+    iis : ``numpy.ndarray(float)``
+        m/z, x (RT or DT), and intensity of the data points
+    mz_bounds : ``list(tuple(float, float))``
+        (lower, upper) m/z bounds for each trace
+
+    Returns
+    -------
+    traces : ``list(tuple(numpy.ndarray(float), numpy.ndarray(float)))``
+        (x, intensity) for each m/z window, with sorted unique x values
+    """
+    order = np.argsort(mzs, kind="stable")
+    mzs, xs, iis = mzs[order], xs[order], iis[order]
+    traces = []
+    for mz_min, mz_max in mz_bounds:
+        i0 = np.searchsorted(mzs, mz_min, side="left")
+        i1 = np.searchsorted(mzs, mz_max, side="right")
+        traces.append(_sum_by(xs[i0:i1], iis[i0:i1]))
+    return traces
+
+
+def _df_points(df: Any, 
+               x: str
+               ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64], npt.NDArray[np.float64]] :
+    """ 
+    m/z, x (rt or dt), and intensity arrays from a data frame returned by the MZA collect_*_df_* methods 
+    (or a dict of arrays with the same columns from ``_DiaTargetSlab``)
+    """
+    return (
+        np.asarray(df["mz"], dtype=np.float64), 
+        np.asarray(df[x], dtype=np.float64), 
+        np.asarray(df["intensity"], dtype=np.float64)
+    )
+
+
+class _DiaTargetSlab:
+    """
+    All of the DIA data points needed for analyzing a single target after its XIC has been extracted, 
+    pulled out of the data file all at once: MS1 points (with DT) around the precursor m/z, and MS2 
+    points (frame-summed and with DT) in the m/z range of the DDA fragments, all within an RT window 
+    covering the precursor XIC peaks. 
+    
+    Implements the subset of the ``mzapy.MZA`` methods used in ``_single_target_analysis`` and 
+    ``_deconvolute_ms2_peaks`` (after the precursor XIC), with the ATDs, spectra, and fragment data
+    derived from the points in memory, so it can be used in place of the reader. Requests outside of 
+    the slab bounds only get the points that are within them.
+    """
+
+    def __init__(self, 
+                 ms1: Dict[str, npt.NDArray[np.float64]], 
+                 ms2_frames: Dict[str, npt.NDArray[np.float64]], 
+                 ms2: Dict[str, npt.NDArray[np.float64]], 
+                 min_dt: float, 
+                 max_dt: float
+                 ) -> None :
+        """
+        Parameters
+        ----------
+        ms1 : ``dict(str:numpy.ndarray(float))``
+            MS1 points, arrays: "rt", "dt", "mz", "intensity" 
+        ms2_frames : ``dict(str:numpy.ndarray(float))``
+            MS2 points from frame-summed scans (no DT), arrays: "rt", "mz", "intensity" 
+        ms2 : ``dict(str:numpy.ndarray(float))``
+            MS2 points, arrays: "rt", "dt", "mz", "intensity" 
+        min_dt : ``float``
+        max_dt : ``float``
+            DT range of the data file
+        """
+        self.ms1 = ms1
+        self.ms2_frames = ms2_frames
+        self.ms2 = ms2
+        self.min_dt = min_dt
+        self.max_dt = max_dt
+
+    @classmethod
+    def from_reader(cls, 
+                    rdr: MZA, 
+                    rt_bounds: Tuple[float, float], 
+                    ms1_mz_bounds: Tuple[float, float], 
+                    ms2_mz_bounds: Optional[Tuple[float, float]]
+                    ) -> "_DiaTargetSlab" :
+        """
+        extract the slab from a DIA data file, MS1 points in ms1_mz_bounds and MS2 points in ms2_mz_bounds 
+        (None to skip MS2) within rt_bounds and the full DT range, this is 3 reads (or 1 without MS2)
+        """
+        cols = ["rt", "dt", "mz", "intensity"]
+        df = rdr.collect_ms1_df_by_rt_dt(*rt_bounds, rdr.min_dt, rdr.max_dt, mz_bounds=ms1_mz_bounds)
+        ms1 = {c: np.asarray(df[c], dtype=np.float64) for c in cols}
+        if ms2_mz_bounds is not None:
+            df = rdr.collect_ms2_df_by_rt(*rt_bounds, mz_bounds=ms2_mz_bounds)
+            ms2_frames = {c: np.asarray(df[c], dtype=np.float64) for c in ["rt", "mz", "intensity"]}
+            df = rdr.collect_ms2_df_by_rt_dt(*rt_bounds, rdr.min_dt, rdr.max_dt, mz_bounds=ms2_mz_bounds)
+            ms2 = {c: np.asarray(df[c], dtype=np.float64) for c in cols}
+        else:
+            ms2_frames = {c: np.array([], dtype=np.float64) for c in ["rt", "mz", "intensity"]}
+            ms2 = {c: np.array([], dtype=np.float64) for c in cols}
+        return cls(ms1, ms2_frames, ms2, rdr.min_dt, rdr.max_dt)
+
+    @staticmethod
+    def _select(points: Dict[str, npt.NDArray[np.float64]], 
+                **bounds: Optional[Tuple[float, float]]
+                ) -> Dict[str, npt.NDArray[np.float64]] :
+        """ select points within (inclusive) bounds on any of the columns, None bounds are ignored """
+        mask = np.ones(len(points["mz"]), dtype=bool)
+        for c, b in bounds.items():
+            if b is not None:
+                mask &= (points[c] >= b[0]) & (points[c] <= b[1])
+        return {c: a[mask] for c, a in points.items()}
+
+    def collect_atd_arrays_by_rt_mz(self, mz_min, mz_max, rt_min, rt_max, dt_bounds=None, mslvl=1):
+        """ ATD (dt, intensity) for m/z range within an RT window """
+        sel = self._select(self.ms1 if mslvl == 1 else self.ms2, 
+                           mz=(mz_min, mz_max), rt=(rt_min, rt_max), dt=dt_bounds)
+        return _sum_by(sel["dt"], sel["intensity"])
+
+    def collect_ms1_arrays_by_rt_dt(self, rt_min, rt_max, dt_min, dt_max, mz_bounds=None):
+        """ MS1 spectrum (m/z, intensity) for RT and DT ranges """
+        sel = self._select(self.ms1, rt=(rt_min, rt_max), dt=(dt_min, dt_max), mz=mz_bounds)
+        return _sum_by(sel["mz"], sel["intensity"])
+
+    def collect_ms2_arrays_by_rt_dt(self, rt_min, rt_max, dt_min, dt_max, mz_bounds=None):
+        """ MS2 spectrum (m/z, intensity) for RT and DT ranges """
+        sel = self._select(self.ms2, rt=(rt_min, rt_max), dt=(dt_min, dt_max), mz=mz_bounds)
+        return _sum_by(sel["mz"], sel["intensity"])
+
+    def collect_ms2_df_by_rt(self, rt_min, rt_max, mz_bounds=None):
+        """ MS2 points from frame-summed scans for an RT range, as a dict of arrays """
+        return self._select(self.ms2_frames, rt=(rt_min, rt_max), mz=mz_bounds)
+
+    def collect_ms2_df_by_rt_dt(self, rt_min, rt_max, dt_min, dt_max, mz_bounds=None):
+        """ MS2 points for RT and DT ranges, as a dict of arrays """
+        return self._select(self.ms2, rt=(rt_min, rt_max), dt=(dt_min, dt_max), mz=mz_bounds)
+
+
+class _Ms2PointsCache:
+    """
+    Per-target memo of the MS2 data points extracted for fragment XICs (``collect_ms2_df_by_rt``) and 
+    ATDs (``collect_ms2_df_by_rt_dt`` over the full DT range), keyed by the kind of extraction and the 
+    RT window. Every ATD peak under the same XIC peak deconvolutes fragments over the same RT window,
+    so after the first one the fragment XICs and ATDs come from memory. Each entry covers an m/z range,
+    a request for m/z windows outside of that range extends it with a new extraction over the union of 
+    the two ranges (counted as a miss).
+    """
+
+    def __init__(self) -> None :
+        self._entries: Dict[Tuple[str, float, float], Tuple[float, float, Tuple[npt.NDArray[np.float64], ...]]] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def get(self, 
+            rdr: Union[MZA, _DiaTargetSlab], 
+            x: str, 
+            rt_bounds: Tuple[float, float], 
+            mz_min: float, 
+            mz_max: float
+            ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64], npt.NDArray[np.float64]] :
+        """
+        get the MS2 data points (m/z, x, intensity) in an RT window covering (at least) an m/z range, 
+        x is "rt" for fragment XICs or "dt" for fragment ATDs
+        """
+        key = (x, *rt_bounds)
+        if key in self._entries:
+            cached_min, cached_max, points = self._entries[key]
+            if cached_min <= mz_min and mz_max <= cached_max:
+                self.hits += 1
+                return points  # type: ignore
+            mz_min, mz_max = min(mz_min, cached_min), max(mz_max, cached_max)
+        self.misses += 1
+        if x == "rt":
+            df = rdr.collect_ms2_df_by_rt(*rt_bounds, mz_bounds=(mz_min, mz_max))
+        else:
+            df = rdr.collect_ms2_df_by_rt_dt(*rt_bounds, rdr.min_dt, rdr.max_dt, mz_bounds=(mz_min, mz_max))
+        points = _df_points(df, x)
+        self._entries[key] = (mz_min, mz_max, points)
+        return points
+
+
+def _deconvolute_ms2_peaks(rdr: Union[MZA, _DiaTargetSlab], 
                            sel_ms2_mzs: List[float],
                            pre_xic: Xic, 
                            pre_xic_rt: float, 
                            pre_xic_wt: float, 
                            pre_atd: Atd, 
-                           params: DiaParams
+                           params: DiaParams, 
+                           cache: Optional[_Ms2PointsCache] = None
                            ) -> Tuple[List[Tuple[bool, Optional[float], Optional[float]]],
                                       List[Tuple[Optional[Xic], Optional[Atd]]]] :
     """
     Deconvolute MS2 peak m/zs, if the XIC and ATD are similar enough to the precursor, 
-    they are returned as deconvoluted peak m/zs
+    they are returned as deconvoluted peak m/zs. The MS2 data in the precursor RT window
+    is read once for all of the fragment XICs, then once more for the ATDs of the fragments 
+    that have XICs similar enough to the precursor (if any).
     
     Parameters
     ----------
-    rdr : ``mzapy.MZA``
+    rdr : ``mzapy.MZA`` or ``_DiaTargetSlab``
         interface to raw data
     sel_ms2_mzs : ``list(float)``
         list of selected MS2 peak m/zs
@@ -143,6 +348,9 @@ def _deconvolute_ms2_peaks(rdr: MZA,
         precursor ATD
     params : ``DeconvoluteMS2PeaksParams``
         parameters for deconvoluting MS2 peaks
+    cache : ``_Ms2PointsCache``, optional
+        memo of extracted MS2 data for reusing between calls with the same precursor RT window, 
+        a new one gets used for just this call if not provided
 
     Returns
     -------
@@ -153,33 +361,40 @@ def _deconvolute_ms2_peaks(rdr: MZA,
     """
     # unpack parameters
     P = params.deconvolute_ms2_peaks
+    if len(sel_ms2_mzs) == 0:
+        return [], []
+    cache = cache if cache is not None else _Ms2PointsCache()
+    mz_bounds = [
+        (ms2_mz - (mz_tol := tol_from_ppm(ms2_mz, P.mz_ppm)), ms2_mz + mz_tol) 
+        for ms2_mz in sel_ms2_mzs
+    ]
+    rt_bounds = (pre_xic_rt - pre_xic_wt, pre_xic_rt + pre_xic_wt)
+    # extract fragment XICs, all at once
+    xic_points = cache.get(rdr, "rt", rt_bounds, min(_[0] for _ in mz_bounds), max(_[1] for _ in mz_bounds))
+    ms2_xics = _bin_ms2_traces(*xic_points, mz_bounds)
+    # compute XIC distances
+    xic_dists = [_decon_distance(pre_xic, ms2_xic, P.xic_dist_metric, 0.05) for ms2_xic in ms2_xics]
+    # extract fragment ATDs, all at once, only for the fragments with XICs that pass
+    xic_pass = [j for j, xic_dist in enumerate(xic_dists) if xic_dist <= P.xic_dist_threshold]
+    ms2_atds: List[Optional[Atd]] = [None for _ in sel_ms2_mzs]
+    atd_dists: List[Optional[float]] = [None for _ in sel_ms2_mzs]
+    if xic_pass:
+        atd_mz_bounds = [mz_bounds[j] for j in xic_pass]
+        atd_points = cache.get(rdr, "dt", rt_bounds, 
+                               min(_[0] for _ in atd_mz_bounds), max(_[1] for _ in atd_mz_bounds))
+        for j, ms2_atd in zip(xic_pass, _bin_ms2_traces(*atd_points, atd_mz_bounds)):
+            ms2_atds[j] = ms2_atd
+            # compute ATD distance
+            atd_dists[j] = _decon_distance(pre_atd, ms2_atd, P.atd_dist_metric, 0.25)
     deconvoluted = []
     raws = []
-    for ms2_mz in sel_ms2_mzs:
-        flag = False
-        xic_dist = None
-        ms2_xic = None
-        atd_dist = None
-        ms2_atd = None
-        mz_tol = tol_from_ppm(ms2_mz, params.deconvolute_ms2_peaks.mz_ppm)
-        mz_bounds = (ms2_mz - mz_tol, ms2_mz + mz_tol)
-        rt_bounds = (pre_xic_rt - pre_xic_wt, pre_xic_rt + pre_xic_wt)
-        # extract fragment XIC 
-        ms2_xic = rdr.collect_xic_arrays_by_mz(*mz_bounds, rt_bounds=rt_bounds, mslvl=2)
-        # compute XIC distance
-        xic_dist = _decon_distance(pre_xic, ms2_xic, P.xic_dist_metric, 0.05)
-        if xic_dist <= P.xic_dist_threshold:
-            # extract fragment ATD 
-            ms2_atd = rdr.collect_atd_arrays_by_rt_mz(*mz_bounds, *rt_bounds, mslvl=2)
-            # compute ATD distance
-            atd_dist = _decon_distance(pre_atd, ms2_atd, P.atd_dist_metric, 0.25)
-            if atd_dist <= P.atd_dist_threshold:
-                # accept fragment
-                flag = True
+    for ms2_xic, xic_dist, ms2_atd, atd_dist in zip(ms2_xics, xic_dists, ms2_atds, atd_dists):
+        # accept fragment if both XIC and ATD are similar enough
+        flag = atd_dist is not None and atd_dist <= P.atd_dist_threshold
         deconvoluted.append((flag, xic_dist, atd_dist))
         raws.append((ms2_xic, ms2_atd))
     return deconvoluted, raws
-    
+
 
 def _add_single_target_results_to_db(cur: ResultsDbCursor, 
                                      dda_pre_id: Optional[int], 
@@ -224,6 +439,13 @@ def _add_single_target_results_to_db(cur: ResultsDbCursor,
     dia_frag_qry = """--beginsql
         INSERT INTO DIAFragments VALUES (?,?,?,?,?,?,?)
     --endsql"""
+    if not store_blobs:
+        # no raw data to associate with the fragments so they do not need their IDs, add them all at once
+        cur.executemany(dia_frag_qry, [
+            (None, dia_pre_id, fmz, fint, int(decon_flag), xic_dist, atd_dist)
+            for fmz, fint, (decon_flag, xic_dist, atd_dist) in zip(sel_ms2_mzs, sel_ms2_ints, deconvoluted)
+        ])
+        return
     for fmz, fint, (decon_flag, xic_dist, atd_dist), (fxic, fatd) in zip(
         sel_ms2_mzs, sel_ms2_ints, deconvoluted, frag_raws
     ):
@@ -238,41 +460,143 @@ def _add_single_target_results_to_db(cur: ResultsDbCursor,
             atd_dist            # atd distance metric (rel. to precursor), can be None
         )
         cur.execute(dia_frag_qry, frag_qdata)
-        # optionally add some raw data
-        if store_blobs:
-            # grab the fragment identifier
-            dia_frag_id = cur.lastrowid
-            assert dia_frag_id is not None, "last row ID should not be none"
-            for farr, raw_type in [(fxic, "DIA_FRAG_XIC"), (fatd, "DIA_FRAG_ATD")]:
-                if farr is not None:
-                    fblob: bytes = np.array(farr).tobytes()
-                    fn: int = len(farr[0])
-                    raw_qdata = (
-                        None,           # raw_id will be automatically generated
-                        raw_type,       # type of raw data being stored (like MS1, XIC, etc.)   
-                        "dia_frag_id",  # type of feature identifier to associate with this raw data
-                        dia_frag_id,    # feature identifier (DIA fragment)
-                        fn,             # number of points in the 2 arrays, makes unpacking easier later on
-                        fblob,          # binary data for the arrays (BLOB)
-                    )
-                    cur.execute(_RAW_INSERT_QRY, raw_qdata)
-    # if specified, add raw data to the database
-    if store_blobs:
-        # unpack and convert precursor raw data to blobs
-        for pre_arr, raw_type in zip(pre_raws, ["DIA_PRE_MS1", "DIA_PRE_XIC", "DIA_PRE_ATD"]):
-            pre_blob: bytes = np.array(pre_arr).tobytes()
-            pre_n: int = len(pre_arr[0])
-            raw_qdata = (
-                None,           # raw_id will be automatically generated
-                raw_type,       # type of raw data being stored (like MS1, XIC, etc.)   
-                "dia_pre_id",   # type of feature identifier to associate with this raw data
-                dia_pre_id,     # feature identifier (DIA precursor)
-                pre_n,          # number of points in the 2 arrays, makes unpacking easier later on
-                pre_blob,       # binary data for the arrays (BLOB)
-            )
-            cur.execute(_RAW_INSERT_QRY, raw_qdata)
+        # add some raw data, grab the fragment identifier
+        dia_frag_id = cur.lastrowid
+        assert dia_frag_id is not None, "last row ID should not be none"
+        for farr, raw_type in [(fxic, "DIA_FRAG_XIC"), (fatd, "DIA_FRAG_ATD")]:
+            if farr is not None:
+                fblob: bytes = np.array(farr).tobytes()
+                fn: int = len(farr[0])
+                raw_qdata = (
+                    None,           # raw_id will be automatically generated
+                    raw_type,       # type of raw data being stored (like MS1, XIC, etc.)   
+                    "dia_frag_id",  # type of feature identifier to associate with this raw data
+                    dia_frag_id,    # feature identifier (DIA fragment)
+                    fn,             # number of points in the 2 arrays, makes unpacking easier later on
+                    fblob,          # binary data for the arrays (BLOB)
+                )
+                cur.execute(_RAW_INSERT_QRY, raw_qdata)
+    # add raw data to the database, unpack and convert precursor raw data to blobs
+    for pre_arr, raw_type in zip(pre_raws, ["DIA_PRE_MS1", "DIA_PRE_XIC", "DIA_PRE_ATD"]):
+        pre_blob: bytes = np.array(pre_arr).tobytes()
+        pre_n: int = len(pre_arr[0])
+        raw_qdata = (
+            None,           # raw_id will be automatically generated
+            raw_type,       # type of raw data being stored (like MS1, XIC, etc.)   
+            "dia_pre_id",   # type of feature identifier to associate with this raw data
+            dia_pre_id,     # feature identifier (DIA precursor)
+            pre_n,          # number of points in the 2 arrays, makes unpacking easier later on
+            pre_blob,       # binary data for the arrays (BLOB)
+        )
+        cur.execute(_RAW_INSERT_QRY, raw_qdata)
    
 
+def _match_ms2_peaks(dda_fmzs: npt.NDArray[np.float64], 
+                     dia_mzs: npt.NDArray[np.float64], 
+                     mz_ppm: float
+                     ) -> npt.NDArray[np.int64] :
+    """
+    match DIA MS2 peaks with DDA fragments, a DIA peak is matched if it is within the m/z tolerance 
+    (from ppm, relative to the DDA fragment m/z) of any of the DDA fragments
+
+    Parameters
+    ----------
+    dda_fmzs : ``numpy.ndarray(float)``
+        DDA fragment m/zs
+    dia_mzs : ``numpy.ndarray(float)``
+        DIA MS2 peak m/zs
+    mz_ppm : ``float``
+        m/z tolerance in ppm
+
+    Returns
+    -------
+    matched : ``numpy.ndarray(int)``
+        sorted indices of the matched DIA MS2 peaks, each one only included once even if it matched
+        multiple DDA fragments
+    """
+    dia_mzs = np.asarray(dia_mzs, dtype=np.float64)
+    if len(dda_fmzs) == 0 or len(dia_mzs) == 0:
+        return np.array([], dtype=np.int64)
+    order = np.argsort(dia_mzs, kind="stable")
+    sorted_mzs = dia_mzs[order]
+    # window of (sorted) DIA peaks that fall within the tolerance of each DDA fragment
+    tols = tol_from_ppm(dda_fmzs, mz_ppm)  # type: ignore
+    lo = np.searchsorted(sorted_mzs, dda_fmzs - tols, side="left")
+    hi = np.searchsorted(sorted_mzs, dda_fmzs + tols, side="right")
+    # DIA peaks covered by at least one window
+    cover = np.zeros(len(sorted_mzs) + 1, dtype=np.int64)
+    np.add.at(cover, lo, 1)
+    np.add.at(cover, hi, -1)
+    return np.sort(order[np.cumsum(cover[:-1]) > 0])
+
+
+class _DdaFragmentIndex:
+    """
+    In-memory index of the DDA fragments (from the DDAFragments table of the results database) for 
+    looking up the fragment m/zs for DIA targets without querying the database for each one. The 
+    fragment m/zs are stored in one flat array sorted by DDA precursor ID then m/z, along with the 
+    sorted unique DDA precursor IDs and offsets, so the fragments for DDA precursor ``pre_ids[i]`` 
+    are ``fmzs[offsets[i]:offsets[i + 1]]``.
+    """
+
+    def __init__(self, 
+                 pre_ids: npt.NDArray[np.int64], 
+                 offsets: npt.NDArray[np.int64], 
+                 fmzs: npt.NDArray[np.float64]
+                 ) -> None :
+        """
+        Parameters
+        ----------
+        pre_ids : ``numpy.ndarray(int)``
+            sorted unique DDA precursor IDs, shape: (n_precursors,)
+        offsets : ``numpy.ndarray(int)``
+            offsets of the fragments for each DDA precursor, shape: (n_precursors + 1,)
+        fmzs : ``numpy.ndarray(float)``
+            fragment m/zs, sorted within each DDA precursor, shape: (n_fragments,)
+        """
+        self.pre_ids = pre_ids
+        self.offsets = offsets
+        self.fmzs = fmzs
+
+    @classmethod
+    def from_db(cls, 
+                cur: ResultsDbCursor, 
+                dda_pids: Optional[Union[int, str]] = None
+                ) -> "_DdaFragmentIndex" :
+        """ 
+        load the index from the results database, with all of the DDA fragments or optionally only the
+        fragments for specified DDA precursor ID(s) (single ID or comma-separated string of IDs)
+        """
+        qry = """--beginsql
+            SELECT dda_pre_id, fmz FROM DDAFragments {} ORDER BY dda_pre_id, fmz
+        --endsql"""
+        if dda_pids is None:
+            rows = cur.execute(qry.format("")).fetchall()
+        else:
+            ids = [int(_) for _ in str(dda_pids).split(",")]
+            rows = cur.execute(qry.format(f"WHERE dda_pre_id IN ({','.join('?' * len(ids))})"), ids).fetchall()
+        ids_col = np.array([_[0] for _ in rows], dtype=np.int64)
+        fmzs = np.array([_[1] for _ in rows], dtype=np.float64)
+        pre_ids, starts = np.unique(ids_col, return_index=True)
+        return cls(pre_ids, np.append(starts, len(ids_col)).astype(np.int64), fmzs)
+
+    def get_fmzs(self, 
+                 dda_pids: Union[int, str]
+                 ) -> npt.NDArray[np.float64] :
+        """
+        get the fragment m/zs for DDA precursor ID(s) (single ID or comma-separated string of IDs), 
+        DDA precursors without any fragments are ignored
+        """
+        if len(self.pre_ids) == 0:
+            return np.array([], dtype=np.float64)
+        ids = np.array([int(_) for _ in str(dda_pids).split(",")], dtype=np.int64)
+        j = np.clip(np.searchsorted(self.pre_ids, ids), 0, len(self.pre_ids) - 1)
+        j = j[self.pre_ids[j] == ids]
+        if len(j) == 0:
+            return np.array([], dtype=np.float64)
+        return np.concatenate([self.fmzs[self.offsets[k]:self.offsets[k + 1]] for k in j])
+
+
 # TODO (Dylan Ross): This function could probably benefit from being broken up into a couple
 #                    smaller functions. In particular, probably one for extracting/fitting
 #                    chromatograms, and another for extracting/fitting ATDs
@@ -280,7 +604,7 @@ def _add_single_target_results_to_db(cur: ResultsDbCursor,
 def _single_target_analysis(n: int, 
                             i: int, 
                             rdr: MZA, 
-                            cur: ResultsDbCursor, 
+                            cur: Optional[ResultsDbCursor], 
                             dia_file_id: MzaFileId, 
                             dda_pid: int, 
                             dda_mz: float, 
@@ -288,7 +612,10 @@ def _single_target_analysis(n: int,
                             dda_ms2_n_peaks: Optional[int], 
                             params: DiaParams, 
                             debug_flag: Optional[str], 
-                            debug_cb: Optional[Callable]
+                            debug_cb: Optional[Callable], 
+                            results: Optional[List[Tuple[Any, ...]]] = None, 
+                            dda_frags: Optional[_DdaFragmentIndex] = None, 
+                            xic_rt_range: Optional[Tuple[float, float]] = None
                             ) -> int :
     """
     Perform a complete analysis of DIA data for a single target DDA feature 
@@ -302,7 +629,7 @@ def _single_target_analysis(n: int,
     rdr 
         MZA instance for extracting raw data
     cur
-        cursor for querying into results database
+        cursor for querying into results database, can be None if both results and dda_frags are provided
     dia_file_id
         DIA data file ID
     dda_pid 
@@ -321,6 +648,15 @@ def _single_target_analysis(n: int,
     debug_cb
         callback function that takes the debugging message as an argument, can be None if
         debug_flag is not set to 'textcb' or 'textcb_pid'
+    results
+        if provided, the results for this target (arguments for ``_add_single_target_results_to_db`` 
+        after the cursor) get appended to this list instead of being added to the database
+    dda_frags
+        preloaded index of the DDA fragments, if not provided the fragments for this target are 
+        loaded from the results database
+    xic_rt_range
+        if provided, only XIC peaks with RTs in this range (min, max) are kept, for targets with XIC windows 
+        that overlap with others for the same m/z (see ``_schedule_dia_targets``)
 
     Returns
     -------
@@ -329,12 +665,6 @@ def _single_target_analysis(n: int,
     """
     # TODO: If ignoring the DDA precursor RT works, then get rid of all of the RT-related stuff left over in
     #       this function. Things like unused parameters, the whole RT peak selecting logic, etc.
-    qry_sel_min_max_dda_frags = """--beginsql
-        SELECT MIN(fmz), MAX(fmz) FROM DDAFragments WHERE dda_pre_id IN ({})
-    --endsql"""
-    qry_sel_dda_frags = """--beginsql
-        SELECT fmz, fint FROM DDAFragments WHERE dda_pre_id IN ({})
-    --endsql"""
     n_features: int = 0
     pid = os.getpid()
     msg = f"({i + 1}/{n}) DDA precursor ID: {dda_pid}, m/z: {dda_mz:.4f}, RT: {dda_rts} min -> "
@@ -344,6 +674,13 @@ def _single_target_analysis(n: int,
     assert params.extract_and_fit_chroms.rt_tol is not None, "extract_and_fit_chroms.rt_tol must be set"
     rt_bounds = (min(_dda_rts) - params.extract_and_fit_chroms.rt_tol, 
                  max(_dda_rts) + params.extract_and_fit_chroms.rt_tol)
+    if xic_rt_range is not None:
+        # extend the XIC window rt_tol past the bounds of the owned RT range, so a peak at the boundary 
+        # with a neighboring target is fully covered by (and fits the same in) both of their XICs
+        rt_bounds = (
+            xic_rt_range[0] - params.extract_and_fit_chroms.rt_tol if np.isfinite(xic_rt_range[0]) else rt_bounds[0],
+            xic_rt_range[1] + params.extract_and_fit_chroms.rt_tol if np.isfinite(xic_rt_range[1]) else rt_bounds[1]
+        )
     assert params.extract_and_fit_chroms.mz_ppm is not None, "the m/z ppm parameter must be set"
     pre_mzt = tol_from_ppm(dda_mz, params.extract_and_fit_chroms.mz_ppm)
     pre_xic = rdr.collect_xic_arrays_by_mz(dda_mz - pre_mzt, dda_mz + pre_mzt, rt_bounds=rt_bounds)
@@ -352,13 +689,13 @@ def _single_target_analysis(n: int,
     if len(pre_xic[0]) < 2:
         debug_handler(debug_flag, debug_cb, msg +  'empty XIC', pid)
         return 0
-    pre_pkrts, pre_pkhts, pre_pkwts = find_peaks_1d_gauss(*pre_xic,
-                                                          params.extract_and_fit_chroms.min_rel_height,
-                                                          params.extract_and_fit_chroms.min_abs_height,
-                                                          params.extract_and_fit_chroms.fwhm.min,
-                                                          params.extract_and_fit_chroms.fwhm.max,
-                                                          params.extract_and_fit_chroms.max_peaks, 
-                                                          True)
+    (pre_pkrts, pre_pkhts, pre_pkwts, pre_psnrs), = fit_traces([pre_xic], params.extract_and_fit_chroms)
+    if xic_rt_range is not None:
+        # leave the XIC peaks that belong to the targets with overlapping XIC windows for them
+        keep = [xic_rt_range[0] <= rt < xic_rt_range[1] for rt in pre_pkrts]
+        pre_pkrts, pre_pkhts, pre_pkwts, pre_psnrs = (
+            [_ for _, k in zip(vals, keep) if k] for vals in (pre_pkrts, pre_pkhts, pre_pkwts, pre_psnrs)
+        )
     # determine the closest XIC peak (if any)
     # target_rt = dda_rt + params.select_chrom_peaks_params.target_rt_shift
     # xic_rt, xic_ht, xic_wt = _select_xic_peak(target_rt, params.select_chrom_peaks_params.target_rt_tol,
@@ -366,39 +703,59 @@ def _single_target_analysis(n: int,
     # proceed if XIC peak was selected
     # if xic_rt is not None:
     # Proceed with all XIC peaks, regardless of whether they were matched with DDA feature. We can assign later on.
-    for xic_rt, xic_ht, xic_wt in zip(pre_pkrts, pre_pkhts, pre_pkwts):
+    # DDA fragment m/zs for this target, the same for all of the XIC/ATD peaks
+    if dda_frags is None:
+        assert cur is not None, "need either a results database cursor or preloaded DDA fragments"
+        dda_frags = _DdaFragmentIndex.from_db(cur, dda_pid)
+    dda_all_fmzs = dda_frags.get_fmzs(dda_pid)
+    # do it this way in an attempt to avoid overcounting fragments, not perfect but should help
+    dda_fmzs = np.unique(np.round(dda_all_fmzs, 3))
+    extract_ms2 = dda_ms2_n_peaks is not None and dda_ms2_n_peaks > 0 and len(dda_all_fmzs) > 0
+    # everything from here on gets extracted from trdr, which is either the reader or (in slab mode) all 
+    # of the data for this target pulled out at once, covering all of the XIC peaks
+    trdr: Union[MZA, _DiaTargetSlab] = rdr
+    if params.data_access.slab and len(pre_pkrts) > 0:
+        trdr = _DiaTargetSlab.from_reader(
+            rdr, 
+            (min(r - w for r, w in zip(pre_pkrts, pre_pkwts)), max(r + w for r, w in zip(pre_pkrts, pre_pkwts))), 
+            (dda_mz - max(1.5, pre_mzt), dda_mz + max(2.5, pre_mzt)),
+            (dda_all_fmzs.min() - 1, dda_all_fmzs.max() + 1) if extract_ms2 else None
+        )
+    # extract the ATDs for all of the XIC peaks up front so that they can all be fitted together, 
+    # stopping at the first one that is empty (tight enough bounds and high enough threshold can do that)
+    pre_atds: List[Atd] = []
+    for xic_rt, xic_wt in zip(pre_pkrts, pre_pkwts):
+        pre_atd = trdr.collect_atd_arrays_by_rt_mz(dda_mz - pre_mzt, dda_mz + pre_mzt, 
+                                                   xic_rt - xic_wt, xic_rt + xic_wt)
+        if len(pre_atd[0]) < 2:
+            break
+        pre_atds.append(pre_atd)
+    atd_fits = fit_traces(pre_atds, params.extract_and_fit_atds)  # type: ignore
+    # memo for the MS2 data extracted for deconvolution, shared by all of the ATD peaks under each XIC peak
+    frag_cache = _Ms2PointsCache()
+    for j, (xic_rt, xic_ht, xic_wt, xic_psnr) in enumerate(zip(pre_pkrts, pre_pkhts, pre_pkwts, pre_psnrs)):
         rtmsg = msg + f"RT: {xic_rt:.2f} +/- {xic_wt:.2f} min ({xic_ht:.2e}) -> "
-        xic_psnr = calc_gauss_psnr(*pre_xic, (xic_rt, xic_ht, xic_wt))
-        # extract the ATD, fit
         rt_min, rt_max = xic_rt - xic_wt, xic_rt + xic_wt
-        pre_atd = rdr.collect_atd_arrays_by_rt_mz(dda_mz - pre_mzt, dda_mz + pre_mzt, rt_min, rt_max)
         # handle case where ATD is empty 
-        # (tight enough bounds and high enough threshold can do that)
-        if len(pre_atd[0]) < 2:
+        if j == len(pre_atds):
             debug_handler(debug_flag, debug_cb, msg +  'empty ATD', pid)
             return 0
-        pre_pkdts, pre_pkhts, pre_pkwts = find_peaks_1d_gauss(*pre_atd, 
-                                                              params.extract_and_fit_atds.min_rel_height,
-                                                              params.extract_and_fit_atds.min_abs_height,
-                                                              params.extract_and_fit_atds.fwhm.min,
-                                                              params.extract_and_fit_atds.fwhm.max,
-                                                              params.extract_and_fit_atds.max_peaks, 
-                                                              True)
+        pre_atd = pre_atds[j]
+        pre_pkdts, pre_pkhts, pre_pkwts, pre_psnrs_atd = atd_fits[j]
         # consider each ATD peak as separate features
-        for atd_dt, atd_ht, atd_wt in zip(pre_pkdts, pre_pkhts, pre_pkwts):
+        for atd_dt, atd_ht, atd_wt, atd_psnr in zip(pre_pkdts, pre_pkhts, pre_pkwts, pre_psnrs_atd):
             dtmsg = rtmsg +  f"DT: {atd_dt:.2f} +/- {atd_wt:.2f} ms ({atd_ht:.2e}) -> "
-            atd_psnr = calc_gauss_psnr(*pre_atd, (atd_dt, atd_ht, atd_wt))
             # extract partial MS1 spectrum from M-1.5 to M+2.5, with RT and DT selection
-            ms1 = rdr.collect_ms1_arrays_by_rt_dt(rt_min, rt_max, 
-                                                  atd_dt - atd_wt, atd_dt + atd_wt, 
-                                                  mz_bounds=(dda_mz - 1.5, dda_mz + 2.5))
+            ms1 = trdr.collect_ms1_arrays_by_rt_dt(rt_min, rt_max, 
+                                                   atd_dt - atd_wt, atd_dt + atd_wt, 
+                                                   mz_bounds=(dda_mz - 1.5, dda_mz + 2.5))
             ms2 = None
             n_ms2_peaks = None
             sel_ms2_mzs = []
             sel_ms2_ints = []
             deconvoluted = []
             frag_raws = []
-            if dda_ms2_n_peaks is not None and dda_ms2_n_peaks > 0:
+            if extract_ms2:
                 # extract MS2 spectrum (before deconvolution)
                 # only if there are MS/MS peaks from DDA spectrum
                 # use those as targets? Not really. Currently we are just extracting the whole
@@ -407,10 +764,10 @@ def _single_target_analysis(n: int,
                 # one thing we can do though is grab the min/max mz from the DDA MS2 spectrum peaks
                 # and only extract from that range. Could really reduce the amount of data we need 
                 # to pull out of the DIA file, therefore speeding things up.
-                min_fmz, max_fmz = cur.execute(qry_sel_min_max_dda_frags.format(dda_pid)).fetchall()[0]
-                ms2 = rdr.collect_ms2_arrays_by_rt_dt(xic_rt - xic_wt, xic_rt + xic_wt, 
-                                                      atd_dt - atd_wt, atd_dt + atd_wt, 
-                                                      mz_bounds=[min_fmz - 1, max_fmz + 1])
+                min_fmz, max_fmz = dda_all_fmzs.min(), dda_all_fmzs.max()
+                ms2 = trdr.collect_ms2_arrays_by_rt_dt(xic_rt - xic_wt, xic_rt + xic_wt, 
+                                                       atd_dt - atd_wt, atd_dt + atd_wt, 
+                                                       mz_bounds=[min_fmz - 1, max_fmz + 1])
                 if len(ms2[0]) > 1:
                     dia_ms2_peaks = find_peaks_1d_localmax(*ms2,
                                                            params.extract_and_fit_ms2_spectra.min_rel_height,
@@ -422,26 +779,20 @@ def _single_target_analysis(n: int,
                     if n_ms2_peaks > 0:
                         dtmsg += f"# DIA MS2 peaks: {n_ms2_peaks} -> "
                         # try to match peaks from DDA spectrum
-                        # do it this way in an attempt to avoid overcounting fragments
-                        # not perfect but should help
-                        dda_fmzs = set([
-                            round(r[0], 3) 
-                            for r in cur.execute(qry_sel_dda_frags.format(dda_pid)).fetchall()
-                        ])
-                        for ddam in dda_fmzs:
-                            if ddam < dda_mz + 25:  # only consider MS2 peaks that are less than precursor + 25
-                                for diam, diah, diaw in zip(*dia_ms2_peaks):
-                                    frg_tol = tol_from_ppm(ddam, params.ms2_peak_matching.mz_ppm)
-                                    if abs(diam - ddam) <= frg_tol:
-                                        sel_ms2_mzs.append(diam)
-                                        sel_ms2_ints.append(diah)
+                        # only consider MS2 peaks that are less than precursor + 25
+                        matched = _match_ms2_peaks(dda_fmzs[dda_fmzs < dda_mz + 25], 
+                                                   dia_ms2_peaks[0], 
+                                                   params.ms2_peak_matching.mz_ppm)
+                        sel_ms2_mzs = np.asarray(dia_ms2_peaks[0])[matched].tolist()
+                        sel_ms2_ints = np.asarray(dia_ms2_peaks[1])[matched].tolist()
                         dtmsg += f"matched with DDA: {len(sel_ms2_mzs)}"
                         # deconvolute peaks that were matched from DDA spectrum
                         if len(sel_ms2_mzs) > 0:
-                            deconvoluted, frag_raws = _deconvolute_ms2_peaks(rdr, 
+                            deconvoluted, frag_raws = _deconvolute_ms2_peaks(trdr, 
                                                                             sel_ms2_mzs, 
                                                                             pre_xic, xic_rt, xic_wt, pre_atd,
-                                                                            params)
+                                                                            params, 
+                                                                            cache=frag_cache)
                             dtmsg += f" -> deconvoluted: {len([_ for _ in deconvoluted if _[0]])}"
             debug_handler(debug_flag, debug_cb, dtmsg, pid)
             # add the results for this target to the database
@@ -450,22 +801,330 @@ def _single_target_analysis(n: int,
             #       The fragment info that already gets stored is more than sufficient. Plus at a conceptual level
             #       we are only dealing in centroided MS2 spectra in this package as a whole, so it does not make
             #       sense to store the profile data as well (plus plus it takes up a ton of space).
-            _add_single_target_results_to_db(cur, 
-                                             None, 
-                                             dia_file_id,
-                                             dda_mz,
-                                             xic_rt, xic_wt, xic_ht, xic_psnr, 
-                                             atd_dt, atd_wt, atd_ht, atd_psnr, 
-                                             (ms1, pre_xic, pre_atd),
-                                             sel_ms2_mzs, sel_ms2_ints, deconvoluted, frag_raws,
-                                             params.store.blob)
+            target_results = (
+                None, 
+                dia_file_id,
+                dda_mz,
+                xic_rt, xic_wt, xic_ht, xic_psnr, 
+                atd_dt, atd_wt, atd_ht, atd_psnr, 
+                (ms1, pre_xic, pre_atd),
+                sel_ms2_mzs, sel_ms2_ints, deconvoluted, frag_raws,
+                params.store.blob
+            )
+            if results is not None:
+                results.append(target_results)
+            else:
+                assert cur is not None, "need a results database cursor to add the results to"
+                _add_single_target_results_to_db(cur, *target_results)
             n_features += 1
     else:
         debug_handler(debug_flag, debug_cb, msg + 'no XIC peak found', pid)
+    if frag_cache.hits + frag_cache.misses > 0:
+        debug_handler(debug_flag, debug_cb, 
+                      msg + f"fragment MS2 data cache: {frag_cache.hits} hits, {frag_cache.misses} misses", pid)
     # return the count of features extracted
     return n_features
 
 
+def _get_dia_file_id(cur: ResultsDbCursor, 
+                     dia_data_file: Union[MzaFilePath, MzaFileId]
+                     ) -> MzaFileId :
+    """
+    get the file ID for a DIA data file, which is either already a file ID from the results database or 
+    a path to a data file that gets added to the database
+    """
+    # check if the dia_data_file is a path (str) or file ID from the results database (int)
+    match dia_data_file:
+        case int():
+            return dia_data_file
+        case str():
+            # add the MZA data file to the database and get a file identifier for it
+            dia_file_id: MzaFileId = add_data_file_to_db(cur, "LC-IMS-MS/MS (DIA)", dia_data_file)
+            cur.connection.commit()
+            return dia_file_id
+        case _:
+            msg = f"extract_dia_features: invalid type for dia_data_file ({type(dia_data_file)})"
+            raise ValueError(msg)
+
+
+def _select_dia_targets(cur: ResultsDbCursor
+                        ) -> List[Tuple[str, float, str, Optional[int]]] :
+    """
+    select the targets for DIA data analysis from the DDA features in the results database, 
+    returns a list of (DDA precursor IDs, m/z, RTs, total MS2 peaks) with the IDs and RTs as 
+    comma-separated strings
+    """
+    # NOTE: We group by precursor m/z, keep all dda_pre_ids, and sum together ms2_n_peaks which
+    #       means that we are only going by unique m/z value and combining all the rest of the 
+    #       info for all matching precursors from DDA. This goes with the change in the DIA feature
+    #       extraction procedure where instead of trying to select the XIC peak that most closely
+    #       matches a particular DDA feature RT we just consider all XIC peaks for the DIA feature
+    #       separately and a mapping between the DDA and DIA features can be done later based on 
+    #       m/z and RT of the DDA and DIA features.
+    # NOTE: If the DDA precursors have been clustered (cluster_dda_features) then all precursors in a
+    #       cluster are grouped under the m/z of the cluster representative. Precursors that are not in 
+    #       DDAPrecursorClusters, or whose representative is no longer in DDAPrecursors, are their own 
+    #       representatives. Results databases from before clustering was added do not have the 
+    #       DDAPrecursorClusters table at all.
+    if results_db_has_table(cur, "DDAPrecursorClusters"):
+        pre_sel_qry = """--beginsql
+            SELECT 
+                GROUP_CONCAT(p.dda_pre_id) AS dda_pre_ids, 
+                COALESCE(r.mz, p.mz) AS target_mz, 
+                GROUP_CONCAT(p.rt) AS rts, 
+                SUM(p.ms2_n_peaks) AS sum_ms2_n_peaks 
+            FROM 
+                DDAPrecursors AS p
+                LEFT JOIN DDAPrecursorClusters AS c USING(dda_pre_id)
+                LEFT JOIN DDAPrecursors AS r ON r.dda_pre_id = c.cluster_id
+            GROUP BY
+                target_mz
+        --endsql"""
+    else:
+        pre_sel_qry = """--beginsql
+            SELECT 
+                GROUP_CONCAT(dda_pre_id) AS dda_pre_ids, 
+                mz, 
+                GROUP_CONCAT(rt) AS rts, 
+                SUM(ms2_n_peaks) AS sum_ms2_n_peaks 
+            FROM 
+                DDAPrecursors
+            GROUP BY
+                mz
+        --endsql"""
+    return cur.execute(pre_sel_qry).fetchall()
+
+
+class _ScanCache:
+    """
+    Memory-capped LRU cache for decoded scan data (the [mzbins, intensities] arrays for each scan) from 
+    MZA readers, used in place of the unbounded ``MZA`` scan cache (``cache_scan_data=True``). Scans are 
+    evicted, least recently used first, to keep the total size of the cached arrays within the byte budget. 
+    The cache can be shared by readers for multiple data files through per-reader views (``view``), so the 
+    budget covers everything cached in a process. Hits and misses are counted by the readers themselves 
+    (see ``_scan_cache_stats``), the cache only keeps track of evictions and its size.
+    """
+
+    def __init__(self, 
+                 max_bytes: int
+                 ) -> None :
+        """
+        Parameters
+        ----------
+        max_bytes : ``int``
+            byte budget for the cached scan data
+        """
+        self.max_bytes = max_bytes
+        self._scans: OrderedDict[Tuple[str, int], List[npt.NDArray]] = OrderedDict()
+        self._scan_bytes: Dict[Tuple[str, int], int] = {}
+        self.nbytes: int = 0
+        self.peak_nbytes: int = 0
+        self.evictions: int = 0
+
+    def __contains__(self, key: Tuple[str, int]) -> bool :
+        return key in self._scans
+
+    def __getitem__(self, key: Tuple[str, int]) -> List[npt.NDArray] :
+        self._scans.move_to_end(key)
+        return self._scans[key]
+
+    def __setitem__(self, key: Tuple[str, int], scan_data: List[npt.NDArray]) -> None :
+        nbytes = sum(a.nbytes for a in scan_data if a is not None)
+        if key in self._scans:
+            self.nbytes -= self._scan_bytes.pop(key)
+            del self._scans[key]
+        if nbytes > self.max_bytes:
+            # a scan that does not fit in the budget by itself does not get cached
+            return
+        while self.nbytes + nbytes > self.max_bytes:
+            old_key, _ = self._scans.popitem(last=False)
+            self.nbytes -= self._scan_bytes.pop(old_key)
+            self.evictions += 1
+        self._scans[key] = scan_data
+        self._scan_bytes[key] = nbytes
+        self.nbytes += nbytes
+        self.peak_nbytes = max(self.peak_nbytes, self.nbytes)
+
+    def view(self, 
+             name: str
+             ) -> "_ScanCacheView" :
+        """ get a view of the cache for a reader, name identifies the data file """
+        return _ScanCacheView(self, name)
+
+
+class _ScanCacheView:
+    """ view of a ``_ScanCache`` for one MZA reader, maps scan index -> scan data like the MZA scan cache """
+
+    def __init__(self, 
+                 cache: _ScanCache, 
+                 name: str
+                 ) -> None :
+        self.cache = cache
+        self.name = name
+
+    def __contains__(self, idx: int) -> bool :
+        return (self.name, idx) in self.cache
+
+    def __getitem__(self, idx: int) -> List[npt.NDArray] :
+        return self.cache[(self.name, idx)]
+
+    def __setitem__(self, idx: int, scan_data: List[npt.NDArray]) -> None :
+        self.cache[(self.name, idx)] = scan_data
+
+
+# NOTE: _swap_scan_cache and _scan_cache_stats are the only places that depend on the internals of the 
+#       mzapy MZA reader: the scan cache (_scan_cache, a mapping of scan index -> [mzbins, intensities] 
+#       that gets checked and filled in when reading scans) and its hit/miss counters. These are not part 
+#       of the public mzapy API, so the mzapy version is pinned (in setup.cfg) to the releases that this 
+#       has been checked against, check these again before allowing newer releases.
+
+
+def _swap_scan_cache(rdr: MZA, 
+                     scan_cache: Optional[Union[Dict[Any, Any], _ScanCacheView]]
+                     ) -> Optional[Union[Dict[Any, Any], _ScanCacheView]] :
+    """ 
+    replace the MZA reader's scan cache (None to turn scan caching off), returns the one it had before 
+    """
+    prev_scan_cache = rdr._scan_cache
+    rdr._scan_cache = scan_cache
+    return prev_scan_cache
+
+
+def _scan_cache_stats(rdr: MZA
+                      ) -> Tuple[int, int] :
+    """ 
+    (hits, misses) for the MZA reader's scan cache, these are counted by the reader whichever scan 
+    cache it is using
+    """
+    return rdr._scan_cache_hits, rdr._scan_cache_misses
+
+
+def _scan_cache_msg(hits: int, 
+                    misses: int
+                    ) -> str :
+    """ debugging message with scan cache hit rate """
+    rate = hits / (hits + misses) if hits + misses > 0 else 0.
+    return f"MZA scan cache: {hits} hits, {misses} misses ({100 * rate:.1f}% hit rate)"
+
+
+def _open_dia_reader(dia_data_file: MzaFilePath, 
+                     mza_io_threads: int, 
+                     scan_cache: Optional[_ScanCache] = None
+                     ) -> MZA :
+    """
+    open a reader for a DIA data file, with the default (unbounded) MZA scan cache, or if scan_cache 
+    is provided, with scans cached in that instead
+    """
+    if scan_cache is None:
+        return MZA(dia_data_file, io_threads=mza_io_threads, cache_scan_data=True)
+    # NOTE: The reader gets opened without its own scan cache (which would also be loaded from and saved 
+    #       to a file next to the data file) then gets a view of the memory-capped cache in its place. 
+    rdr = MZA(dia_data_file, io_threads=mza_io_threads, cache_scan_data=False)
+    _swap_scan_cache(rdr, scan_cache.view(dia_data_file))
+    return rdr
+
+
+def _close_dia_reader(rdr: MZA, 
+                      save_scan_cache: bool = True
+                      ) -> None :
+    """ 
+    close a reader from _open_dia_reader, the default MZA scan cache gets saved to file unless 
+    save_scan_cache is False (the memory-capped scan cache never gets saved)
+    """
+    # the reader saves its scan cache to file on close if it has one
+    scan_cache = _swap_scan_cache(rdr, None)
+    if save_scan_cache and not isinstance(scan_cache, _ScanCacheView):
+        _swap_scan_cache(rdr, scan_cache)
+    rdr.close()
+
+
+def _scan_cache_budget(params: DiaParams
+                       ) -> Optional[_ScanCache] :
+    """ set up the memory-capped scan cache from DIA params (None if not using one) """
+    if params.data_access.cache_mb is None:
+        return None
+    return _ScanCache(int(params.data_access.cache_mb * 2**20))
+
+
+def _scan_cache_budget_msg(evictions: int, 
+                           peak_nbytes: int, 
+                           max_bytes: int
+                           ) -> str :
+    """ debugging message with memory-capped scan cache stats """
+    return (f"scan cache (LRU): {evictions} evictions, "
+            f"peak {peak_nbytes / 2**20:.1f} MB of {max_bytes / 2**20:.1f} MB")
+
+
+def _schedule_dia_targets(targets: List[Tuple[str, float, str, Optional[int]]], 
+                          rt_tol: float, 
+                          max_rt_span: Optional[float] = None
+                          ) -> List[Tuple[str, float, str, Optional[int], Tuple[float, float]]] :
+    """
+    order DIA targets (from ``_select_dia_targets``) by the start of their XIC RT windows so consecutive 
+    targets read data from the same frames. The DDA precursor RTs for each target are clustered, and the 
+    target is split into one target per cluster, each with the DDA precursor IDs and RTs in that cluster, 
+    so that an m/z that was selected for MS/MS at very different RTs gets several narrow XIC windows rather 
+    than one that covers most of the gradient. A new cluster starts at any gap > 2 * rt_tol between RTs 
+    (giving separate XIC windows) or where the cluster would span more than max_rt_span. 
+    
+    XIC windows for clusters that were split up by max_rt_span overlap, so each cluster also gets an RT 
+    range that it owns, bounded by the midpoints between its RTs and those of the neighboring clusters that 
+    it was split from by max_rt_span (unbounded on the sides where the clusters were split by a gap, their 
+    XIC windows do not overlap). Only XIC peaks in that range should be kept for the target so that peaks 
+    in the overlap are not picked up twice, and the XIC window should extend rt_tol past the bounds of the 
+    range so that a peak at a boundary gets the same fit from both of the neighboring targets. The owned 
+    RT ranges for the clusters of an m/z cover all RTs without overlapping. 
+
+    Parameters
+    ----------
+    targets : ``list(tuple(str, float, str, int or None))``
+        DIA targets: (DDA precursor IDs, m/z, RTs, total MS2 peaks) with IDs and RTs as comma-separated strings
+    rt_tol : ``float``
+        RT tolerance for XIC extraction (``extract_and_fit_chroms.rt_tol``)
+    max_rt_span : ``float``, optional
+        max span of the DDA precursor RTs in one cluster, if not provided defaults to 2 * rt_tol 
+        (XIC windows no wider than 4 * rt_tol)
+
+    Returns
+    -------
+    scheduled_targets : ``list(tuple(str, float, str, int or None, tuple(float, float)))``
+        DIA targets, split up by RT cluster and sorted by RT window start then m/z, with the RT range that 
+        each one owns (min, max) added 
+    """
+    max_rt_span = 2 * rt_tol if max_rt_span is None else max_rt_span
+    scheduled = []
+    for dda_fids, dda_mz, dda_rts, dda_ms2_n_peaks in targets:
+        pairs = sorted(zip(str(dda_fids).split(","), (float(_) for _ in dda_rts.split(","))), key=lambda p: p[1])
+        clusters = [[pairs[0]]]
+        # boundaries before each cluster and after the last one: (max RT of the owned range of the cluster 
+        # before, min RT of the owned range of the cluster after), unbounded if there is no overlap
+        no_bound = (np.inf, -np.inf)
+        bounds = [no_bound]
+        for pair in pairs[1:]:
+            if pair[1] - clusters[-1][-1][1] > 2 * rt_tol:
+                # separate XIC windows, no need to restrict XIC peaks
+                bounds.append(no_bound)
+            elif pair[1] - clusters[-1][0][1] > max_rt_span:
+                # overlapping XIC windows, split at the midpoint
+                mid = (clusters[-1][-1][1] + pair[1]) / 2
+                bounds.append((mid, mid))
+            else:
+                clusters[-1].append(pair)
+                continue
+            clusters.append([pair])
+        bounds.append(no_bound)
+        for k, cluster in enumerate(clusters):
+            scheduled.append((",".join(_[0] for _ in cluster), dda_mz, ",".join(str(_[1]) for _ in cluster), 
+                              dda_ms2_n_peaks, (bounds[k][1], bounds[k + 1][0])))
+    # the RTs within each target are sorted, so the first one is the start of the RT window
+    return sorted(scheduled, key=lambda t: (float(t[2].split(",")[0]), t[1]))
+
+
+# number of targets worth of results that get added to the results database in each transaction, when 
+# running extract_dia_features_multiproc workers accumulate this many before sending them to the writer process
+_RESULTS_BATCH_SIZE: int = 50
+
+
 def extract_dia_features(dia_data_file: MzaFilePath, 
                          results_db: ResultsDbPath, 
                          params: DiaParams, 
@@ -513,51 +1172,35 @@ def extract_dia_features(dia_data_file: MzaFilePath,
     # check that DDA feature extraction and consolidation have been completed first
     check_analysis_log(cur, AnalysisStep.DDA_EXT)
     check_analysis_log(cur, AnalysisStep.DDA_CONS)
-    # check if the dia_data_file is a path (str) or file ID from the results database (int)
-    match dia_data_file:
-        case int():
-            dia_file_id: int = dia_data_file
-        case str():
-            # add the MZA data file to the database and get a file identifier for it
-            dia_file_id: int = add_data_file_to_db(cur, "LC-IMS-MS/MS (DIA)", dia_data_file)
-            # close database connection
-            con.commit()
-        case _:
-            msg = f"extract_dda_features: invalid type for dda_data_file ({type(dia_data_file)})"
-            raise ValueError(msg)
+    # add the DIA data file to the database (if needed) and get its file ID
+    dia_file_id: MzaFileId = _get_dia_file_id(cur, dia_data_file)
     # initialize the data file reader
-    rdr = MZA(dia_data_file, io_threads=mza_io_threads, cache_scan_data=True)
+    scan_cache = _scan_cache_budget(params)
+    rdr = _open_dia_reader(dia_data_file, mza_io_threads, scan_cache=scan_cache)
     # get all of the DDA features, these will be the targets for the DIA data analysis
-    # NOTE: We group by precursor m/z, keep all dda_pre_ids, and sum together ms2_n_peaks which
-    #       means that we are only going by unique m/z value and combining all the rest of the 
-    #       info for all matching precursors from DDA. This goes with the change in the DIA feature
-    #       extraction procedure where instead of trying to select the XIC peak that most closely
-    #       matches a particular DDA feature RT we just consider all XIC peaks for the DIA feature
-    #       separately and a mapping between the DDA and DIA features can be done later based on 
-    #       m/z and RT of the DDA and DIA features.
-    pre_sel_qry = """--beginsql
-        SELECT 
-            GROUP_CONCAT(dda_pre_id) AS dda_pre_ids, 
-            mz, 
-            GROUP_CONCAT(rt) AS rts, 
-            SUM(ms2_n_peaks) AS sum_ms2_n_peaks 
-        FROM 
-            DDAPrecursors
-        GROUP BY
-            mz
-    --endsql"""
-    dda_feats = [_ for _ in cur.execute(pre_sel_qry).fetchall()]
+    # schedule them in order of RT so consecutive targets use the same scans
+    assert params.extract_and_fit_chroms.rt_tol is not None, "extract_and_fit_chroms.rt_tol must be set"
+    dda_feats = _schedule_dia_targets(_select_dia_targets(cur), params.extract_and_fit_chroms.rt_tol)
+    # load all of the DDA fragments up front
+    dda_frags = _DdaFragmentIndex.from_db(cur)
     # extract DIA features for each DDA feature
     n = len(dda_feats)
     n_dia_features: int = 0
-    for i, (dda_fids, dda_mz, dda_rts, dda_ms2_n_peaks) in enumerate(dda_feats):
+    for i, (dda_fids, dda_mz, dda_rts, dda_ms2_n_peaks, xic_rt_range) in enumerate(dda_feats):
         n_dia_features += _single_target_analysis(n, i, rdr, cur, dia_file_id, dda_fids, 
                                                   dda_mz, dda_rts, dda_ms2_n_peaks, 
-                                                  params, debug_flag, debug_cb)
-        # commit DB changes after each target? Yes.
-        con.commit()
-    # commit DB changes at the end of the analysis? No.
-    #con.commit()
+                                                  params, debug_flag, debug_cb, 
+                                                  dda_frags=dda_frags, xic_rt_range=xic_rt_range)
+        # commit DB changes after each batch of targets rather than after every target
+        if (i + 1) % _RESULTS_BATCH_SIZE == 0:
+            con.commit()
+    # commit DB changes for the last (partial) batch of targets
+    con.commit()
+    debug_handler(debug_flag, debug_cb, _scan_cache_msg(*_scan_cache_stats(rdr)), pid)
+    if scan_cache is not None:
+        debug_handler(debug_flag, debug_cb, 
+                      _scan_cache_budget_msg(scan_cache.evictions, scan_cache.peak_nbytes, scan_cache.max_bytes), 
+                      pid)
     # update the analysis log
     update_analysis_log(
         cur, 
@@ -570,7 +1213,7 @@ def extract_dia_features(dia_data_file: MzaFilePath,
     con.commit()
     # clean up
     con.close()
-    rdr.close()
+    _close_dia_reader(rdr)
     # return the number of features extracted
     return n_dia_features
 
@@ -584,6 +1227,138 @@ def extract_dia_features(dia_data_file: MzaFilePath,
 #                    that is how this should work...
     
 
+# DIA targets, DDA fragments, MZA reader (for the DIA data file of the current work unit), and the queue 
+# for sending results to the writer process owned by each worker process when running 
+# extract_dia_features_multiproc, get set up by _init_dia_worker when the worker process starts
+# NOTE: Workers do not need a connection to the results database, everything they need from it gets 
+#       loaded up front and all of the writing goes through the writer process.
+_WORKER_TARGETS: List[Tuple[str, float, str, Optional[int], Tuple[float, float]]] = []
+_WORKER_FRAGS: Optional[_DdaFragmentIndex] = None
+_WORKER_RDR: Optional[MZA] = None
+_WORKER_RDR_FILE: Optional[MzaFilePath] = None
+_WORKER_QUEUE: Optional[multiprocessing.Queue] = None
+# memory-capped scan cache shared by all of the readers in each worker process (if using one)
+_WORKER_SCAN_CACHE: Optional[_ScanCache] = None
+
+
+def _init_dia_worker(targets: List[Tuple[str, float, str, Optional[int], Tuple[float, float]]], 
+                     dda_frags: _DdaFragmentIndex,
+                     queue: multiprocessing.Queue
+                     ) -> None :
+    """ 
+    initializer for worker processes, sets up the DIA targets, DDA fragments, and the queue for sending 
+    results to the writer process 
+    """
+    global _WORKER_TARGETS, _WORKER_FRAGS, _WORKER_RDR, _WORKER_RDR_FILE, _WORKER_QUEUE, _WORKER_SCAN_CACHE
+    _WORKER_TARGETS = targets
+    _WORKER_FRAGS = dda_frags
+    _WORKER_SCAN_CACHE = None
+    _WORKER_RDR, _WORKER_RDR_FILE = None, None
+    _WORKER_QUEUE = queue
+    # close the reader when the worker exits (after the pool gets closed)
+    multiprocessing.util.Finalize(None, _close_dia_worker_reader, exitpriority=10)
+
+
+def _close_dia_worker_reader() -> None :
+    """ 
+    close the reader owned by this worker process (if there is one). The default MZA scan cache does not 
+    get saved to file because workers for the same DIA data file would all be writing to the same file.
+    """
+    global _WORKER_RDR, _WORKER_RDR_FILE
+    if _WORKER_RDR is not None:
+        _close_dia_reader(_WORKER_RDR, save_scan_cache=False)
+    _WORKER_RDR, _WORKER_RDR_FILE = None, None
+
+
+def _add_dia_results_batch(cur: ResultsDbCursor, 
+                           batch: List[Tuple[Any, ...]]
+                           ) -> None :
+    """
+    adds a batch of DIA target results (lists of arguments for _add_single_target_results_to_db after 
+    the cursor) to the results database, used by the results writer process during 
+    extract_dia_features_multiproc
+    """
+    for target_results in batch:
+        _add_single_target_results_to_db(cur, *target_results)
+
+
+def _extract_dia_features_worker(unit: Tuple[MzaFilePath, MzaFileId, int, int], 
+                                 params: DiaParams, 
+                                 debug_flag: Optional[str], 
+                                 debug_cb: Optional[Callable], 
+                                 mza_io_threads: int
+                                 ) -> Tuple[MzaFilePath, int, int, int, int, int] :
+    """ 
+    runs _single_target_analysis on a work unit: a chunk of the DIA targets (i0 to i1) for one DIA data 
+    file (dia_data_file, dia_file_id, i0, i1), using the reader owned by this worker (the reader for the 
+    previous file gets closed and one for this file opened if this unit is for a different file), sends the results to the writer process in batches, returns the DIA data 
+    file, the number of DIA features extracted, the reader's scan cache hits and misses for this unit, and 
+    if this worker uses a memory-capped scan cache: its evictions for this unit and its peak size (bytes) 
+    so far (otherwise both 0)
+    """
+    global _WORKER_SCAN_CACHE, _WORKER_RDR, _WORKER_RDR_FILE
+    assert _WORKER_FRAGS is not None and _WORKER_QUEUE is not None, "DIA worker was not initialized"
+    dia_data_file, dia_file_id, i0, i1 = unit
+    if _WORKER_SCAN_CACHE is None:
+        _WORKER_SCAN_CACHE = _scan_cache_budget(params)
+    if dia_data_file != _WORKER_RDR_FILE:
+        # only keep one reader (and its scan cache) open at a time, the work units for each DIA data file
+        # get dispatched together so workers do not switch between files often
+        _close_dia_worker_reader()
+        _WORKER_RDR = _open_dia_reader(dia_data_file, mza_io_threads, scan_cache=_WORKER_SCAN_CACHE)
+        _WORKER_RDR_FILE = dia_data_file
+    rdr = _WORKER_RDR
+    hits0, misses0 = _scan_cache_stats(rdr)
+    evictions0 = _WORKER_SCAN_CACHE.evictions if _WORKER_SCAN_CACHE is not None else 0
+    n = len(_WORKER_TARGETS)
+    n_dia_features: int = 0
+    results: List[Tuple[Any, ...]] = []
+    for i in range(i0, i1):
+        dda_fids, dda_mz, dda_rts, dda_ms2_n_peaks, xic_rt_range = _WORKER_TARGETS[i]
+        n_dia_features += _single_target_analysis(n, i, rdr, None, dia_file_id, dda_fids, 
+                                                  dda_mz, dda_rts, dda_ms2_n_peaks, 
+                                                  params, debug_flag, debug_cb, 
+                                                  results=results, dda_frags=_WORKER_FRAGS, 
+                                                  xic_rt_range=xic_rt_range)
+        if len(results) >= _RESULTS_BATCH_SIZE:
+            _WORKER_QUEUE.put(results)
+            results = []
+    if results:
+        _WORKER_QUEUE.put(results)
+    hits, misses = _scan_cache_stats(rdr)
+    evictions, peak_nbytes = 0, 0
+    if _WORKER_SCAN_CACHE is not None:
+        evictions, peak_nbytes = _WORKER_SCAN_CACHE.evictions - evictions0, _WORKER_SCAN_CACHE.peak_nbytes
+    return dia_data_file, n_dia_features, hits - hits0, misses - misses0, evictions, peak_nbytes
+
+
+def _dia_work_units(dia_data_files: List[MzaFilePath], 
+                    n_targets: int, 
+                    n_proc: int, 
+                    max_chunk_size: int = 250, 
+                    chunks_per_proc: int = 4
+                    ) -> List[Tuple[int, int, int]] :
+    """
+    split up DIA feature extraction into work units: (index of DIA data file, first target, last target) 
+    with the targets for each file split into chunks. The chunk size is set so that there are several 
+    work units per process even with only one DIA data file (up to max_chunk_size). Work units are grouped
+    by DIA data file, from the biggest file to the smallest, so the big units get started first and workers 
+    (which keep one reader open at a time) rarely have to switch between files. Within each file the 
+    smaller last chunk comes after the full-size ones. 
+    """
+    if n_targets == 0:
+        return []
+    n_units = len(dia_data_files) * n_targets
+    chunk_size = max(1, min(max_chunk_size, -(-n_units // (n_proc * chunks_per_proc))))
+    file_sizes = [os.path.getsize(f) if os.path.isfile(f) else 0 for f in dia_data_files]
+    units = [
+        (k, i0, min(i0 + chunk_size, n_targets)) 
+        for k in range(len(dia_data_files)) for i0 in range(0, n_targets, chunk_size)
+    ]
+    # ties stay in order of file then target
+    return sorted(units, key=lambda u: (-file_sizes[u[0]], u[0], u[1] - u[2]))
+
+
 def extract_dia_features_multiproc(dia_data_files: List[MzaFilePath], 
                                    results_db: ResultsDbPath, 
                                    params: DiaParams, 
@@ -593,7 +1368,11 @@ def extract_dia_features_multiproc(dia_data_files: List[MzaFilePath],
                                    mza_io_threads: int = 4
                                    ) -> Dict[str, int] :
     """
-    extracts dda features from multiple DDA files in parallel
+    extracts DIA features from multiple DIA files in parallel. The work is split up into units of 
+    (DIA data file, chunk of DIA targets) that go into a queue for a pool of worker processes, so all 
+    of the processes can be kept busy regardless of the number of DIA data files. Each worker keeps 
+    one reader open, for the DIA data file it is currently working on. Workers do not write to the results
+    database, they send their results to a single writer process which adds them in large transactions.
 
     Parameters
     ----------
@@ -618,14 +1397,70 @@ def extract_dia_features_multiproc(dia_data_files: List[MzaFilePath],
     dia_features_per_file : ``dict(str:int)``
         dictionary with the number of DIA features mapped to input DIA data files
     """
-    n_proc = min(n_proc, len(dia_data_files))  # no need to use more processes than the number of inputs
-    args = [(dia_data_file, results_db, params) for dia_data_file in dia_data_files]
-    args_for_starmap = zip(repeat(extract_dia_features), args, repeat({'debug_flag': debug_flag, 
-                                                                       'debug_cb': debug_cb, 
-                                                                       'mza_io_threads': mza_io_threads}))
-    with multiprocessing.Pool(processes=n_proc) as p:
-        feat_counts = p.starmap(apply_args_and_kwargs, args_for_starmap)
-    return {k: v for k, v in zip(dia_data_files, feat_counts)}
+    # ensure the results database exists
+    if not os.path.isfile(results_db):    
+        raise FileNotFoundError(errno.ENOENT, 
+                                os.strerror(errno.ENOENT), 
+                                results_db)
+    con = sqlite3.connect(results_db)
+    cur = con.cursor()
+    # check that DDA feature extraction and consolidation have been completed first
+    check_analysis_log(cur, AnalysisStep.DDA_EXT)
+    check_analysis_log(cur, AnalysisStep.DDA_CONS)
+    # add all of the DIA data files to the database and select the targets up front
+    dia_file_ids = [_get_dia_file_id(cur, dia_data_file) for dia_data_file in dia_data_files]
+    # targets are scheduled in order of RT, so each work unit covers a contiguous range of RT
+    assert params.extract_and_fit_chroms.rt_tol is not None, "extract_and_fit_chroms.rt_tol must be set"
+    targets = _schedule_dia_targets(_select_dia_targets(cur), params.extract_and_fit_chroms.rt_tol)
+    dda_frags = _DdaFragmentIndex.from_db(cur)
+    units = _dia_work_units(dia_data_files, len(targets), n_proc)
+    debug_handler(debug_flag, debug_cb, 
+                  f"EXTRACTING DIA FEATURES: {len(dia_data_files)} files x {len(targets)} targets "
+                  f"in {len(units)} work units")
+    feat_counts: Dict[str, int] = {dia_data_file: 0 for dia_data_file in dia_data_files}
+    cache_stats: Dict[str, List[int]] = {dia_data_file: [0, 0] for dia_data_file in dia_data_files}
+    # memory-capped scan cache stats: total evictions and peak size (bytes) of any one worker's cache
+    evictions, peak_nbytes = 0, 0
+    n_proc = max(1, min(n_proc, len(units)))  # no need to use more processes than the number of work units
+    # the results writer process is the only process that writes to the results database until the
+    # pool of workers is done 
+    con.commit()
+    with results_writer_process(results_db, _add_dia_results_batch) as (queue, writer):
+        with multiprocessing.Pool(processes=n_proc, 
+                                  initializer=_init_dia_worker, 
+                                  initargs=(targets, dda_frags, queue)) as p:
+            unit_results = imap_unordered_with_writer(
+                p, 
+                partial(_extract_dia_features_worker, params=params, debug_flag=debug_flag, debug_cb=debug_cb, 
+                        mza_io_threads=mza_io_threads), 
+                [(dia_data_files[k], dia_file_ids[k], i0, i1) for k, i0, i1 in units], 
+                writer
+            )
+            for dia_data_file, n_dia_features, hits, misses, unit_evictions, unit_peak_nbytes in unit_results:
+                feat_counts[dia_data_file] += n_dia_features
+                cache_stats[dia_data_file][0] += hits
+                cache_stats[dia_data_file][1] += misses
+                evictions += unit_evictions
+                peak_nbytes = max(peak_nbytes, unit_peak_nbytes)
+    for dia_data_file in dia_data_files:
+        debug_handler(debug_flag, debug_cb, f"{dia_data_file}: {_scan_cache_msg(*cache_stats[dia_data_file])}")
+    if params.data_access.cache_mb is not None:
+        debug_handler(debug_flag, debug_cb, 
+                      "per process " + _scan_cache_budget_msg(evictions, peak_nbytes, 
+                                                              int(params.data_access.cache_mb * 2**20)))
+    # update the analysis log, once for each DIA data file
+    for dia_data_file, dia_file_id in zip(dia_data_files, dia_file_ids):
+        update_analysis_log(
+            cur, 
+            AnalysisStep.DIA_EXT,
+            {
+                "DIA file ID": dia_file_id,
+                "precursors": feat_counts[dia_data_file],
+            }
+        )
+    con.commit()
+    con.close()
+    return feat_counts
 
 
 def add_calibrated_ccs_to_dia_features(results_db: ResultsDbPath, 
@@ -48,6 +48,7 @@ class _Display:
 @dataclass
 class _Precursor:
     precursor_mz: _Range
+    cluster_ppm: Optional[float] = None
 
     def __post_init__(self):
         if type(self.precursor_mz) is dict:
@@ -62,6 +63,7 @@ class _ExtractAndFitChroms:
     min_psnr: Optional[float] = None
     mz_ppm: Optional[float] = None
     rt_tol: Optional[float] = None
+    fit_engine: str = "mzapy"
 
     def __post_init__(self):
         if type(self.fwhm) is dict:
@@ -72,6 +74,7 @@ class _ExtractAndFitChroms:
 class _ConsolidateChromFeats:
     mz_ppm: float
     rt_tol: float
+    drop_isotopes: bool = False
 
 
 @dataclass
@@ -97,11 +100,20 @@ class _StoreData:
     blob: bool
 
 
+@dataclass
+class _DiaDataAccess:
+    slab: bool = False
+    cache_mb: Optional[float] = None
+
+
 @dataclass
 class _ConsolidateDdaFeats:
     mz_ppm: float
     rt_tol: float
     drop_if_no_ms2: bool
+    merge_ms2: bool = False
+    cluster_min_cosine: Optional[float] = None
+    cluster_rt_tol: float = 0.5
 
 
 @dataclass
@@ -365,6 +377,7 @@ class DiaParams:
     ms2_peak_matching: _MS2PeakMatching
     deconvolute_ms2_peaks: _DeconvoluteMs2Peaks
     store: _StoreData
+    data_access: _DiaDataAccess
 
     def __post_init__(self):
         if type(self.extract_and_fit_chroms) is dict:
@@ -379,6 +392,8 @@ class DiaParams:
             self.deconvolute_ms2_peaks = _DeconvoluteMs2Peaks(**self.deconvolute_ms2_peaks)
         if type(self.store) is dict:
             self.store = _StoreData(**self.store)
+        if type(self.data_access) is dict:
+            self.data_access = _DiaDataAccess(**self.data_access)
 
 
     # --- static methods ---
@@ -10,10 +10,12 @@ import unittest
 
 from lipidimea.test.msms.dda import AllTestsDda
 from lipidimea.test.msms.dia import AllTestsDia
+from lipidimea.test.msms._peaks import AllTestsPeaks
 
 # collect tests
 AllTests = unittest.TestSuite()
 AllTests.addTests([
     AllTestsDda,
-    AllTestsDia
+    AllTestsDia,
+    AllTestsPeaks
 ])
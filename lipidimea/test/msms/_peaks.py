@@ -0,0 +1,141 @@
+"""
+lipidimea/test/msms/_peaks.py
+
+Dylan Ross (dylan.ross@pnnl.gov)
+
+    tests for the lipidimea/msms/_peaks.py module
+"""
+
+
+import unittest
+
+import numpy as np
+from mzapy.peaks import _gauss, calc_gauss_psnr, find_peaks_1d_localmax
+
+from lipidimea.msms._peaks import pad_traces, find_peaks_gauss_padded, fit_traces, find_peaks_localmax_sparse
+from lipidimea.params import DdaParams
+
+
+def _mock_traces(n, seed):
+    """ make some traces with different lengths containing 0-3 well separated peaks and a bit of noise """
+    rng = np.random.default_rng(seed)
+    traces, expected = [], []
+    for _ in range(n):
+        x = np.arange(10., rng.uniform(14.5, 16.), 0.01)
+        y = rng.normal(0, 100, len(x)).clip(0)
+        peaks = []
+        for rt in rng.choice([11., 12.5, 14.], rng.integers(0, 4), replace=False):
+            ht, wt = rng.uniform(1e5, 1e6), rng.uniform(0.1, 0.3)
+            y += _gauss(x, rt, ht, wt)
+            peaks.append((rt, ht, wt))
+        traces.append((x, y))
+        expected.append(sorted(peaks))
+    return traces, expected
+
+
+class TestPadTraces(unittest.TestCase):
+    """ tests for the pad_traces function """
+
+    def test_different_lengths(self):
+        """ pad traces with different lengths """
+        X, Y, M = pad_traces([(np.array([1., 2.]), np.array([3., 4.])), (np.array([5.]), np.array([6.]))])
+        self.assertEqual(X.shape, (2, 2))
+        self.assertListEqual(M.tolist(), [[True, True], [True, False]])
+        self.assertListEqual(Y[M].tolist(), [3., 4., 6.])
+
+
+class TestFindPeaksGaussPadded(unittest.TestCase):
+    """ tests for the find_peaks_gauss_padded function """
+
+    def test_mock_traces(self):
+        """ fit a batch of traces and make sure the expected peaks are found """
+        traces, expected = _mock_traces(50, 420)
+        means, heights, fwhms, psnrs = find_peaks_gauss_padded(*pad_traces(traces), 0.05, 1e4, 0.05, 0.5, 3)
+        for i, exp_peaks in enumerate(expected):
+            found = ~np.isnan(means[i])
+            self.assertEqual(found.sum(), len(exp_peaks))
+            for (rt, ht, wt), pk in zip(exp_peaks, sorted(zip(means[i][found], heights[i][found], fwhms[i][found]))):
+                self.assertAlmostEqual(pk[0], rt, places=2)
+                self.assertLess(abs(pk[1] - ht) / ht, 0.01)
+                self.assertAlmostEqual(pk[2], wt, places=2)
+            # pSNR should be the same as computed by mzapy
+            for pkparams, psnr in zip(zip(means[i][found], heights[i][found], fwhms[i][found]), psnrs[i][found]):
+                self.assertAlmostEqual(psnr, calc_gauss_psnr(*traces[i], pkparams))
+
+    def test_empty_traces(self):
+        """ traces that are all zeros or all padding do not have peaks """
+        X, Y, M = pad_traces([(np.arange(10.), np.zeros(10)), (np.arange(5.), np.ones(5) * 1e5)])
+        M[1] = False
+        means, *_ = find_peaks_gauss_padded(X, Y, M, 0.05, 1e4, 0.5, 5, 3)
+        self.assertTrue(np.all(np.isnan(means)))
+
+
+class TestFitTraces(unittest.TestCase):
+    """ tests for the fit_traces function """
+
+    def test_engines_agree(self):
+        """ the mzapy and batch engines should find the same peaks in well behaved traces """
+        traces, _ = _mock_traces(20, 69)
+        params = DdaParams.load_default().extract_and_fit_chroms
+        params.fit_engine = "mzapy"
+        peaks_mzapy = fit_traces(traces, params)
+        params.fit_engine = "batch"
+        peaks_batch = fit_traces(traces, params, batch_size=7)
+        for pk_mzapy, pk_batch in zip(peaks_mzapy, peaks_batch):
+            for a, b in zip(pk_mzapy, pk_batch):
+                self.assertEqual(len(a), len(b))
+                np.testing.assert_allclose(a, b, rtol=1e-3)
+
+    def test_bad_engine(self):
+        """ an unrecognized fit engine should cause a ValueError """
+        params = DdaParams.load_default().extract_and_fit_chroms
+        params.fit_engine = "not a fit engine"
+        with self.assertRaises(ValueError):
+            _ = fit_traces([], params)
+
+
+class TestFindPeaksLocalmaxSparse(unittest.TestCase):
+    """ tests for the find_peaks_localmax_sparse function """
+
+    def test_matches_dense(self):
+        """ peaks found in sparse spectra should be the same as in the equivalent dense spectra """
+        rng = np.random.default_rng(420)
+        for _ in range(100):
+            mz_max, mz_bin_size = rng.uniform(300, 900), rng.choice([0.01, 0.05])
+            n_bins = int((mz_max - 50.) / mz_bin_size) + 1
+            mz_bins = np.linspace(50., mz_max, n_bins)
+            # a bunch of narrow peaks with some scattered noise points
+            i_bins = np.zeros(n_bins)
+            for c in rng.integers(0, n_bins, size=rng.integers(0, 40)):
+                sl = slice(max(c - 5, 0), c + 6)
+                i_bins[sl] += _gauss(mz_bins[sl], mz_bins[c], rng.uniform(1e2, 1e5), rng.uniform(0.02, 0.2))
+            i_bins[rng.integers(0, n_bins, size=50)] += rng.uniform(0, 5e3, size=50)
+            params = (0.05, 1e3, 0.02, 0.2, rng.choice([0.05, 0.2, 1.]))
+            exp_mzs, exp_hts, exp_wts = find_peaks_1d_localmax(mz_bins, i_bins, *params)
+            bin_idx = np.nonzero(i_bins)[0]
+            mzs, hts, wts = find_peaks_localmax_sparse(bin_idx, i_bins[bin_idx], n_bins, 50., mz_max, *params)
+            np.testing.assert_array_equal(mzs, exp_mzs)
+            np.testing.assert_array_equal(hts, exp_hts)
+            np.testing.assert_allclose(wts, exp_wts, rtol=1e-9)
+
+    def test_empty(self):
+        """ no occupied bins, no peaks """
+        mzs, hts, wts = find_peaks_localmax_sparse(np.array([], dtype=np.int64), np.array([]), 1000, 
+                                                   50., 100., 0.05, 1e3, 0.02, 0.2, 0.2)
+        self.assertEqual(len(mzs), 0)
+
+
+# group all of the tests from this module into a TestSuite
+_loader = unittest.TestLoader()
+AllTestsPeaks = unittest.TestSuite()
+AllTestsPeaks.addTests([
+    _loader.loadTestsFromTestCase(TestPadTraces),
+    _loader.loadTestsFromTestCase(TestFindPeaksGaussPadded),
+    _loader.loadTestsFromTestCase(TestFitTraces),
+    _loader.loadTestsFromTestCase(TestFindPeaksLocalmaxSparse),
+])
+
+
+if __name__ == '__main__':
+    # run all defined TestCases for only this module if invoked directly
+    unittest.TextTestRunner(verbosity=2).run(AllTestsPeaks)
@@ -8,15 +8,21 @@ Dylan Ross (dylan.ross@pnnl.gov)
 
 
 import unittest
+from tempfile import TemporaryDirectory
+import os
+import sqlite3
+import multiprocessing
+import time
 
 import numpy as np
 
 from lipidimea.msms._util import (
     ms2_to_str, 
     str_to_ms2, 
-    apply_args_and_kwargs,
     ppm_from_delta_mz,
-    tol_from_ppm
+    tol_from_ppm, 
+    results_writer_process,
+    imap_unordered_with_writer
 )
 
 
@@ -92,104 +98,6 @@ class TestStrToMS2(unittest.TestCase):
             self._arrays_length_and_content_match(iis, exp_iis, "iis")
             
 
-# static return value for apply_args_and_kwargs helper functions
-_HELPER_VALUE = 420
-
-
-# trivial helper function for testing apply_args_and_kwargs function
-def _helper_no_args_no_kwargs(
-                              ) -> int:
-    """ take no args, no kwargs, always returns _HELPER_VALUE """
-    return _HELPER_VALUE
-
-
-# trivial helper function for testing apply_args_and_kwargs function
-def _helper_one_arg_no_kwargs(arg: int
-                              ) -> int:
-    """ takes one arg (an int), no kwargs, always returns _HELPER_VALUE + arg """
-    return _HELPER_VALUE + arg
-
-
-# trivial helper function for testing apply_args_and_kwargs function
-def _helper_two_args_no_kwargs(arg1: int, arg2: int
-                               ) -> int:
-    """ takes two args (ints), no kwargs, always returns _HELPER_VALUE + arg1 + arg2 """
-    return _HELPER_VALUE + arg1 + arg2
-
-
-# trivial helper function for testing apply_args_and_kwargs function
-def _helper_no_args_one_kwarg(kwarg: int = 0
-                              ) -> int:
-    """ take no args, one kwarg (int, default=0), always returns _HELPER_VALUE + kwarg """
-    return _HELPER_VALUE + kwarg
-
-
-# trivial helper function for testing apply_args_and_kwargs function
-def _helper_no_args_two_kwargs(kwarg1: int = 0, kwarg2: int = 0
-                               ) -> int:
-    """ take no args, two kwargs (ints, default=0), always returns _HELPER_VALUE + kwarg1 + kwarg2 """
-    return _HELPER_VALUE + kwarg1 + kwarg2
-
-
-# trivial helper function for testing apply_args_and_kwargs function
-def _helper_two_args_two_kwargs(arg1: int, arg2: int,
-                                kwarg1: int = 0, kwarg2: int = 0
-                                ) -> int:
-    """ 
-        take two args (ints), two kwargs (ints, default=0), 
-        always returns _HELPER_VALUE + arg1 + arg2 + kwarg1 + kwarg2 
-    """
-    return _HELPER_VALUE + arg1 + arg2 + kwarg1 + kwarg2
-
-
-class TestApplyArgsAndKwargs(unittest.TestCase):
-    """ tests for the apply_args_and_kwargs function """
-
-    def test_AAAK_no_args_no_kwargs(self):
-        """ wrap a function without args or kwargs """
-        self.assertEqual(apply_args_and_kwargs(_helper_no_args_no_kwargs, [], {}), _HELPER_VALUE,
-                         msg="did not get correct return value from wrapped function")
-    
-    def test_AAAK_one_arg_no_kwargs(self):
-        """ wrap a function with one arge and no kwargs """
-        self.assertEqual(apply_args_and_kwargs(_helper_one_arg_no_kwargs, [1], {}), _HELPER_VALUE + 1,
-                         msg="did not get correct return value from wrapped function")
-
-    def test_AAAK_two_args_no_kwargs(self):
-        """ wrap a function with two args and no kwargs """
-        self.assertEqual(apply_args_and_kwargs(_helper_two_args_no_kwargs, [1, 2], {}), _HELPER_VALUE + 3,
-                         msg="did not get correct return value from wrapped function")
-
-    def test_AAAK_no_args_one_kwarg(self):
-        """ wrap a function with no args and one kwarg """
-        self.assertEqual(apply_args_and_kwargs(_helper_no_args_one_kwarg, [], {}), _HELPER_VALUE,
-                         msg="did not get correct return value from wrapped function")
-        self.assertEqual(apply_args_and_kwargs(_helper_no_args_one_kwarg, [], {"kwarg": 1}), _HELPER_VALUE + 1,
-                         msg="did not get correct return value from wrapped function")
-
-    def test_AAAK_no_args_two_kwargs(self):
-        """ wrap a function with no args and two kwargs """
-        self.assertEqual(apply_args_and_kwargs(_helper_no_args_two_kwargs, [], {}), _HELPER_VALUE,
-                         msg="did not get correct return value from wrapped function")
-        self.assertEqual(apply_args_and_kwargs(_helper_no_args_two_kwargs, [], {"kwarg1": 1}), _HELPER_VALUE + 1,
-                         msg="did not get correct return value from wrapped function")
-        self.assertEqual(apply_args_and_kwargs(_helper_no_args_two_kwargs, [], {"kwarg2": 1}), _HELPER_VALUE + 1,
-                         msg="did not get correct return value from wrapped function")
-        self.assertEqual(apply_args_and_kwargs(_helper_no_args_two_kwargs, [], {"kwarg1": 1, "kwarg2": 2}), _HELPER_VALUE + 3,
-                         msg="did not get correct return value from wrapped function")
-
-    def test_AAAK_two_args_two_kwargs(self):
-        """ wrap a function with two args and two kwargs """
-        self.assertEqual(apply_args_and_kwargs(_helper_two_args_two_kwargs, [1, 2], {}), _HELPER_VALUE + 3,
-                         msg="did not get correct return value from wrapped function")
-        self.assertEqual(apply_args_and_kwargs(_helper_two_args_two_kwargs, [1, 2], {"kwarg1": 3}), _HELPER_VALUE + 6,
-                         msg="did not get correct return value from wrapped function")
-        self.assertEqual(apply_args_and_kwargs(_helper_two_args_two_kwargs, [1, 2], {"kwarg2": 3}), _HELPER_VALUE + 6,
-                         msg="did not get correct return value from wrapped function")
-        self.assertEqual(apply_args_and_kwargs(_helper_two_args_two_kwargs, [1, 2], {"kwarg1": 3, "kwarg2": 4}), _HELPER_VALUE + 10,
-                         msg="did not get correct return value from wrapped function")
-
-
 class TestPPMFromDeltaMz(unittest.TestCase):
     """ tests for the ppm function """
     
@@ -230,6 +138,61 @@ class TestTolFromPPM(unittest.TestCase):
                                    msg=f"with mz: {mz} ppm: {ppm}, expected tol: {exp_tol} (got tol: {tol})")
 
 
+# queue for sending results to the writer process, set in each worker by _init_worker
+_QUEUE = None
+
+
+def _init_worker(queue):
+    global _QUEUE
+    _QUEUE = queue
+
+
+def _worker(i):
+    """ sends a few big batches of results (~100 KB each) to the writer """
+    for j in range(4):
+        _QUEUE.put([(i, j, np.random.random(12500).tobytes())])
+    return i
+
+
+def _add_batch(cur, batch):
+    """ slowly adds a batch of results """
+    time.sleep(0.01)
+    cur.execute("CREATE TABLE IF NOT EXISTS Results (i INT, j INT, data BLOB)")
+    cur.executemany("INSERT INTO Results VALUES (?,?,?)", batch)
+
+
+def _add_batch_fail(cur, batch):
+    raise ValueError("writer failed")
+
+
+class TestResultsWriterProcess(unittest.TestCase):
+    """ tests for results_writer_process and imap_unordered_with_writer """
+
+    def test_all_results_written(self):
+        """ all of the results sent by the workers should make it into the database """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            with results_writer_process(dbf, _add_batch) as (queue, writer):
+                with multiprocessing.Pool(processes=4, initializer=_init_worker, initargs=(queue,)) as p:
+                    returned = sorted(imap_unordered_with_writer(p, _worker, range(16), writer))
+            self.assertListEqual(returned, list(range(16)))
+            self.assertFalse(writer.is_alive())
+            con = sqlite3.connect(dbf)
+            self.assertEqual(con.execute("SELECT COUNT(*), COUNT(DISTINCT i) FROM Results").fetchone(), (64, 16))
+            con.close()
+
+    def test_writer_fails(self):
+        """ a failed writer should raise an error rather than hanging """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            with self.assertRaises(RuntimeError):
+                with results_writer_process(dbf, _add_batch_fail) as (queue, writer):
+                    with multiprocessing.Pool(processes=4, initializer=_init_worker, initargs=(queue,)) as p:
+                        for _ in imap_unordered_with_writer(p, _worker, range(16), writer):
+                            pass
+            self.assertFalse(writer.is_alive())
+
+
 if __name__ == "__main__":
     # run the tests for this module if invoked directly
     unittest.main(verbosity=2)
@@ -13,14 +13,21 @@ import os
 import sqlite3
 
 import numpy as np
+import pandas as pd
+import h5py
 from mzapy.peaks import _gauss
+from mzapy.dda import MsmsReaderDda
 
 from lipidimea.msms.dda import (
-    _extract_and_fit_chroms, _consolidate_chrom_feats,
-    _extract_and_fit_ms2_spectra, _add_precursors_and_fragments_to_db, extract_dda_features, 
-    consolidate_dda_features
+    _MsmsReaderDdaMmapMs1, _Ms2ScanIndex, _extract_chroms, _cluster_pre_mzs, _split_pre_mzs, _group_dda_features, 
+    _ms2_trigger_rt_windows, _extract_and_fit_chroms, _consolidate_chrom_feats, _drop_isotope_chrom_feats, _extract_and_fit_ms2_spectra, 
+    _DdaFeatureTable, _insert_dda_feature_table, _add_precursors_and_fragments_to_db, _iter_feature_tables, extract_dda_features, 
+    extract_dda_features_multiproc, _init_dda_reader, 
+    _consensus_ms2_spectrum, consolidate_dda_features, _sparse_ms2_vectors, _cosine_similarity, 
+    cluster_dda_features
 )
-from lipidimea.util import create_results_db
+from lipidimea.msms._util import ppm_from_delta_mz
+from lipidimea.util import create_results_db, update_analysis_log, AnalysisStep
 from lipidimea.params import DdaParams
 
 
@@ -41,6 +48,240 @@ def _debug_cb(msg: str
 _DDA_PARAMS = DdaParams.load_default()
 
 
+def _set_mock_ms1_scans(rdr, scan_rts, scan_mzs, scan_iis):
+    """ 
+    helper that sets up MS1 scan data (RT, m/z array, intensity array for each scan) on a 
+    mocked reader object, the attributes are laid out the same way as in ``MsmsReaderDda``
+    """
+    scans = np.arange(1, len(scan_rts) + 1)
+    mz_full = np.unique(np.concatenate(scan_mzs))
+    rdr.ms1_scans = scans
+    rdr.metadata = pd.DataFrame({"MSLevel": 1, 
+                                 "RetentionTime": scan_rts, 
+                                 "PrecursorScan": 0, 
+                                 "PrecursorMonoisotopicMz": 0.}, 
+                                index=scans)
+    rdr.mz_full = mz_full
+    rdr.arrays_mz = pd.DataFrame({"Data": [np.searchsorted(mz_full, smz) for smz in scan_mzs]}, index=scans)
+    rdr.arrays_i = pd.DataFrame({"Data": list(scan_iis)}, index=scans)
+
+
+def _set_mock_xic(rdr, pre_mz, xic_rts, xic_iis):
+    """ helper that sets up MS1 scan data on a mocked reader so that the XIC for pre_mz is xic_rts, xic_iis """
+    _set_mock_ms1_scans(rdr, xic_rts, [np.array([pre_mz]) for _ in xic_rts], [np.array([i]) for i in xic_iis])
+
+
+def _add_mock_ms2_scans(rdr, pre_mz, pre_rt, ms2_mzs, ms2_iis, n_scans):
+    """ 
+    helper that adds n_scans MS2 scans for pre_mz to a reader with mocked MS1 scan data (see 
+    ``_set_mock_ms1_scans``), triggered from the MS1 scan closest to pre_rt, that add up to the 
+    spectrum ms2_mzs, ms2_iis
+    """
+    md = rdr.metadata
+    pre_scan = md.index[np.argmin(np.abs(md["RetentionTime"].to_numpy() - pre_rt))]
+    scans = np.arange(md.index.max() + 1, md.index.max() + 1 + n_scans)
+    rdr.metadata = pd.concat([md, pd.DataFrame({"MSLevel": 2, 
+                                                "RetentionTime": md.loc[pre_scan, "RetentionTime"], 
+                                                "PrecursorScan": pre_scan, 
+                                                "PrecursorMonoisotopicMz": pre_mz}, 
+                                               index=scans)])
+    # MS2 m/zs go at the end of the full m/z array so the MS1 m/z bin indices stay the same
+    mzbins = np.arange(len(rdr.mz_full), len(rdr.mz_full) + len(ms2_mzs))
+    rdr.mz_full = np.concatenate([rdr.mz_full, ms2_mzs])
+    rdr.arrays_mz = pd.concat([rdr.arrays_mz, pd.DataFrame({"Data": [mzbins] * n_scans}, index=scans)])
+    rdr.arrays_i = pd.concat([rdr.arrays_i, pd.DataFrame({"Data": [ms2_iis / n_scans] * n_scans}, index=scans)])
+
+
+def _write_mock_dda_mza(mza_file, mz_full, scans):
+    """ 
+    helper that writes a minimal DDA data file (MZA format) with just enough in it for 
+    ``MsmsReaderDda`` to be able to read it, scans is a list of tuples with: 
+    (scan, MS level, RT, precursor scan, precursor m/z, m/z bin indices, intensities)
+    """
+    metadata = np.array(
+        [(scan, lvl, rt, pre_scan, pre_mz) for scan, lvl, rt, pre_scan, pre_mz, *_ in scans],
+        dtype=[("Scan", np.int64), ("MSLevel", np.int64), ("RetentionTime", np.float64), 
+               ("PrecursorScan", np.int64), ("PrecursorMonoisotopicMz", np.float64)]
+    )
+    with h5py.File(mza_file, "w") as h5:
+        h5.create_dataset("Metadata", data=metadata)
+        h5.create_dataset("Full_mz_array", data=mz_full)
+        for scan, *_, mzbins, iis in scans:
+            h5.create_dataset(f"Arrays_mzbin/{scan}", data=mzbins)
+            h5.create_dataset(f"Arrays_intensity/{scan}", data=iis)
+
+
+# (m/z, RT) of precursors in the mock DDA data file made by _write_mock_dda_data
+_MOCK_DDA_TARGETS = [(600.5, 12.), (700.25, 13.), (800.75, 14.), (850.1, 12.5)]
+
+
+def _write_mock_dda_data(mza_file):
+    """ 
+    helper that writes a small but complete mock DDA data file (MZA format) with MS1 scans every 
+    0.01 min from 10-16 min, a chromatographic peak for each of the precursors in _MOCK_DDA_TARGETS
+    and MS2 scans with a few fragments for each precursor across the top of its chromatographic peak
+    """
+    rng = np.random.default_rng(420)
+    frag_mzs = [184.0733, 264.2686, 313.2737]
+    mz_full = np.unique([_[0] for _ in _MOCK_DDA_TARGETS] + [_[0] + 1.00336 for _ in _MOCK_DDA_TARGETS] 
+                        + [650., 750.] + frag_mzs)
+    target_bins = np.searchsorted(mz_full, [_[0] for _ in _MOCK_DDA_TARGETS])
+    noise_bins = np.searchsorted(mz_full, [650., 750.])
+    frag_bins = np.searchsorted(mz_full, frag_mzs)
+    scans = []
+    scan = 1
+    for i, rt in enumerate(np.arange(10, 16, 0.01)):
+        # MS1 scan
+        iis = [_gauss(rt, trt, 1e5, 0.25) * rng.normal(1, 0.05) + 1e3 * rng.normal(1, 0.2) 
+               for _, trt in _MOCK_DDA_TARGETS]
+        scans.append((scan, 1, rt, 0, 0., np.concatenate([target_bins, noise_bins]), 
+                      np.abs(np.concatenate([iis, rng.normal(1e3, 100, size=2)]))))
+        ms1_scan = scan
+        scan += 1
+        # MS2 scans every 5th MS1 scan, for precursors that are close to their peak RT 
+        if i % 5 == 0:
+            for tmz, trt in _MOCK_DDA_TARGETS:
+                if abs(rt - trt) <= 0.2:
+                    scans.append((scan, 2, rt + 0.001, ms1_scan, tmz, frag_bins, np.array([1e4, 5e3, 2e4])))
+                    scan += 1
+    _write_mock_dda_mza(mza_file, mz_full, scans)
+
+
+class Test_MsmsReaderDdaMmapMs1(unittest.TestCase):
+    """ tests for the _MsmsReaderDdaMmapMs1 class """
+
+    def test_cache_matches_mza(self):
+        """ build the MS1 cache from a small MZA file and make sure the cached data matches """
+        rng = np.random.default_rng(420)
+        mz_full = np.linspace(700, 710, 1001)
+        scans = []
+        for scan in range(1, 21):
+            # every 4th scan is MS2 
+            lvl = 2 if scan % 4 == 0 else 1
+            mzbins = rng.choice(len(mz_full), size=50, replace=False)
+            scans.append((scan, lvl, 0.1 * scan, 0 if lvl == 1 else scan - 1, 0. if lvl == 1 else 705., 
+                          mzbins, rng.uniform(0, 1e4, size=50)))
+        with TemporaryDirectory() as tmp_dir:
+            mza_file = os.path.join(tmp_dir, "dda.mza")
+            _write_mock_dda_mza(mza_file, mz_full, scans)
+            rdr = _MsmsReaderDdaMmapMs1(mza_file)
+            self.assertTrue(os.path.isfile(mza_file + ".ms1_cache"))
+            # cached data should match what is in the MZA file (m/z sorted within each scan)
+            cached = list(rdr.iter_ms1_scans())
+            ms1_scans = [_ for _ in scans if _[1] == 1]
+            self.assertEqual(len(cached), len(ms1_scans))
+            for (rt, smz, sin), (_, _, ert, _, _, embins, eis) in zip(cached, ms1_scans):
+                srt = np.argsort(mz_full[embins])
+                self.assertAlmostEqual(rt, ert)
+                np.testing.assert_allclose(smz, mz_full[embins][srt], rtol=1e-6)
+                np.testing.assert_allclose(sin, eis[srt], rtol=1e-6)
+            # chromatograms should match the uncached reader
+            chrom = rdr.get_chrom(705., 0.5)
+            rdr.close()
+            # re-opening with some scans dropped should reuse the existing cache file 
+            mtime = os.path.getmtime(mza_file + ".ms1_cache")
+            rdr = _MsmsReaderDdaMmapMs1(mza_file, drop_scans=[1, 2])
+            self.assertEqual(os.path.getmtime(mza_file + ".ms1_cache"), mtime)
+            self.assertEqual(len(list(rdr.iter_ms1_scans())), len(ms1_scans) - 2)
+            rdr.close()
+            rdr = MsmsReaderDda(mza_file)
+            expected_chrom = rdr.get_chrom(705., 0.5)
+            rdr.close()
+        np.testing.assert_allclose(chrom, expected_chrom, rtol=1e-5)
+
+    def test_cache_not_writable(self):
+        """ if the MS1 cache cannot be written, fall back to the uncached reader and clean up """
+        rng = np.random.default_rng(420)
+        mz_full = np.linspace(700, 710, 1001)
+        scans = [
+            (scan, 1, 0.1 * scan, 0, 0., 
+             rng.choice(len(mz_full), size=50, replace=False), rng.uniform(0, 1e4, size=50))
+            for scan in range(1, 11)
+        ]
+        with TemporaryDirectory() as tmp_dir:
+            mza_file = os.path.join(tmp_dir, "dda.mza")
+            _write_mock_dda_mza(mza_file, mz_full, scans)
+            with patch('lipidimea.msms.dda.os.replace', side_effect=PermissionError("read-only")):
+                with self.assertRaises(PermissionError):
+                    _MsmsReaderDdaMmapMs1(mza_file)
+                # the partially written cache file should not be left behind
+                self.assertListEqual(os.listdir(tmp_dir), ["dda.mza"])
+                global _DEBUG_MSGS
+                _DEBUG_MSGS = []
+                rdr = _init_dda_reader(mza_file, True, None, "textcb", _debug_cb)
+            self.assertNotIsInstance(rdr, _MsmsReaderDdaMmapMs1)
+            self.assertEqual(len(_DEBUG_MSGS), 1)
+            self.assertEqual(len(list(rdr.get_chrom(705., 0.5)[0])), 10)
+            rdr.close()
+            self.assertListEqual(os.listdir(tmp_dir), ["dda.mza"])
+
+
+class Test_ExtractChroms(unittest.TestCase):
+    """ tests for the _extract_chroms function """
+
+    def test_matches_single_target_extraction(self):
+        """ chromatograms extracted in one pass should match extracting them one at a time """
+        rng = np.random.default_rng(420)
+        scan_rts = np.arange(0, 5, 0.1)
+        # random (unsorted) scan data with peaks scattered around a few target m/zs
+        scan_mzs = [rng.uniform(700, 710, size=250) for _ in scan_rts]
+        scan_iis = [rng.uniform(0, 1e4, size=250) for _ in scan_rts]
+        pre_mzs = np.array([700.5, 701.5, 701.50002, 705.25, 709.9])
+        with patch('mzapy.dda.MsmsReaderDda') as MockReader:
+            rdr = MockReader.return_value
+            _set_mock_ms1_scans(rdr, scan_rts, scan_mzs, scan_iis)
+            chrom_rts, chrom_ins = _extract_chroms(rdr, pre_mzs, 40.)
+        self.assertEqual(chrom_ins.shape, (len(pre_mzs), len(scan_rts)))
+        np.testing.assert_allclose(chrom_rts, scan_rts)
+        for pre_mz, ins in zip(pre_mzs, chrom_ins):
+            mz_tol = pre_mz * 40. / 1e6
+            expected = [
+                np.sum(sin[(smz >= pre_mz - mz_tol) & (smz <= pre_mz + mz_tol)]) 
+                for smz, sin in zip(scan_mzs, scan_iis)
+            ]
+            np.testing.assert_allclose(ins, expected)
+
+    def test_scan_mask(self):
+        """ scans excluded by the scan mask should have 0 intensity, the rest should be unaffected """
+        rng = np.random.default_rng(420)
+        scan_rts = np.arange(0, 5, 0.1)
+        scan_mzs = [rng.uniform(700, 710, size=250) for _ in scan_rts]
+        scan_iis = [rng.uniform(0, 1e4, size=250) for _ in scan_rts]
+        pre_mzs = np.array([700.5, 705.25, 709.9])
+        scan_mask = rng.uniform(size=len(scan_rts)) > 0.5
+        with patch('mzapy.dda.MsmsReaderDda') as MockReader:
+            rdr = MockReader.return_value
+            _set_mock_ms1_scans(rdr, scan_rts, scan_mzs, scan_iis)
+            _, full_ins = _extract_chroms(rdr, pre_mzs, 40.)
+            chrom_rts, masked_ins = _extract_chroms(rdr, pre_mzs, 40., scan_mask=scan_mask)
+        np.testing.assert_allclose(chrom_rts, scan_rts)
+        np.testing.assert_allclose(masked_ins[:, scan_mask], full_ins[:, scan_mask])
+        self.assertTrue(np.all(masked_ins[:, ~scan_mask] == 0))
+
+
+class Test_Ms2TriggerRtWindows(unittest.TestCase):
+    """ tests for the _ms2_trigger_rt_windows function """
+
+    def test_windows(self):
+        """ windows should cover the MS1 scans within rt_tol of the MS2 scans for each precursor m/z """
+        scan_rts = np.arange(0, 10, 0.5)
+        with patch('mzapy.dda.MsmsReaderDda') as MockReader:
+            rdr = MockReader.return_value
+            rdr.ms2_scans = np.array([1, 2, 3, 4])
+            rdr.metadata = pd.DataFrame({
+                "RetentionTime": [2., 2.2, 7., 5.], 
+                "PrecursorMonoisotopicMz": [700.5, 700.5, 700.5, 800.25]
+            }, index=rdr.ms2_scans)
+            windows = _ms2_trigger_rt_windows(rdr, np.array([700.5, 800.25, 900.]), scan_rts, 1.)
+        self.assertEqual(windows.shape, (3, len(scan_rts)))
+        for pre_mz, win in zip([700.5, 800.25], windows):
+            trig_rts = rdr.metadata.loc[rdr.metadata["PrecursorMonoisotopicMz"] == pre_mz, "RetentionTime"]
+            expected = [any(abs(rt - trt) <= 1. for trt in trig_rts) for rt in scan_rts]
+            self.assertListEqual(win.tolist(), expected)
+        # no MS2 scans for this precursor m/z
+        self.assertFalse(windows[2].any())
+
+
 class Test_ExtractAndFitChroms(unittest.TestCase):
     """ tests for the _extract_and_fit_chroms function """
 
@@ -51,10 +292,10 @@ class Test_ExtractAndFitChroms(unittest.TestCase):
         xic_rts = np.arange(0, 20.05, 0.01)
         noise1 = np.random.normal(1, 0.2, size=xic_rts.shape)
         xic_iis = 1000 * noise1 
-        # mock a _MSMSReaderDDA instance with get_chrom method that returns the fake XIC 
+        # mock a _MSMSReaderDDA instance with MS1 scan data that produce the fake XIC 
         with patch('mzapy.dda.MsmsReaderDda') as MockReader:
             rdr = MockReader.return_value
-            rdr.get_chrom.return_value = (xic_rts, xic_iis)
+            _set_mock_xic(rdr, 789.0123, xic_rts, xic_iis)
             # use a helper callback function to store instead of printing debugging messages
             global _DEBUG_MSGS
             _DEBUG_MSGS = []
@@ -84,10 +325,10 @@ class Test_ExtractAndFitChroms(unittest.TestCase):
             (789.0123, 15., 1e5, 0.25, 15.6),
             (789.0123, 14.25, 5e4, 0.4, 5),
         ]
-        # mock a _MSMSReaderDDA instance with get_chrom method that returns the fake XIC 
+        # mock a _MSMSReaderDDA instance with MS1 scan data that produce the fake XIC 
         with patch('mzapy.dda.MsmsReaderDda') as MockReader:
             rdr = MockReader.return_value
-            rdr.get_chrom.return_value = (xic_rts, xic_iis)
+            _set_mock_xic(rdr, 789.0123, xic_rts, xic_iis)
             # use a helper callback function to store instead of printing debugging messages
             global _DEBUG_MSGS
             _DEBUG_MSGS = []
@@ -149,6 +390,96 @@ class Test_ConsolidateChromFeats(unittest.TestCase):
             self.assertAlmostEqual(frt, efrt, places=2)
             self.assertLess(abs(fht - efht) / efht, 0.1)      
 
+    def test_matches_pairwise_consolidation(self):
+        """ consolidate many random features and compare against a simple pairwise implementation """
+        def pairwise(feats, mz_ppm, rt_tol):
+            cons = []
+            for feat in feats:
+                add = True
+                for i in range(len(cons)):
+                    fc_i = cons[i]
+                    if ppm_from_delta_mz(abs(feat[0] - fc_i[0]), fc_i[0]) <= mz_ppm and abs(feat[1] - fc_i[1]) <= rt_tol:
+                        add = False
+                        if feat[2] > fc_i[2]:
+                            cons[i] = feat
+                if add:
+                    cons.append(feat)
+            return cons
+        rng = np.random.default_rng(420)
+        # a few m/z and RT centers with lots of jitter so that there are plenty of overlapping groups
+        mzs = rng.choice(rng.uniform(600, 900, 40), 2000) * (1 + rng.normal(0, 20e-6, 2000))
+        rts = rng.choice(rng.uniform(5, 20, 10), 2000) + rng.normal(0, 0.2, 2000)
+        features = [(mz, rt, ht, 0.25, 10.) for mz, rt, ht in zip(mzs, rts, rng.uniform(1e3, 1e6, 2000))]
+        P = _DDA_PARAMS.consolidate_chrom_feats
+        expected_features = pairwise(features, P.mz_ppm, P.rt_tol)
+        cons_features = _consolidate_chrom_feats(features, _DDA_PARAMS, None, None)
+        self.assertLess(len(cons_features), len(features))
+        self.assertListEqual(cons_features, expected_features)
+
+
+class Test_DropIsotopeChromFeats(unittest.TestCase):
+    """ tests for the _drop_isotope_chrom_feats function """
+
+    def test_isotopes_dropped(self):
+        """ M+1 and M+2 isotopes should get dropped, everything else kept in the same order """
+        chrom_feats = [
+            # M+2 of the first feature, only 0.1 min off (within default rt_tol)
+            (700.5 + 2 * 1.00336, 12.1, 2e4, 0.2, 10.),
+            # monoisotopic
+            (700.5, 12., 1e5, 0.2, 20.),
+            # M+1 (with a bit of m/z error)
+            (700.5 + 1.00336 + 0.005, 12., 4e4, 0.2, 15.),
+            # right m/z for M+1 but does not co-elute
+            (701.50336, 14., 5e4, 0.2, 15.),
+            # right m/z and RT for M+1 but more intense than the monoisotopic feature
+            (800.25, 13., 1e5, 0.2, 20.),
+            (801.25336, 13., 2e5, 0.2, 20.),
+            # unrelated
+            (900., 12., 1e4, 0.2, 10.),
+        ]
+        global _DEBUG_MSGS
+        _DEBUG_MSGS = []
+        kept = _drop_isotope_chrom_feats(chrom_feats, _DDA_PARAMS, "textcb", _debug_cb)
+        self.assertListEqual(kept, [chrom_feats[i] for i in [1, 3, 4, 5, 6]])
+        self.assertEqual(len(_DEBUG_MSGS), 1)
+        self.assertIn("7 features -> 5 features", _DEBUG_MSGS[0])
+
+    def test_no_feats(self):
+        """ no chromatographic features in, none out """
+        self.assertListEqual(_drop_isotope_chrom_feats([], _DDA_PARAMS, None, None), [])
+
+
+class Test_Ms2ScanIndex(unittest.TestCase):
+    """ tests for the _Ms2ScanIndex class """
+
+    def test_matches_reader(self):
+        """ sparse spectra from the index should match the dense spectra from MsmsReaderDda.get_msms_spectrum """
+        with TemporaryDirectory() as tmp_dir:
+            mza_file = os.path.join(tmp_dir, "dda.mza")
+            _write_mock_dda_data(mza_file)
+            rdr = MsmsReaderDda(mza_file)
+            idx = _Ms2ScanIndex(rdr)
+            queries = [
+                (tmz, tmz * 40e-6, trt - rt_win, trt + rt_win) 
+                for tmz, trt in _MOCK_DDA_TARGETS for rt_win in [0.05, 0.1, 1.]
+            ] + [
+                # no MS2 scans
+                (650., 0.03, 10., 16.),
+                # everything
+                (725., 200., 0., 20.),
+            ]
+            for query in queries:
+                exp_mzs, exp_iis, exp_n, exp_pre_mzs = rdr.get_msms_spectrum(*query, 50., query[0] + 5, 0.05)
+                # sparse spectrum should have the same values in the occupied bins and nothing anywhere else
+                bin_idx, bin_i, n_bins, n, pre_mzs = idx.get_sparse_msms_spectrum(*query, 50., query[0] + 5, 0.05)
+                self.assertEqual(n_bins, len(exp_mzs))
+                np.testing.assert_array_equal(np.linspace(50., query[0] + 5, n_bins), exp_mzs)
+                self.assertEqual(n, exp_n)
+                self.assertListEqual(pre_mzs, exp_pre_mzs)
+                np.testing.assert_array_equal(bin_i, exp_iis[bin_idx])
+                self.assertTrue(np.all(np.delete(exp_iis, bin_idx) == 0))
+            rdr.close()
+
 
 class Test_ExtractAndFitMs2Spectra(unittest.TestCase):
     """ tests for the _extract_and_fit_ms2_spectra function """
@@ -157,17 +488,18 @@ class Test_ExtractAndFitMs2Spectra(unittest.TestCase):
         """ test extracting and fitting spectrum from noisy signal with no peaks in it """
         # make a fake XIC with no peaks
         np.random.seed(420)
-        ms2_mzs = np.arange(50, 800, 0.01)
+        ms2_mzs = np.arange(50, 800, 0.05)
         noise1 = np.random.normal(1, 0.2, size=ms2_mzs.shape)
         ms2_iis = 1000 * noise1 
         # consolidated features
         cons_feats = [
             (789.0123, 10.03, 1e5, 0.25, 10.),
         ]
-        # mock a _MSMSReaderDDA instance with get_msms_spectrum method that returns the fake spectrum
+        # mock a _MSMSReaderDDA instance with 3 MS2 scans for the feature that add up to the fake spectrum
         with patch('mzapy.dda.MsmsReaderDda') as MockReader:
             rdr = MockReader.return_value
-            rdr.get_msms_spectrum.return_value = (ms2_mzs, ms2_iis, 3, [789.0123, 789.0123, 789.0123])
+            _set_mock_xic(rdr, 789.0123, [10.03], [1e5])
+            _add_mock_ms2_scans(rdr, 789.0123, 10.03, ms2_mzs, ms2_iis, 3)
             # use a helper callback function to store instead of printing debugging messages
             global _DEBUG_MSGS
             _DEBUG_MSGS = []
@@ -187,7 +519,7 @@ class Test_ExtractAndFitMs2Spectra(unittest.TestCase):
         """ test extracting and fitting MS2 spectrum with peaks in it """
         # make a fake spectrum with peaks
         np.random.seed(420)
-        ms2_mzs = np.arange(50, 800, 0.01)
+        ms2_mzs = np.arange(50, 800, 0.05)
         noise1 = np.random.normal(1, 0.2, size=ms2_mzs.shape)
         ms2_iis = 1000 * noise1 
         noise2 = np.random.normal(1, 0.1, size=ms2_mzs.shape)
@@ -202,10 +534,11 @@ class Test_ExtractAndFitMs2Spectra(unittest.TestCase):
         cons_feats = [
             (789.0123, 10.03, 1e5, 0.25, 10.),
         ]
-        # mock a _MSMSReaderDDA instance with get_msms_spectrum method that returns the fake spectrum
+        # mock a _MSMSReaderDDA instance with 3 MS2 scans for the feature that add up to the fake spectrum
         with patch('mzapy.dda.MsmsReaderDda') as MockReader:
             rdr = MockReader.return_value
-            rdr.get_msms_spectrum.return_value = (ms2_mzs, ms2_iis, 3, [789.0123, 789.0123, 789.0123])
+            _set_mock_xic(rdr, 789.0123, [10.03], [1e5])
+            _add_mock_ms2_scans(rdr, 789.0123, 10.03, ms2_mzs, ms2_iis, 3)
             # use a helper callback function to store instead of printing debugging messages
             global _DEBUG_MSGS
             _DEBUG_MSGS = []
@@ -234,6 +567,40 @@ class Test_ExtractAndFitMs2Spectra(unittest.TestCase):
             self.assertIn("# MS2 peaks: 28", _DEBUG_MSGS[1])
 
 
+class Test_DdaFeatureTable(unittest.TestCase):
+    """ tests for the _DdaFeatureTable class """
+
+    def test_round_trip(self):
+        """ features should come back out of the table the same as they went in """
+        features = [
+            ((None, 69, 789.0123, 12.34, 0.12, 1.23e4, 10., 3, 3), 
+             np.array([[123.456, 234.567, 345.678], [1e3, 2e3, 3e3]])),
+            ((None, 69, 789.0123, 12.34, 0.12, 1.23e4, 10., 3, 0), None),
+            ((None, 69, 789.0123, 12.34, 0.12, 1.23e4, 10., 0, None), None),
+            ((None, 69, 800.5, 13.5, 0.2, 4.56e5, 20., 5, 1), np.array([[184.0733], [5e4]])),
+        ]
+        table = _DdaFeatureTable.from_features(features)
+        self.assertEqual(len(table), 4)
+        self.assertListEqual(table.offsets.tolist(), [0, 3, 3, 3, 4])
+        for (pre_in, spec_in), (pre_out, spec_out) in zip(features, table):
+            self.assertTupleEqual(pre_in, pre_out)
+            if spec_in is None:
+                self.assertIsNone(spec_out)
+            else:
+                np.testing.assert_array_equal(spec_in, spec_out)
+        self.assertListEqual(
+            list(table.fragment_rows(10)), 
+            [(None, 10, 123.456, 1e3), (None, 10, 234.567, 2e3), (None, 10, 345.678, 3e3), (None, 13, 184.0733, 5e4)]
+        )
+
+    def test_empty(self):
+        """ a table with no features """
+        table = _DdaFeatureTable.from_features([])
+        self.assertEqual(len(table), 0)
+        self.assertListEqual(list(table), [])
+        self.assertListEqual(list(table.fragment_rows(1)), [])
+
+
 class Test_AddPrecursorsAndFragmentsToDb(unittest.TestCase):
     """ 
         tests for the _add_precursors_to_db function, 
@@ -260,6 +627,8 @@ class Test_AddPrecursorsAndFragmentsToDb(unittest.TestCase):
             # test the function
             _add_precursors_and_fragments_to_db(cur, precursors, spectra, 
                                                 debug_flag="textcb", debug_cb=_debug_cb)
+            # committing is up to the caller
+            self.assertTrue(con.in_transaction)
             # make sure values in = values out 
             # exept for the first value which is an ID 
             # that is generated when the data gets inserted
@@ -322,6 +691,84 @@ class Test_AddPrecursorsAndFragmentsToDb(unittest.TestCase):
             self.assertListEqual(values_in, values_out)
 
 
+class Test_InsertDdaFeatureTable(unittest.TestCase):
+    """ tests for the _insert_dda_feature_table function """
+
+    def test_caller_owns_commit(self):
+        """ the inserts should go into the transaction the caller has open, without committing it """
+        table = _DdaFeatureTable.from_features([
+            ((None, 69, 789.0123, 12.34, 0.12, 1.23e4, 10., 3, 2), np.array([[123.456, 234.567], [1e3, 2e3]])),
+            ((None, 69, 800.5, 13.5, 0.2, 4.56e5, 20., 0, None), None),
+        ])
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)  # STRICT!
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            other = sqlite3.connect(dbf)
+            # the caller already has a transaction open
+            cur.execute("INSERT INTO DDAPrecursors VALUES (?,?,?,?,?,?,?,?,?)", 
+                        (None, 69, 600., 12.34, 0.12, 1.23e4, 10., 0, None))
+            _insert_dda_feature_table(cur, table)
+            self.assertTrue(con.in_transaction)
+            self.assertEqual(other.execute("SELECT COUNT(*) FROM DDAPrecursors").fetchone()[0], 0)
+            # rolling back gets rid of everything, including what the caller added
+            con.rollback()
+            self.assertEqual(cur.execute("SELECT COUNT(*) FROM DDAPrecursors").fetchone()[0], 0)
+            # with no transaction open, one gets started and stays open for the caller to commit
+            _insert_dda_feature_table(cur, table)
+            self.assertTrue(con.in_transaction)
+            con.commit()
+            self.assertListEqual(
+                other.execute("SELECT dda_pre_id, mz FROM DDAPrecursors ORDER BY dda_pre_id").fetchall(), 
+                [(1, 789.0123), (2, 800.5)]
+            )
+            self.assertListEqual(
+                other.execute("SELECT dda_pre_id, fmz FROM DDAFragments ORDER BY fmz").fetchall(), 
+                [(1, 123.456), (1, 234.567)]
+            )
+            other.close()
+            con.close()
+
+
+class Test_IterFeatureTables(unittest.TestCase):
+    """ tests for the _iter_feature_tables function """
+
+    def test_chunked_fragments_linked(self):
+        """ write features in several tables and make sure the fragments point to the right precursors """
+        def features():
+            for k in range(25):
+                pre = (None, 69, 700. + k, 12.34, 0.12, 1.23e4, 10., 1, k % 4 or None)
+                spec = np.array([[100. + k] * (k % 4), [1e3] * (k % 4)]) if k % 4 else None
+                yield pre, spec
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)  # STRICT!
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            # there is already a precursor in the database
+            _add_precursors_and_fragments_to_db(cur, [(None, 69, 600., 12.34, 0.12, 1.23e4, 10., 0, None)], 
+                                                [None], None, None)
+            # test the function
+            tables = list(_iter_feature_tables(features(), chunk_size=4))
+            self.assertListEqual([len(table) for table in tables], [4, 4, 4, 4, 4, 4, 1])
+            for table in tables:
+                _insert_dda_feature_table(cur, table)
+            con.commit()
+            self.assertEqual(cur.execute("SELECT COUNT(*) FROM DDAPrecursors").fetchone()[0], 26)
+            qry = """
+                SELECT p.mz, f.fmz, p.ms2_n_peaks FROM DDAFragments AS f JOIN DDAPrecursors AS p USING(dda_pre_id)
+            """
+            n_frags = 0
+            for pmz, fmz, n_peaks in cur.execute(qry).fetchall():
+                n_frags += 1
+                # fragment m/z was set to the precursor m/z - 600
+                self.assertAlmostEqual(pmz - fmz, 600.)
+                self.assertGreater(n_peaks, 0)
+            self.assertEqual(n_frags, sum([k % 4 for k in range(25)]))
+            con.close()
+
+
 class TestExtractDdaFeatures(unittest.TestCase):
     """ tests for the extract_dda_features function """
 
@@ -339,7 +786,7 @@ class TestExtractDdaFeatures(unittest.TestCase):
         xic_iis += _gauss(xic_rts, 15, 1e5, 0.25) * noise2 
         xic_iis += _gauss(xic_rts, 14.25, 5e4, 0.4) * noise2
         # make a fake spectrum with peaks
-        ms2_mzs = np.arange(50, 800, 0.01)
+        ms2_mzs = np.arange(50, 800, 0.05)
         noise1 = np.random.normal(1, 0.2, size=ms2_mzs.shape)
         ms2_iis = 1000 * noise1 
         noise2 = np.random.normal(1, 0.1, size=ms2_mzs.shape)
@@ -354,14 +801,15 @@ class TestExtractDdaFeatures(unittest.TestCase):
             cur = con.cursor()
             # mock a _MSMSReaderDDA instance with 
             # get_pre_mzs method that returns {789.0123}
-            # get_chrom method that returns a fake XIC 
-            # get_msms_spectrum method that returns a fake spectrum
+            # MS1 scan data that produce a fake XIC 
+            # MS2 scans that add up to a fake spectrum at each peak
             # f property that returns "data.file"
             rdr = MockReader.return_value
             type(rdr).f = PropertyMock(return_value="data.file")
             rdr.get_pre_mzs.return_value = {789.0123}
-            rdr.get_chrom.return_value = (xic_rts, xic_iis)
-            rdr.get_msms_spectrum.return_value = (ms2_mzs, ms2_iis, 1, [789.0123])
+            _set_mock_xic(rdr, 789.0123, xic_rts, xic_iis)
+            for pk_rt in [15., 14.25]:
+                _add_mock_ms2_scans(rdr, 789.0123, pk_rt, ms2_mzs, ms2_iis, 1)
             # use a helper callback function to store instead of printing debugging messages
             global _DEBUG_MSGS
             _DEBUG_MSGS = []
@@ -378,11 +826,185 @@ class TestExtractDdaFeatures(unittest.TestCase):
                              msg="should have gotten 2 for number of features extracted")
 
 
-# NOTE (Dylan Ross): removed the unit test for extract_dda_features_multiproc as mocking does 
-#                    not work well with multiprocessing. The actual business logic function is 
-#                    fully tested and the logic of applying it in a multiprocessing context via 
-#                    starmap is small and straightforward so should be able to trust it well 
-#                    enough without the unit test
+class Test_SplitPreMzs(unittest.TestCase):
+    """ tests for the _split_pre_mzs function """
+
+    def test_contiguous_chunks(self):
+        """ chunks should be m/z-contiguous, similar in size, and cover all of the precursor m/zs """
+        pre_mzs = set(np.random.default_rng(420).uniform(200, 1200, size=103).tolist())
+        chunks = _split_pre_mzs(pre_mzs, 4)
+        self.assertEqual(len(chunks), 4)
+        self.assertSetEqual(set().union(*chunks), pre_mzs)
+        self.assertLessEqual(max(map(len, chunks)) - min(map(len, chunks)), 1)
+        for lower, upper in zip(chunks[:-1], chunks[1:]):
+            self.assertLess(max(lower), min(upper))
+        # no empty chunks when there are more chunks than precursor m/zs
+        self.assertEqual(len(_split_pre_mzs({123.4, 234.5}, 4)), 2)
+
+
+class Test_ClusterPreMzs(unittest.TestCase):
+    """ tests for the _cluster_pre_mzs function """
+
+    def test_jittered_pre_mzs(self):
+        """ precursor m/zs that jitter in the last decimals should be clustered together """
+        rng = np.random.default_rng(420)
+        targets = [500.1234, 500.2345, 750.5, 1000.]
+        pre_mzs = set(np.concatenate([t + rng.uniform(-1e-3, 1e-3, size=10) for t in targets]).tolist())
+        centroids = sorted(_cluster_pre_mzs(pre_mzs, 10.))
+        self.assertEqual(len(centroids), len(targets))
+        for centroid, target in zip(centroids, targets):
+            self.assertAlmostEqual(centroid, target, places=3)
+
+    def test_max_cluster_span(self):
+        """ a chain of closely spaced m/zs should be split up so no cluster is wider than the tolerance """
+        pre_mzs = set((500. + 0.001 * np.arange(100)).tolist())
+        centroids = _cluster_pre_mzs(pre_mzs, 10.)
+        # each cluster covers at most 5 mDa (10 ppm at m/z 500) so it has at most 6 of the m/zs
+        self.assertGreaterEqual(len(centroids), np.ceil(100 / 6))
+        for pre_mz in pre_mzs:
+            self.assertLessEqual(min(ppm_from_delta_mz(abs(pre_mz - c), c) for c in centroids), 10.)
+
+
+class TestExtractDdaFeaturesMockFile(unittest.TestCase):
+    """ tests for the extract_dda_features function using a mock DDA data file """
+
+    def _extract(self, tmp_dir, name, params=_DDA_PARAMS, **kwargs):
+        """ extract features from the mock data file into a new results database, return the precursors """
+        dbf = os.path.join(tmp_dir, f"{name}.db")
+        create_results_db(dbf)
+        n = extract_dda_features(os.path.join(tmp_dir, "dda.mza"), dbf, params, **kwargs)
+        con = sqlite3.connect(dbf)
+        precursors = con.execute("SELECT * FROM DDAPrecursors").fetchall()
+        fragments = con.execute("SELECT * FROM DDAFragments").fetchall()
+        con.close()
+        self.assertEqual(n, len(precursors))
+        return precursors, fragments
+
+    def test_serial_and_parallel_match(self):
+        """ extracting features with multiple processes should give the same results as serially """
+        with TemporaryDirectory() as tmp_dir:
+            _write_mock_dda_data(os.path.join(tmp_dir, "dda.mza"))
+            serial_pre, serial_frag = self._extract(tmp_dir, "serial", cache_ms1=False)
+            parallel_pre, parallel_frag = self._extract(tmp_dir, "parallel", cache_ms1=True, n_proc=2)
+        # there should be a precursor with MS2 spectrum for each of the mock targets
+        self.assertEqual(len(serial_pre), len(_MOCK_DDA_TARGETS))
+        for (*_, mz, rt, _, _, _, n_scans, n_peaks), (tmz, trt) in zip(serial_pre, sorted(_MOCK_DDA_TARGETS)):
+            self.assertAlmostEqual(mz, tmz, places=4)
+            self.assertAlmostEqual(rt, trt, places=1)
+            self.assertGreater(n_scans, 0)
+            self.assertEqual(n_peaks, 3)
+        self.assertEqual(len(serial_pre), len(parallel_pre))
+        for a, b in zip(serial_pre, parallel_pre):
+            np.testing.assert_allclose(a[2:], b[2:], rtol=1e-5)
+        self.assertEqual(len(serial_frag), len(parallel_frag))
+
+    def test_batch_fit_engine(self):
+        """ extracting features with the batch peak fitting engine should give the same results """
+        params = DdaParams.load_default()
+        params.extract_and_fit_chroms.fit_engine = "batch"
+        with TemporaryDirectory() as tmp_dir:
+            _write_mock_dda_data(os.path.join(tmp_dir, "dda.mza"))
+            mzapy_pre, _ = self._extract(tmp_dir, "mzapy")
+            batch_pre, _ = self._extract(tmp_dir, "batch", params=params)
+        self.assertEqual(len(mzapy_pre), len(batch_pre))
+        for a, b in zip(mzapy_pre, batch_pre):
+            np.testing.assert_allclose(a[2:], b[2:], rtol=1e-3)
+
+    def test_ms2_trigger_rt_windows(self):
+        """ restricting chromatograms to RT windows around MS2 scans should find the same features """
+        params = DdaParams.load_default()
+        params.extract_and_fit_chroms.rt_tol = 0.5
+        with TemporaryDirectory() as tmp_dir:
+            _write_mock_dda_data(os.path.join(tmp_dir, "dda.mza"))
+            full_pre, _ = self._extract(tmp_dir, "full")
+            win_pre, _ = self._extract(tmp_dir, "windows", params=params)
+            # the windows get computed once and split up among the workers
+            par_pre, _ = self._extract(tmp_dir, "windows_parallel", params=params, n_proc=2)
+        self.assertEqual(len(full_pre), len(win_pre))
+        for a, b in zip(full_pre, win_pre):
+            # RT should agree closely, peak shape/pSNR are fit on a narrower window 
+            self.assertAlmostEqual(a[2], b[2], places=4)
+            self.assertAlmostEqual(a[3], b[3], places=1)
+        self.assertEqual(len(win_pre), len(par_pre))
+        for a, b in zip(win_pre, par_pre):
+            np.testing.assert_allclose(a[2:], b[2:], rtol=1e-5)
+
+    def test_cluster_pre_mzs(self):
+        """ clustering precursor m/zs (with and without MS2 trigger RT windows) should find the same features """
+        params = DdaParams.load_default()
+        params.precursor.cluster_ppm = 10.
+        with TemporaryDirectory() as tmp_dir:
+            _write_mock_dda_data(os.path.join(tmp_dir, "dda.mza"))
+            exact_pre, _ = self._extract(tmp_dir, "exact")
+            clust_pre, _ = self._extract(tmp_dir, "clustered", params=params)
+            params.extract_and_fit_chroms.rt_tol = 0.5
+            win_pre, _ = self._extract(tmp_dir, "windows", params=params)
+        self.assertEqual(len(exact_pre), len(clust_pre))
+        self.assertEqual(len(exact_pre), len(win_pre))
+        for a, b, c in zip(exact_pre, clust_pre, win_pre):
+            np.testing.assert_allclose(a[2:], b[2:])
+            self.assertAlmostEqual(a[2], c[2], places=4)
+            self.assertAlmostEqual(a[3], c[3], places=1)
+
+
+class TestExtractDdaFeaturesMultiprocMockFile(unittest.TestCase):
+    """ tests for the extract_dda_features_multiproc function using mock DDA data files """
+
+    def test_matches_single_file(self):
+        """ features from multiple files in parallel should match extracting each file on its own """
+        with TemporaryDirectory() as tmp_dir:
+            dda_files = [os.path.join(tmp_dir, f"dda{i}.mza") for i in range(3)]
+            for dda_file in dda_files:
+                _write_mock_dda_data(dda_file)
+            single_dbf = os.path.join(tmp_dir, "single.db")
+            create_results_db(single_dbf)
+            n_single = extract_dda_features(dda_files[0], single_dbf, _DDA_PARAMS)
+            multi_dbf = os.path.join(tmp_dir, "multi.db")
+            create_results_db(multi_dbf)
+            feat_counts = extract_dda_features_multiproc(dda_files, multi_dbf, _DDA_PARAMS, 2)
+            self.assertDictEqual(feat_counts, {dda_file: n_single for dda_file in dda_files})
+            con = sqlite3.connect(single_dbf)
+            single_pre = con.execute("SELECT * FROM DDAPrecursors ORDER BY mz").fetchall()
+            con.close()
+            con = sqlite3.connect(multi_dbf)
+            cur = con.cursor()
+            # each file should have all of the same features (and fragments) as the single file
+            for dfile_id in range(1, 4):
+                multi_pre = cur.execute(
+                    "SELECT * FROM DDAPrecursors WHERE dfile_id=? ORDER BY mz", (dfile_id,)
+                ).fetchall()
+                self.assertEqual(len(multi_pre), len(single_pre))
+                for a, b in zip(single_pre, multi_pre):
+                    self.assertTupleEqual(a[2:], b[2:])
+            qry = """--beginsql
+                SELECT COUNT(*) FROM DDAFragments JOIN DDAPrecursors USING(dda_pre_id)
+            --endsql"""
+            n_frags = cur.execute(qry).fetchone()[0]
+            self.assertGreater(n_frags, 0)
+            self.assertEqual(n_frags % 3, 0)
+            # one analysis log entry for each file
+            qry = """--beginsql
+                SELECT COUNT(*) FROM AnalysisLog WHERE step=?
+            --endsql"""
+            self.assertEqual(cur.execute(qry, (AnalysisStep.DDA_EXT.value,)).fetchone()[0], 3)
+            con.close()
+
+
+class Test_GroupDdaFeatures(unittest.TestCase):
+    """ tests for the _group_dda_features function """
+
+    def test_linked_groups(self):
+        """ group features by m/z and RT, including features linked through other features """
+        mzs = np.array([789.0123, 700.0001, 789.0124, 789.0123, 700.0002, 789.0125, 800.])
+        rts = np.array([12.34, 12.34, 12.50, 13.5, 12.34, 12.65, 12.34])
+        # with 0.2 min RT tolerance features 0, 2, 5 are linked (0-2, 2-5) and 1, 4 are linked
+        # features 3 and 6 are not linked to anything
+        group_ids = _group_dda_features(mzs, rts, 20., 0.2)
+        self.assertListEqual(group_ids.tolist(), [0, 1, 0, 3, 1, 0, 6])
+
+    def test_no_features(self):
+        """ grouping no features should give no groups """
+        self.assertEqual(len(_group_dda_features(np.array([]), np.array([]), 20., 0.2)), 0)
 
 
 class TestConsolidateDdaFeatures(unittest.TestCase):
@@ -455,17 +1077,182 @@ class TestConsolidateDdaFeatures(unittest.TestCase):
                 _, *b = obs
                 self.assertListEqual(a, b)
 
+    def test_merge_ms2(self):
+        """ features with MS2 in the same group get merged into one with a consensus spectrum """
+        precursors = [
+            # all have MS2, merged into the second (highest intensity)
+            (None, 69, 799.0123, 12.34, 0.12, 1.23e4, 10., 3, 3),
+            (None, 69, 799.0124, 12.35, 0.12, 2.34e4, 10., 2, 2),
+            (None, 69, 799.0123, 12.36, 0.12, 1.99e4, 10., 1, 0),
+            # no MS2 in the same group, dropped
+            (None, 69, 799.0123, 12.34, 0.12, 3.45e4, 10., 0, None),
+            # different group, left alone
+            (None, 69, 709.0123, 12.34, 0.12, 1.23e4, 10., 3, 3),
+        ]
+        spectra = [
+            np.array([[123.45, 234.55, 345.65], [1e3, 2e3, 3e3]]),
+            np.array([[123.50, 456.75], [3e3, 4e3]]),
+            None,
+            None,
+            np.array([[123.456, 234.567, 345.678], [1e3, 2e3, 3e3]]),
+        ]
+        params = DdaParams.load_default()
+        params.consolidate_dda_feats.merge_ms2 = True
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)  # STRICT!
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            _add_precursors_and_fragments_to_db(cur, precursors, spectra, None, None)  
+            update_analysis_log(cur, AnalysisStep.DDA_EXT)
+            con.commit()
+            con.close()
+            n_pre, n_post = consolidate_dda_features(dbf, params)
+            self.assertEqual((n_pre, n_post), (5, 2))
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            pre_rows = cur.execute("SELECT dda_pre_id, mz, rt_pkht, ms2_n_scans, ms2_n_peaks FROM DDAPrecursors").fetchall()
+            self.assertListEqual([row[1:] for row in pre_rows], [(799.0124, 2.34e4, 6, 4), (709.0123, 1.23e4, 3, 3)])
+            frags = cur.execute("SELECT dda_pre_id, fmz, fint FROM DDAFragments ORDER BY dda_pre_id, fmz").fetchall()
+            con.close()
+        # no fragments left pointing to dropped precursors
+        self.assertSetEqual(set(f[0] for f in frags), set(row[0] for row in pre_rows))
+        merged = [f[1:] for f in frags if f[0] == pre_rows[0][0]]
+        self.assertEqual(len(merged), 4)
+        self.assertAlmostEqual(merged[0][0], (123.45 * 1e3 + 123.50 * 3e3) / 4e3)
+        self.assertListEqual([f[1] for f in merged], [4e3, 2e3, 3e3, 4e3])
+
+
+class Test_ConsensusMs2Spectrum(unittest.TestCase):
+    """ tests for the _consensus_ms2_spectrum function """
+
+    def test_merge_fragments(self):
+        """ fragments within the tolerance get merged, intensities summed, intensity-weighted m/z """
+        mzs, iis = _consensus_ms2_spectrum(np.array([200., 100., 100.1, 300., 200.05]), 
+                                           np.array([1e3, 1e3, 3e3, 5e2, 1e3]), 
+                                           0.2)
+        np.testing.assert_allclose(mzs, [100.075, 200.025, 300.])
+        np.testing.assert_allclose(iis, [4e3, 2e3, 5e2])
+
+    def test_empty(self):
+        """ no fragments, empty spectrum """
+        mzs, iis = _consensus_ms2_spectrum(np.array([]), np.array([]), 0.2)
+        self.assertEqual(len(mzs), 0)
+        self.assertEqual(len(iis), 0)
+
+
+class Test_SparseMs2Vectors(unittest.TestCase):
+    """ tests for the _sparse_ms2_vectors and _cosine_similarity functions """
+
+    def test_cosine_similarity(self):
+        """ binned spectra should have the expected cosine similarities """
+        vectors = _sparse_ms2_vectors(np.array([1, 1, 1, 2, 2, 3, 4]), 
+                                      np.array([100., 100.05, 200., 100.02, 200.01, 300., 150.]), 
+                                      np.array([1e3, 1e3, 2e3, 2e3, 2e3, 1e3, 0.]), 
+                                      0.2)
+        # precursor 4 has no intensity so it does not get a vector
+        self.assertSetEqual(set(vectors), {1, 2, 3})
+        self.assertAlmostEqual(_cosine_similarity(vectors[1], vectors[1]), 1.)
+        # both have equal intensity at m/z 100 and 200 after binning
+        self.assertAlmostEqual(_cosine_similarity(vectors[1], vectors[2]), 1.)
+        self.assertAlmostEqual(_cosine_similarity(vectors[1], vectors[3]), 0.)
+
+    def test_empty(self):
+        """ no fragments, no vectors """
+        self.assertDictEqual(_sparse_ms2_vectors(np.array([], dtype=np.int64), np.array([]), np.array([]), 0.2), {})
+
+
+class TestClusterDdaFeatures(unittest.TestCase):
+    """ tests for the cluster_dda_features function """
+
+    def test_clusters(self):
+        """ DDA features from different files with similar m/z, RT and MS2 spectra get clustered """
+        spec_a = np.array([[184.0733, 264.2686, 313.2737], [1e4, 5e3, 2e4]])
+        spec_b = np.array([[104.1070, 124.9998, 500.4], [1e4, 5e3, 2e4]])
+        precursors = [
+            # same lipid in 3 files, with slightly different m/z, RT and spectra
+            (None, 1, 760.5851, 12.30, 0.12, 1e5, 10., 3, 3),
+            (None, 2, 760.5860, 12.45, 0.12, 3e5, 10., 3, 3),
+            (None, 3, 760.5845, 12.70, 0.12, 2e5, 10., 3, 3),
+            # same m/z and RT but a different spectrum
+            (None, 1, 760.5851, 12.30, 0.12, 1e5, 10., 3, 3),
+            # same spectrum but RT too far off
+            (None, 1, 760.5851, 14.30, 0.12, 1e5, 10., 3, 3),
+            # no MS2
+            (None, 2, 760.5851, 12.30, 0.12, 1e5, 10., 0, None),
+        ]
+        spectra = [spec_a, spec_a * np.array([[1.000001], [1.2]]), spec_a, spec_b, spec_a, None]
+        params = DdaParams.load_default()
+        params.consolidate_dda_feats.cluster_min_cosine = 0.9
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)  # STRICT!
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            _add_precursors_and_fragments_to_db(cur, precursors, spectra, None, None)  
+            update_analysis_log(cur, AnalysisStep.DDA_CONS)
+            con.commit()
+            con.close()
+            n_feats, n_clusters = cluster_dda_features(dbf, params)
+            self.assertEqual((n_feats, n_clusters), (6, 4))
+            con = sqlite3.connect(dbf)
+            mapping = dict(con.execute("SELECT dda_pre_id, cluster_id FROM DDAPrecursorClusters").fetchall())
+            con.close()
+        # IDs are 1-6 in the same order as precursors, representative is the most intense
+        self.assertDictEqual(mapping, {1: 2, 2: 2, 3: 2, 4: 4, 5: 5, 6: 6})
+
+    def test_missing_ms2_not_compared(self):
+        """ pairs where one feature has no stored MS2 fragments are not counted as compared """
+        spec = np.array([[184.0733, 264.2686, 313.2737], [1e4, 5e3, 2e4]])
+        precursors = [
+            (None, 1, 760.5851, 12.30, 0.12, 1e5, 10., 3, 3),
+            # reports MS2 peaks but has no fragments in the database
+            (None, 2, 760.5860, 12.35, 0.12, 3e5, 10., 3, 3),
+        ]
+        params = DdaParams.load_default()
+        params.consolidate_dda_feats.cluster_min_cosine = 0.9
+        msgs = []
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)  # STRICT!
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            _add_precursors_and_fragments_to_db(cur, precursors, [spec, None], None, None)  
+            update_analysis_log(cur, AnalysisStep.DDA_CONS)
+            con.commit()
+            con.close()
+            n_feats, n_clusters = cluster_dda_features(dbf, params, 
+                                                       debug_flag="textcb", debug_cb=msgs.append)
+        self.assertEqual((n_feats, n_clusters), (2, 2))
+        self.assertTrue(any("(0 spectra compared)" in msg for msg in msgs))
+
 
 # group all of the tests from this module into a TestSuite
 _loader = unittest.TestLoader()
 AllTestsDda = unittest.TestSuite()
 AllTestsDda.addTests([
+    _loader.loadTestsFromTestCase(Test_MsmsReaderDdaMmapMs1),
+    _loader.loadTestsFromTestCase(Test_ExtractChroms),
+    _loader.loadTestsFromTestCase(Test_Ms2TriggerRtWindows),
     _loader.loadTestsFromTestCase(Test_ExtractAndFitChroms),
     _loader.loadTestsFromTestCase(Test_ConsolidateChromFeats),
     _loader.loadTestsFromTestCase(Test_ExtractAndFitChroms),
+    _loader.loadTestsFromTestCase(Test_DropIsotopeChromFeats),
+    _loader.loadTestsFromTestCase(Test_Ms2ScanIndex),
+    _loader.loadTestsFromTestCase(Test_DdaFeatureTable),
     _loader.loadTestsFromTestCase(Test_AddPrecursorsAndFragmentsToDb),
+    _loader.loadTestsFromTestCase(Test_InsertDdaFeatureTable),
+    _loader.loadTestsFromTestCase(Test_IterFeatureTables),
     _loader.loadTestsFromTestCase(TestExtractDdaFeatures),
+    _loader.loadTestsFromTestCase(Test_ClusterPreMzs),
+    _loader.loadTestsFromTestCase(Test_SplitPreMzs),
+    _loader.loadTestsFromTestCase(TestExtractDdaFeaturesMockFile),
+    _loader.loadTestsFromTestCase(TestExtractDdaFeaturesMultiprocMockFile),
+    _loader.loadTestsFromTestCase(Test_GroupDdaFeatures),
     _loader.loadTestsFromTestCase(TestConsolidateDdaFeatures),
+    _loader.loadTestsFromTestCase(Test_ConsensusMs2Spectrum),
+    _loader.loadTestsFromTestCase(Test_SparseMs2Vectors),
+    _loader.loadTestsFromTestCase(TestClusterDdaFeatures),
 ])
 
 
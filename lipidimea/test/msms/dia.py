@@ -7,27 +7,49 @@ Dylan Ross (dylan.ross@pnnl.gov)
 
 
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 from tempfile import TemporaryDirectory
 import os
 import sqlite3
+import multiprocessing
+from functools import partial
 
 import numpy as np
+import pandas as pd
 from mzapy.peaks import _gauss
 
 from lipidimea.msms.dia import (
-    _select_xic_peak, _lerp_together, _decon_distance, _deconvolute_ms2_peaks,
-    _add_single_target_results_to_db, _single_target_analysis,
-    extract_dia_features, add_calibrated_ccs_to_dia_features
+    _select_xic_peak, _lerp_together, _decon_distance, _bin_ms2_traces, _DiaTargetSlab, _Ms2PointsCache, 
+    _deconvolute_ms2_peaks, _match_ms2_peaks,
+    _add_single_target_results_to_db, _DdaFragmentIndex, _single_target_analysis, _select_dia_targets, _schedule_dia_targets, _ScanCache, 
+    _dia_work_units, _add_dia_results_batch, _init_dia_worker, _extract_dia_features_worker, _close_dia_worker_reader,
+    extract_dia_features, extract_dia_features_multiproc, add_calibrated_ccs_to_dia_features
 )
+from lipidimea.msms._util import results_writer
 from lipidimea.params import DiaParams
-from lipidimea.util import create_results_db
+from lipidimea.util import create_results_db, update_analysis_log, AnalysisStep
 
 
 # Use the default params for tests
 _DIA_PARAMS = DiaParams.load_default()
 
 
+def _mock_ms2_data_frames(rdr, xic, atd, mzs, mz_spread=0.):
+    """
+    set up a mock MZA instance to return MS2 data (collect_ms2_df_by_rt and collect_ms2_df_by_rt_dt) 
+    with the same XIC and ATD at each of the specified m/zs, optionally with copies spread out around 
+    each m/z (+/- mz_spread)
+    """
+    mzs = np.concatenate([np.asarray(mzs) + d for d in np.linspace(-mz_spread, mz_spread, 21 if mz_spread else 1)])
+    for method, x, (xs, iis) in [(rdr.collect_ms2_df_by_rt, "rt", xic), (rdr.collect_ms2_df_by_rt_dt, "dt", atd)]:
+        method.return_value = pd.DataFrame({
+            "mz": np.repeat(mzs, len(xs)), 
+            "intensity": np.tile(iis, len(mzs)), 
+            x: np.tile(xs, len(mzs)),
+        })
+    rdr.min_dt, rdr.max_dt = min(atd[0]), max(atd[0])
+
+
 class Test_SelectXicPeak(unittest.TestCase):
     """ tests for the _select_xic_peak function """
 
@@ -135,6 +157,123 @@ class Test_DeconDistance(unittest.TestCase):
                                msg=f"distance func {dist_func} did not produce >0 distance")
 
 
+class Test_BinMs2Traces(unittest.TestCase):
+    """ tests for the _bin_ms2_traces function """
+
+    def test_same_as_separate(self):
+        """ traces should be the same as filtering by m/z and summing by x for each window separately """
+        np.random.seed(420)
+        df = pd.DataFrame({
+            "mz": np.random.uniform(100, 200, size=5000),
+            "rt": np.random.choice(np.arange(10, 11, 0.05), size=5000),
+            "intensity": np.random.randint(1, 1000, size=5000),
+        })
+        mz_bounds = [(110., 111.), (150., 152.5), (120., 120.001), (110.5, 112.)]
+        traces = _bin_ms2_traces(df["mz"].to_numpy(), df["rt"].to_numpy(), df["intensity"].to_numpy(), mz_bounds)
+        self.assertEqual(len(traces), 4)
+        for (mz_min, mz_max), (rts, iis) in zip(mz_bounds, traces):
+            grp = df[(df["mz"] >= mz_min) & (df["mz"] <= mz_max)].groupby("rt").intensity.sum()
+            self.assertTrue(np.allclose(rts, grp.index.to_numpy()))
+            self.assertTrue(np.allclose(iis, grp.to_numpy()))
+        # empty window
+        self.assertEqual(len(traces[2][0]), 0)
+
+
+class Test_DiaTargetSlab(unittest.TestCase):
+    """ tests for the _DiaTargetSlab class """
+
+    def _random_points(self, n, with_dt=True):
+        points = {
+            "rt": np.random.choice(np.arange(10, 11, 0.05), size=n),
+            "mz": np.round(np.random.uniform(100, 200, size=n), 2),
+            "intensity": np.random.randint(1, 1000, size=n).astype(np.float64),
+        }
+        if with_dt:
+            points["dt"] = np.random.choice(np.arange(20, 40, 0.25), size=n)
+        return points
+
+    def test_projections(self):
+        """ ATDs, spectra, and MS2 points from the slab should match selecting and summing the points """
+        np.random.seed(420)
+        ms1, ms2_frames, ms2 = self._random_points(5000), self._random_points(2000, False), self._random_points(5000)
+        slab = _DiaTargetSlab(ms1, ms2_frames, ms2, 20., 40.)
+        df1, df2 = pd.DataFrame(ms1), pd.DataFrame(ms2)
+        # ATD
+        sel = df1[(df1.mz >= 150) & (df1.mz <= 160) & (df1.rt >= 10.2) & (df1.rt <= 10.6)]
+        grp = sel.groupby("dt").intensity.sum()
+        dts, iis = slab.collect_atd_arrays_by_rt_mz(150, 160, 10.2, 10.6)
+        self.assertTrue(np.allclose(dts, grp.index.to_numpy()))
+        self.assertTrue(np.allclose(iis, grp.to_numpy()))
+        # MS1 and MS2 spectra
+        for (mzs, iis), df in [
+            (slab.collect_ms1_arrays_by_rt_dt(10.2, 10.6, 25, 30, mz_bounds=(120, 180)), df1), 
+            (slab.collect_ms2_arrays_by_rt_dt(10.2, 10.6, 25, 30, mz_bounds=(120, 180)), df2),
+        ]:
+            sel = df[(df.mz >= 120) & (df.mz <= 180) & (df.rt >= 10.2) & (df.rt <= 10.6) 
+                     & (df.dt >= 25) & (df.dt <= 30)]
+            grp = sel.groupby("mz").intensity.sum()
+            self.assertTrue(np.allclose(mzs, grp.index.to_numpy()))
+            self.assertTrue(np.allclose(iis, grp.to_numpy()))
+        # MS2 points
+        pts = slab.collect_ms2_df_by_rt(10.2, 10.6, mz_bounds=(120, 180))
+        self.assertTrue(np.all((pts["rt"] >= 10.2) & (pts["rt"] <= 10.6) & (pts["mz"] >= 120) & (pts["mz"] <= 180)))
+        n = np.sum((ms2_frames["rt"] >= 10.2) & (ms2_frames["rt"] <= 10.6) 
+                   & (ms2_frames["mz"] >= 120) & (ms2_frames["mz"] <= 180))
+        self.assertEqual(len(pts["mz"]), n)
+        pts = slab.collect_ms2_df_by_rt_dt(10.2, 10.6, 25, 30)
+        self.assertEqual(len(pts["mz"]), len(df2[(df2.rt >= 10.2) & (df2.rt <= 10.6) & (df2.dt >= 25) & (df2.dt <= 30)]))
+
+    def test_from_reader(self):
+        """ extract a slab from a (mock) reader """
+        np.random.seed(420)
+        with patch('mzapy.MZA') as MockReader:
+            rdr = MockReader.return_value
+            rdr.min_dt, rdr.max_dt = 20., 40.
+            rdr.collect_ms1_df_by_rt_dt.return_value = pd.DataFrame(self._random_points(100))
+            rdr.collect_ms2_df_by_rt.return_value = pd.DataFrame(self._random_points(200, False))
+            rdr.collect_ms2_df_by_rt_dt.return_value = pd.DataFrame(self._random_points(300))
+            slab = _DiaTargetSlab.from_reader(rdr, (10., 11.), (150., 155.), (100., 200.))
+            self.assertEqual(len(slab.ms1["mz"]), 100)
+            self.assertEqual(len(slab.ms2_frames["mz"]), 200)
+            self.assertEqual(len(slab.ms2["mz"]), 300)
+            self.assertTupleEqual(rdr.collect_ms1_df_by_rt_dt.call_args.args, (10., 11., 20., 40.))
+            # without MS2
+            slab = _DiaTargetSlab.from_reader(rdr, (10., 11.), (150., 155.), None)
+            self.assertEqual(len(slab.ms2["mz"]), 0)
+            self.assertEqual(rdr.collect_ms2_df_by_rt.call_count, 1)
+            self.assertEqual(rdr.collect_ms2_df_by_rt_dt.call_count, 1)
+
+
+class Test_Ms2PointsCache(unittest.TestCase):
+    """ tests for the _Ms2PointsCache class """
+
+    def test_hits_and_misses(self):
+        """ extractions are reused for the same RT window and m/z range, extended when needed """
+        with patch('mzapy.MZA') as MockReader:
+            rdr = MockReader.return_value
+            xic = (np.arange(12, 13, 0.1), np.ones(10))
+            atd = (np.arange(30, 31, 0.1), np.ones(10))
+            _mock_ms2_data_frames(rdr, xic, atd, [200., 300., 400.])
+            cache = _Ms2PointsCache()
+            mzs, rts, iis = cache.get(rdr, "rt", (12., 13.), 199., 301.)
+            self.assertEqual(len(mzs), 30)
+            # same RT window, m/z range within the first one
+            cache.get(rdr, "rt", (12., 13.), 250., 300.5)
+            self.assertEqual(rdr.collect_ms2_df_by_rt.call_count, 1)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            # m/z range extends past the first one -> extract over the union
+            cache.get(rdr, "rt", (12., 13.), 250., 401.)
+            self.assertEqual(rdr.collect_ms2_df_by_rt.call_count, 2)
+            self.assertTupleEqual(rdr.collect_ms2_df_by_rt.call_args.kwargs["mz_bounds"], (199., 401.))
+            cache.get(rdr, "rt", (12., 13.), 199., 401.)
+            # different RT window or ATD data are separate entries
+            cache.get(rdr, "rt", (12., 12.5), 250., 300.5)
+            cache.get(rdr, "dt", (12., 13.), 250., 300.5)
+            self.assertEqual(rdr.collect_ms2_df_by_rt.call_count, 3)
+            self.assertEqual(rdr.collect_ms2_df_by_rt_dt.call_count, 1)
+            self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+
 class Test_DeconvoluteMs2Peaks(unittest.TestCase):
     """ tests for the _deconvolute_ms2_peaks function """
 
@@ -172,11 +311,10 @@ class Test_DeconvoluteMs2Peaks(unittest.TestCase):
         # need to patch a mock MZA instance
         with patch('mzapy.MZA') as MockReader:
             # mock a MZA instance with 
-            # collect_xic_arrays_by_mz method that returns a fake XIC
-            # collect_atd_arrays_by_rt_mz method that returns a fake ATD
+            # collect_ms2_df_by_rt method that returns MS2 data with a fake XIC
+            # collect_ms2_df_by_rt_dt method that returns MS2 data with a fake ATD
             rdr = MockReader.return_value
-            rdr.collect_xic_arrays_by_mz.return_value = (xic_rts, xic_iis)
-            rdr.collect_atd_arrays_by_rt_mz.return_value = (atd_ats, atd_iis)
+            _mock_ms2_data_frames(rdr, (xic_rts, xic_iis), (atd_ats, atd_iis), [789.0123])
             # test the function
             deconvoluted, raws = _deconvolute_ms2_peaks(rdr, [789.0123], pre_xic, 15.1, 0.27, pre_atd, _DIA_PARAMS)
             # should get one entry in the deconvoluted list
@@ -185,6 +323,17 @@ class Test_DeconvoluteMs2Peaks(unittest.TestCase):
             self.assertTrue(deconvoluted[0][0])
             self.assertLess(deconvoluted[0][1], 0.5)
             self.assertLess(deconvoluted[0][2], 0.5)
+            # deconvoluting again with a shared cache, MS2 data only gets extracted the first time
+            cache = _Ms2PointsCache()
+            for _ in range(3):
+                self.assertListEqual(
+                    _deconvolute_ms2_peaks(rdr, [789.0123], pre_xic, 15.1, 0.27, pre_atd, _DIA_PARAMS, 
+                                           cache=cache)[0], 
+                    deconvoluted
+                )
+            self.assertEqual(rdr.collect_ms2_df_by_rt.call_count, 2)
+            self.assertEqual(rdr.collect_ms2_df_by_rt_dt.call_count, 2)
+            self.assertEqual((cache.hits, cache.misses), (4, 2))
 
     def test_mock_data_match_XIC_nomatch_ATD(self):
         """ test deconvoluting MS2 peaks with mock data and matching XIC and non matching ATD """
@@ -220,11 +369,10 @@ class Test_DeconvoluteMs2Peaks(unittest.TestCase):
         # need to patch a mock MZA instance
         with patch('mzapy.MZA') as MockReader:
             # mock a MZA instance with 
-            # collect_xic_arrays_by_mz method that returns a fake XIC
-            # collect_atd_arrays_by_rt_mz method that returns a fake ATD
+            # collect_ms2_df_by_rt method that returns MS2 data with a fake XIC
+            # collect_ms2_df_by_rt_dt method that returns MS2 data with a fake ATD
             rdr = MockReader.return_value
-            rdr.collect_xic_arrays_by_mz.return_value = (xic_rts, xic_iis)
-            rdr.collect_atd_arrays_by_rt_mz.return_value = (atd_ats, atd_iis)
+            _mock_ms2_data_frames(rdr, (xic_rts, xic_iis), (atd_ats, atd_iis), [789.0123])
             # test the function
             deconvoluted, raws = _deconvolute_ms2_peaks(rdr, [789.0123], pre_xic, 15.1, 0.27, pre_atd, _DIA_PARAMS)
             # should get a result with deconvoluted flag set to False
@@ -269,11 +417,10 @@ class Test_DeconvoluteMs2Peaks(unittest.TestCase):
         # need to patch a mock MZA instance
         with patch('mzapy.MZA') as MockReader:
             # mock a MZA instance with 
-            # collect_xic_arrays_by_mz method that returns a fake XIC
-            # collect_atd_arrays_by_rt_mz method that returns a fake ATD
+            # collect_ms2_df_by_rt method that returns MS2 data with a fake XIC
+            # collect_ms2_df_by_rt_dt method that returns MS2 data with a fake ATD
             rdr = MockReader.return_value
-            rdr.collect_xic_arrays_by_mz.return_value = (xic_rts, xic_iis)
-            rdr.collect_atd_arrays_by_rt_mz.return_value = (atd_ats, atd_iis)
+            _mock_ms2_data_frames(rdr, (xic_rts, xic_iis), (atd_ats, atd_iis), [789.0123])
             # test the function
             deconvoluted, raws = _deconvolute_ms2_peaks(rdr, [789.0123], pre_xic, 15.1, 0.27, pre_atd, _DIA_PARAMS)
             # should get a result with deconvoluted flag set to False
@@ -384,6 +531,75 @@ class Test_AddSingleTargetResultsToDb(unittest.TestCase):
             self.assertEqual(len(cur.execute("SELECT * FROM DIAFragments").fetchall()), 3)
 
 
+class Test_MatchMs2Peaks(unittest.TestCase):
+    """ tests for the _match_ms2_peaks function """
+
+    def test_matches(self):
+        """ match DIA peaks to DDA fragments, same as checking every pair """
+        np.random.seed(420)
+        dda_fmzs = np.unique(np.round(np.random.uniform(100, 800, size=50), 3))
+        dia_mzs = np.concatenate([
+            dda_fmzs[::2] * (1 + np.random.uniform(-60e-6, 60e-6, size=25)),  # matches
+            np.random.uniform(100, 800, size=100),                            # mostly not matches
+        ])
+        np.random.shuffle(dia_mzs)
+        expected = [
+            i for i, diam in enumerate(dia_mzs) 
+            if any(abs(diam - ddam) <= ddam * 80 / 1e6 for ddam in dda_fmzs)
+        ]
+        matched = _match_ms2_peaks(dda_fmzs, dia_mzs, 80.)
+        self.assertListEqual(matched.tolist(), expected)
+        self.assertGreaterEqual(len(matched), 25)
+
+    def test_no_duplicates(self):
+        """ DIA peak matching multiple DDA fragments only gets included once """
+        matched = _match_ms2_peaks(np.array([500., 500.01, 600.]), np.array([500.005, 550., 600.]), 40.)
+        self.assertListEqual(matched.tolist(), [0, 2])
+
+    def test_empty(self):
+        """ nothing to match """
+        self.assertEqual(len(_match_ms2_peaks(np.array([]), np.array([500.]), 40.)), 0)
+        self.assertEqual(len(_match_ms2_peaks(np.array([500.]), np.array([]), 40.)), 0)
+
+
+class Test_DdaFragmentIndex(unittest.TestCase):
+    """ tests for the _DdaFragmentIndex class """
+
+    def test_from_db(self):
+        """ load fragments from the database and look them up by DDA precursor ID(s) """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)  # STRICT!
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            cur.executemany(
+                "INSERT INTO DDAFragments VALUES (?,?,?,?)",
+                [
+                    (None, 3, 300., 1e3), (None, 1, 150., 1e3), (None, 3, 250., 1e3), 
+                    (None, 1, 100., 1e3), (None, 7, 700., 1e3),
+                ]
+            )
+            idx = _DdaFragmentIndex.from_db(cur)
+            # a subset of the fragments can also be loaded
+            sub = _DdaFragmentIndex.from_db(cur, "1,7")
+            con.close()
+        self.assertListEqual(idx.pre_ids.tolist(), [1, 3, 7])
+        self.assertListEqual(idx.offsets.tolist(), [0, 2, 4, 5])
+        # fragments are sorted within each precursor
+        self.assertListEqual(idx.get_fmzs(1).tolist(), [100., 150.])
+        self.assertListEqual(idx.get_fmzs("3").tolist(), [250., 300.])
+        # comma-separated IDs, IDs without fragments are ignored
+        self.assertListEqual(idx.get_fmzs("1,2,7,69420").tolist(), [100., 150., 700.])
+        self.assertEqual(len(idx.get_fmzs(2)), 0)
+        self.assertListEqual(sub.pre_ids.tolist(), [1, 7])
+        self.assertListEqual(sub.get_fmzs("1,3,7").tolist(), [100., 150., 700.])
+
+    def test_empty(self):
+        """ no fragments at all """
+        idx = _DdaFragmentIndex(np.array([], dtype=np.int64), np.array([0]), np.array([]))
+        self.assertEqual(len(idx.get_fmzs("1,2")), 0)
+
+
 class Test_SingleTargetAnalysis(unittest.TestCase):
     """ tests for the _single_target_analysis function """
 
@@ -424,6 +640,8 @@ class Test_SingleTargetAnalysis(unittest.TestCase):
             rdr.collect_xic_arrays_by_mz.return_value = (xic_rts, xic_iis)
             rdr.collect_atd_arrays_by_rt_mz.return_value = (atd_ats, atd_iis)
             rdr.collect_ms2_arrays_by_rt_dt.return_value = (ms2_mzs, ms2_iis)
+            # fragment XICs and ATDs for deconvolution
+            _mock_ms2_data_frames(rdr, (xic_rts, xic_iis), (atd_ats, atd_iis), pkmzs, mz_spread=0.05)
             # make the fake results database
             dbf = os.path.join(tmp_dir, "results.db")
             create_results_db(dbf)  # STRICT!
@@ -451,6 +669,177 @@ class Test_SingleTargetAnalysis(unittest.TestCase):
             # also the feature count returned from the function should be 1
             self.assertEqual(n, 1)
 
+    def test_mock_data_slab(self):
+        """ use mock data to test single target analysis in slab mode """
+        np.random.seed(420)
+        xic_rts = np.arange(12, 17.05, 0.01)
+        xic_iis = 1000 * np.random.normal(1, 0.2, size=xic_rts.shape) 
+        xic_iis += _gauss(xic_rts, 15, 1e5, 0.25) * np.random.normal(1, 0.1, size=xic_rts.shape) 
+        atd_ats = np.arange(30, 50.05, 0.05)
+        atd_iis = 1000 * np.random.normal(1, 0.2, size=atd_ats.shape) 
+        atd_iis += _gauss(atd_ats, 35, 1e5, 2.5) * np.random.normal(1, 0.1, size=atd_ats.shape)
+        ms2_mzs = np.arange(50, 800, 0.01)
+        ms2_iis = 1000 * np.random.normal(1, 0.2, size=ms2_mzs.shape) 
+        pkmzs = np.arange(100, 800, 25, dtype=np.float64)
+        noise2 = np.random.normal(1, 0.1, size=ms2_mzs.shape)
+        for pkmz in pkmzs:
+            ms2_iis += _gauss(ms2_mzs, pkmz, 1e5, 0.075) * noise2 
+        params = DiaParams.load_default()
+        params.data_access.slab = True
+        with patch('lipidimea.msms.dia.MZA') as MockReader, TemporaryDirectory() as tmp_dir:
+            # mock a MZA instance with the precursor XIC and the data for the slab: 
+            # MS1 points with the precursor ATD, MS2 points with the spectrum (at the precursor DT) 
+            # and the fragment XICs/ATDs
+            rdr = MockReader.return_value
+            rdr.collect_xic_arrays_by_mz.return_value = (xic_rts, xic_iis)
+            rdr.collect_ms1_df_by_rt_dt.return_value = pd.DataFrame({
+                "rt": 15., "dt": atd_ats, "mz": 789.0123, "intensity": atd_iis
+            })
+            _mock_ms2_data_frames(rdr, (xic_rts, xic_iis), (atd_ats, atd_iis), pkmzs, mz_spread=0.05)
+            frag_atds = rdr.collect_ms2_df_by_rt_dt.return_value.assign(rt=15.)
+            rdr.collect_ms2_df_by_rt_dt.return_value = pd.concat([
+                frag_atds, 
+                pd.DataFrame({"rt": 15., "dt": 35., "mz": ms2_mzs, "intensity": ms2_iis})
+            ])
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)  # STRICT!
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            dda_pre_id = 69420
+            cur.executemany(
+                "INSERT INTO DDAFragments VALUES (?,?,?,?)",
+                [
+                    (None, dda_pre_id, fmz, 1e3)
+                    for fmz in pkmzs
+                ]
+            )
+            # test the function
+            n = _single_target_analysis(1, 0, rdr, cur, 1, dda_pre_id, 789.0123, "15.", 25, params, None, None)
+            self.assertEqual(n, 1)
+            self.assertEqual(len(cur.execute("SELECT * FROM DIAPrecursors").fetchall()), 1)
+            self.assertGreater(len(cur.execute("SELECT * FROM DIAFragments").fetchall()), 20)
+            self.assertGreater(cur.execute("SELECT SUM(deconvoluted) FROM DIAFragments").fetchone()[0], 0)
+            # everything after the XIC came out of the slab, 3 reads
+            for method in [rdr.collect_ms1_df_by_rt_dt, rdr.collect_ms2_df_by_rt, rdr.collect_ms2_df_by_rt_dt]:
+                self.assertEqual(method.call_count, 1)
+            for method in [rdr.collect_atd_arrays_by_rt_mz, 
+                           rdr.collect_ms1_arrays_by_rt_dt, 
+                           rdr.collect_ms2_arrays_by_rt_dt]:
+                method.assert_not_called()
+
+    def test_mock_data_collect_results(self):
+        """ use mock data to test single target analysis with results collected instead of added to DB """
+        np.random.seed(420)
+        xic_rts = np.arange(12, 17.05, 0.01)
+        xic_iis = 1000 * np.random.normal(1, 0.2, size=xic_rts.shape) 
+        xic_iis += _gauss(xic_rts, 15, 1e5, 0.25) * np.random.normal(1, 0.1, size=xic_rts.shape) 
+        atd_ats = np.arange(30, 50.05, 0.05)
+        atd_iis = 1000 * np.random.normal(1, 0.2, size=atd_ats.shape) 
+        atd_iis += _gauss(atd_ats, 35, 1e5, 2.5) * np.random.normal(1, 0.1, size=atd_ats.shape)
+        ms2_mzs = np.arange(50, 800, 0.01)
+        ms2_iis = 1000 * np.random.normal(1, 0.2, size=ms2_mzs.shape) 
+        pkmzs = np.arange(100, 800, 25, dtype=np.float64)
+        noise2 = np.random.normal(1, 0.1, size=ms2_mzs.shape)
+        for pkmz in pkmzs:
+            ms2_iis += _gauss(ms2_mzs, pkmz, 1e5, 0.075) * noise2 
+        with patch('lipidimea.msms.dia.MZA') as MockReader, TemporaryDirectory() as tmp_dir:
+            rdr = MockReader.return_value
+            rdr.collect_xic_arrays_by_mz.return_value = (xic_rts, xic_iis)
+            rdr.collect_atd_arrays_by_rt_mz.return_value = (atd_ats, atd_iis)
+            rdr.collect_ms2_arrays_by_rt_dt.return_value = (ms2_mzs, ms2_iis)
+            # fragment XICs and ATDs for deconvolution
+            _mock_ms2_data_frames(rdr, (xic_rts, xic_iis), (atd_ats, atd_iis), pkmzs, mz_spread=0.05)
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)  # STRICT!
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            dda_pre_id = 69420
+            cur.executemany(
+                "INSERT INTO DDAFragments VALUES (?,?,?,?)",
+                [
+                    (None, dda_pre_id, fmz, 1e3)
+                    for fmz in pkmzs
+                ]
+            )
+            # test the function
+            results = []
+            n = _single_target_analysis(1, 0, rdr, cur, 1, dda_pre_id, 789.0123, "15.", 25, _DIA_PARAMS, 
+                                        None, None, results=results)
+            self.assertEqual(n, 1)
+            # nothing should have been added to the database, the results got collected instead
+            self.assertEqual(len(cur.execute("SELECT * FROM DIAPrecursors").fetchall()), 0)
+            self.assertEqual(len(results), 1)
+            # the collected results should add the same feature to the database 
+            _add_single_target_results_to_db(cur, *results[0])
+            self.assertEqual(len(cur.execute("SELECT * FROM DIAPrecursors").fetchall()), 1)
+            self.assertGreater(len(cur.execute("SELECT * FROM DIAFragments").fetchall()), 20)
+
+    def test_mock_data_xic_rt_range(self):
+        """ use mock data to test single target analysis only keeping XIC peaks in an owned RT range """
+        np.random.seed(420)
+        xic_rts = np.arange(12, 17.05, 0.01)
+        xic_iis = 1000 * np.random.normal(1, 0.2, size=xic_rts.shape) 
+        xic_iis += _gauss(xic_rts, 15, 1e5, 0.25) * np.random.normal(1, 0.1, size=xic_rts.shape) 
+        atd_ats = np.arange(30, 50.05, 0.05)
+        atd_iis = 1000 * np.random.normal(1, 0.2, size=atd_ats.shape) 
+        atd_iis += _gauss(atd_ats, 35, 1e5, 2.5) * np.random.normal(1, 0.1, size=atd_ats.shape)
+        with patch('lipidimea.msms.dia.MZA') as MockReader:
+            rdr = MockReader.return_value
+            rdr.collect_xic_arrays_by_mz.return_value = (xic_rts, xic_iis)
+            rdr.collect_atd_arrays_by_rt_mz.return_value = (atd_ats, atd_iis)
+            # no MS2 for this target, so only the XIC peaks matter
+            dda_frags = _DdaFragmentIndex(np.array([], dtype=np.int64), np.array([0]), np.array([]))
+            # the XIC peak (RT 15) belongs to the neighboring target, nothing extracted past the XIC
+            results = []
+            n = _single_target_analysis(1, 0, rdr, None, 1, 69420, 789.0123, "14.5", 0, _DIA_PARAMS, None, None, 
+                                        results=results, dda_frags=dda_frags, xic_rt_range=(-np.inf, 14.8))
+            self.assertEqual(n, 0)
+            self.assertListEqual(results, [])
+            rdr.collect_atd_arrays_by_rt_mz.assert_not_called()
+            # the XIC peak is in this target's RT range
+            n = _single_target_analysis(1, 0, rdr, None, 1, 69420, 789.0123, "15.1", 0, _DIA_PARAMS, None, None, 
+                                        results=results, dda_frags=dda_frags, xic_rt_range=(14.8, np.inf))
+            self.assertEqual(n, 1)
+            self.assertEqual(len(results), 1)
+
+    def test_mock_data_peak_at_split(self):
+        """ a peak at the boundary between targets split up by max RT span should be kept exactly once """
+        np.random.seed(420)
+        xic_rts = np.arange(10, 20.005, 0.01)
+        xic_iis = 1000 * np.random.normal(1, 0.2, size=xic_rts.shape) 
+        xic_iis += _gauss(xic_rts, 14.5, 1e5, 0.1) * np.random.normal(1, 0.1, size=xic_rts.shape) 
+        atd_ats = np.arange(30, 50.05, 0.05)
+        atd_iis = 1000 * np.random.normal(1, 0.2, size=atd_ats.shape) 
+        atd_iis += _gauss(atd_ats, 35, 1e5, 2.5) * np.random.normal(1, 0.1, size=atd_ats.shape)
+
+        def xic_in_window(mz_min, mz_max, rt_bounds=None):
+            """ the XIC only covers the requested RT window """
+            sel = (xic_rts >= rt_bounds[0]) & (xic_rts <= rt_bounds[1])
+            return xic_rts[sel], xic_iis[sel]
+
+        # the midpoint between the clusters (14.5) is right at the peak
+        targets = _schedule_dia_targets([("1,2,3,4", 789.0123, "13.0,14.0,15.0,16.0", 0)], 
+                                        _DIA_PARAMS.extract_and_fit_chroms.rt_tol)
+        self.assertEqual(len(targets), 2)
+        self.assertEqual(targets[0][4][1], 14.5)
+        with patch('lipidimea.msms.dia.MZA') as MockReader:
+            rdr = MockReader.return_value
+            rdr.collect_xic_arrays_by_mz.side_effect = xic_in_window
+            rdr.collect_atd_arrays_by_rt_mz.return_value = (atd_ats, atd_iis)
+            dda_frags = _DdaFragmentIndex(np.array([], dtype=np.int64), np.array([0]), np.array([]))
+            results = []
+            for i, (dda_fids, dda_mz, dda_rts, dda_ms2_n_peaks, xic_rt_range) in enumerate(targets):
+                _single_target_analysis(2, i, rdr, None, 1, dda_fids, dda_mz, dda_rts, dda_ms2_n_peaks, 
+                                        _DIA_PARAMS, None, None, results=results, dda_frags=dda_frags, 
+                                        xic_rt_range=xic_rt_range)
+            # both XIC windows cover the whole peak
+            for call in rdr.collect_xic_arrays_by_mz.call_args_list:
+                rt_min, rt_max = call.kwargs["rt_bounds"]
+                self.assertLess(rt_min, 14.5 - 0.5)
+                self.assertGreater(rt_max, 14.5 + 0.5)
+        self.assertEqual(len(results), 1)
+        self.assertAlmostEqual(results[0][3], 14.5, places=1)
+
 
 class TestExtractDiaFeatures(unittest.TestCase):
     """ tests for the extract_dia_features function """
@@ -503,11 +892,17 @@ class TestExtractDiaFeatures(unittest.TestCase):
             rdr.collect_xic_arrays_by_mz.return_value = (xic_rts, xic_iis)
             rdr.collect_atd_arrays_by_rt_mz.return_value = (atd_ats, atd_iis)
             rdr.collect_ms2_arrays_by_rt_dt.return_value = (ms2_mzs, ms2_iis)
-            # make the fake results database
+            # fragment XICs and ATDs for deconvolution
+            _mock_ms2_data_frames(rdr, (xic_rts, xic_iis), (atd_ats, atd_iis), pkmzs, mz_spread=0.05)
+            # scan cache stats
+            rdr._scan_cache_hits, rdr._scan_cache_misses = 0, 0
+            # make the fake results database, with DDA feature extraction and consolidation done
             dbf = os.path.join(tmp_dir, "results.db")
             create_results_db(dbf)  # STRICT!
             con = sqlite3.connect(dbf)
             cur = con.cursor()
+            update_analysis_log(cur, AnalysisStep.DDA_EXT)
+            update_analysis_log(cur, AnalysisStep.DDA_CONS)
             # need to insert a couple of entries into DDAFragments for determining m/z bounds 
             # for extracting MS2 from DIA data
             dda_pre_id = 69420
@@ -539,11 +934,327 @@ class TestExtractDiaFeatures(unittest.TestCase):
             self.assertEqual(n, 1)
 
 
-# NOTE (Dylan Ross): removed the unit test for extract_dia_features_multiproc as mocking does 
-#                    not work well with multiprocessing. The actual business logic function is 
-#                    fully tested and the logic of applying it in a multiprocessing context via 
-#                    starmap is small and straightforward so should be able to trust it well 
-#                    enough without the unit test
+class Test_SelectDiaTargets(unittest.TestCase):
+    """ tests for the _select_dia_targets function """
+
+    def _make_db(self, tmp_dir, clusters):
+        """ results database with a few DDA precursors, and the cluster mapping if not None """
+        dbf = os.path.join(tmp_dir, "results.db")
+        create_results_db(dbf)  # STRICT!
+        con = sqlite3.connect(dbf)
+        cur = con.cursor()
+        cur.executemany("INSERT INTO DDAPrecursors VALUES (?,?,?,?,?,?,?,?,?);", [
+            (1, 1, 760.5851, 12.3, 0.1, 1e5, 20., 3, 3),
+            (2, 2, 760.5860, 12.4, 0.1, 3e5, 20., 3, 4),
+            (3, 1, 800.1234, 14.5, 0.1, 1e5, 20., 3, 5),
+        ])
+        if clusters is None:
+            cur.execute("DROP TABLE DDAPrecursorClusters")
+        else:
+            cur.executemany("INSERT INTO DDAPrecursorClusters VALUES (?,?)", clusters)
+        con.commit()
+        return con, cur
+
+    def test_clusters(self):
+        """ members of a cluster are grouped under the m/z of the representative """
+        with TemporaryDirectory() as tmp_dir:
+            con, cur = self._make_db(tmp_dir, [(1, 2), (2, 2), (3, 3)])
+            self.assertListEqual(sorted(_select_dia_targets(cur)), [
+                ("1,2", 760.5860, "12.3,12.4", 7), 
+                ("3", 800.1234, "14.5", 5),
+            ])
+            con.close()
+
+    def test_missing_representative(self):
+        """ members of a cluster whose representative is gone are their own representatives """
+        with TemporaryDirectory() as tmp_dir:
+            con, cur = self._make_db(tmp_dir, [(1, 2), (2, 2), (3, 3)])
+            cur.execute("DELETE FROM DDAPrecursors WHERE dda_pre_id=2")
+            self.assertListEqual(sorted(_select_dia_targets(cur)), [
+                ("1", 760.5851, "12.3", 3), 
+                ("3", 800.1234, "14.5", 5),
+            ])
+            con.close()
+
+    def test_no_clusters_table(self):
+        """ results databases from before clustering was added do not have DDAPrecursorClusters """
+        with TemporaryDirectory() as tmp_dir:
+            con, cur = self._make_db(tmp_dir, None)
+            self.assertListEqual(sorted(_select_dia_targets(cur)), [
+                ("1", 760.5851, "12.3", 3), 
+                ("2", 760.5860, "12.4", 4), 
+                ("3", 800.1234, "14.5", 5),
+            ])
+            con.close()
+
+
+class Test_ScheduleDiaTargets(unittest.TestCase):
+    """ tests for the _schedule_dia_targets function """
+
+    def test_order_and_split(self):
+        """ targets are ordered by RT window start and split up by separate RT windows """
+        targets = [
+            ("1,2,3", 500.1, "20.0,5.0,5.5", 10), 
+            ("4", 400.2, "12.0", None),
+            ("5,6", 600.3, "4.9,6.0", 3),
+            ("7", 300.4, "12.0", 1),
+        ]
+        scheduled = _schedule_dia_targets(targets, 0.5)
+        self.assertListEqual(scheduled, [
+            ("5", 600.3, "4.9", 3, (-np.inf, np.inf)),
+            ("2,3", 500.1, "5.0,5.5", 10, (-np.inf, np.inf)),
+            ("6", 600.3, "6.0", 3, (-np.inf, np.inf)),
+            ("7", 300.4, "12.0", 1, (-np.inf, np.inf)),
+            ("4", 400.2, "12.0", None, (-np.inf, np.inf)),
+            ("1", 500.1, "20.0", 10, (-np.inf, np.inf)),
+        ])
+        # split up by gaps, so the XIC windows do not overlap and the owned RT ranges are unbounded
+        # nothing is split with a large enough RT tolerance
+        self.assertEqual(len(_schedule_dia_targets(targets, 10.)), 4)
+        self.assertListEqual(_schedule_dia_targets([], 0.5), [])
+
+    def test_split_wide_cluster(self):
+        """ chains of close RTs get split into narrow clusters with owned RT ranges that do not overlap """
+        rts = [5.0, 5.6, 6.2, 6.8, 7.4, 8.0]
+        targets = [(",".join(str(i) for i in range(len(rts))), 500.1, ",".join(str(rt) for rt in rts), 10)]
+        # no gaps > 2 * rt_tol, so one cluster without the span limit
+        self.assertEqual(len(_schedule_dia_targets(targets, 0.5, max_rt_span=10.)), 1)
+        scheduled = _schedule_dia_targets(targets, 0.5)
+        self.assertListEqual([t[0] for t in scheduled], ["0,1", "2,3", "4,5"])
+        for (_, _, t_rts, _, (rt_min, rt_max)), (_, _, nxt_rts, _, (nxt_min, _)) in zip(scheduled[:-1], scheduled[1:]):
+            self.assertEqual(rt_max, nxt_min)
+            # the boundary is inside of the XIC windows of both of the neighboring clusters
+            self.assertLess(rt_max, float(t_rts.split(",")[-1]) + 0.5)
+            self.assertGreater(rt_max, float(nxt_rts.split(",")[0]) - 0.5)
+        self.assertEqual(scheduled[0][4][0], -np.inf)
+        self.assertEqual(scheduled[-1][4][1], np.inf)
+        # XIC windows are no wider than 4 * rt_tol
+        for _, _, t_rts, _, _ in scheduled:
+            t_rts = [float(_) for _ in t_rts.split(",")]
+            self.assertLessEqual(max(t_rts) - min(t_rts) + 1., 2.)
+
+
+class Test_ScanCache(unittest.TestCase):
+    """ tests for the _ScanCache class """
+
+    def _scan(self, n):
+        """ scan data with n m/z bins (n * 16 bytes) """
+        return [np.arange(n, dtype=np.int64), np.ones(n, dtype=np.float64)]
+
+    def test_lru_eviction(self):
+        """ least recently used scans get evicted to stay within the budget """
+        cache = _ScanCache(3 * 160)
+        for i in range(3):
+            cache[("a", i)] = self._scan(10)
+        self.assertEqual(cache.nbytes, 480)
+        # using scan 0 makes scan 1 the least recently used
+        _ = cache[("a", 0)]
+        cache[("a", 3)] = self._scan(10)
+        self.assertNotIn(("a", 1), cache)
+        for i in [0, 2, 3]:
+            self.assertIn(("a", i), cache)
+        # a bigger scan evicts more than one
+        cache[("a", 4)] = self._scan(20)
+        self.assertNotIn(("a", 2), cache)
+        self.assertNotIn(("a", 0), cache)
+        self.assertIn(("a", 3), cache)
+        self.assertEqual(cache.nbytes, 480)
+        self.assertEqual(cache.evictions, 3)
+        self.assertEqual(cache.peak_nbytes, 480)
+        # a scan bigger than the whole budget does not get cached
+        cache[("a", 5)] = self._scan(40)
+        self.assertNotIn(("a", 5), cache)
+        self.assertEqual(cache.nbytes, 480)
+
+    def test_views_share_budget(self):
+        """ views for multiple readers share the cache and its budget """
+        cache = _ScanCache(2 * 160)
+        va, vb = cache.view("a.mza"), cache.view("b.mza")
+        va[1] = self._scan(10)
+        vb[1] = self._scan(10)
+        self.assertIn(1, va)
+        self.assertIn(1, vb)
+        self.assertIsNot(va[1], vb[1])
+        vb[2] = self._scan(10)
+        self.assertNotIn(1, va)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.nbytes, 320)
+
+
+class Test_DiaWorkUnits(unittest.TestCase):
+    """ tests for the _dia_work_units function """
+
+    def test_units(self):
+        """ work units should cover all targets for all files, biggest units first """
+        with TemporaryDirectory() as tmp_dir:
+            dia_data_files = []
+            for name, size in [("small.mza", 10), ("big.mza", 1000), ("medium.mza", 100)]:
+                dia_data_files.append(os.path.join(tmp_dir, name))
+                with open(dia_data_files[-1], "wb") as f:
+                    f.write(b"0" * size)
+            units = _dia_work_units(dia_data_files, 1001, 4)
+        # every target for every file is covered exactly once
+        for k in range(3):
+            covered = sorted([i for kk, i0, i1 in units if kk == k for i in range(i0, i1)])
+            self.assertListEqual(covered, list(range(1001)))
+        # several units per process
+        self.assertGreaterEqual(len(units), 4 * 4)
+        # units are grouped by file from the biggest file to the smallest, with the last chunks smaller
+        files = [k for k, _, _ in units]
+        self.assertListEqual(files, sorted(files, key=lambda k: -[10, 1000, 100][k]))
+        for k in range(3):
+            sizes = [i1 - i0 for kk, i0, i1 in units if kk == k]
+            self.assertListEqual(sizes, sorted(sizes, reverse=True))
+
+    def test_single_file(self):
+        """ a single file still gets split up for multiple processes """
+        units = _dia_work_units(["dia.mza"], 100, 8)
+        self.assertGreaterEqual(len(units), 8)
+        self.assertListEqual(_dia_work_units(["dia.mza"], 0, 8), [])
+
+
+class Test_ExtractDiaFeaturesWorker(unittest.TestCase):
+    """ tests for the _extract_dia_features_worker function """
+
+    def test_one_reader_at_a_time(self):
+        """ workers should close the reader for the previous file when switching to another file """
+        readers = []
+        def mock_reader(dia_data_file, **kwargs):
+            rdr = MagicMock()
+            rdr.f = dia_data_file
+            # empty XICs, so there is nothing to do past extracting them
+            rdr.collect_xic_arrays_by_mz.return_value = ([], [])
+            rdr._scan_cache_hits, rdr._scan_cache_misses = 0, 0
+            readers.append(rdr)
+            return rdr
+        targets = _schedule_dia_targets([("1", 500.1, "5.0", 3), ("2", 600.2, "10.0", 3)], 0.5)
+        dda_frags = _DdaFragmentIndex(np.array([], dtype=np.int64), np.array([0]), np.array([]))
+        with patch('lipidimea.msms.dia.MZA', side_effect=mock_reader):
+            _init_dia_worker(targets, dda_frags, multiprocessing.Queue())
+            worker = partial(_extract_dia_features_worker, params=_DIA_PARAMS, debug_flag=None, debug_cb=None, 
+                             mza_io_threads=1)
+            worker(("a.mza", 1, 0, 1))
+            worker(("a.mza", 1, 1, 2))
+            # still on the same file, the reader stays open
+            self.assertListEqual([rdr.f for rdr in readers], ["a.mza"])
+            readers[0].close.assert_not_called()
+            worker(("b.mza", 2, 0, 2))
+            # the reader for the first file got closed, without saving the scan cache
+            self.assertListEqual([rdr.f for rdr in readers], ["a.mza", "b.mza"])
+            readers[0].close.assert_called_once()
+            self.assertIsNone(readers[0]._scan_cache)
+            readers[1].close.assert_not_called()
+            # the worker closes its reader on the way out
+            _close_dia_worker_reader()
+            readers[1].close.assert_called_once()
+
+
+class Test_DiaResultsWriter(unittest.TestCase):
+    """ tests for the results writer with the _add_dia_results_batch function """
+
+    def test_batches(self):
+        """ writer should add all of the batches from the queue to the database and stop at None """
+        xic = (np.arange(12, 17.05, 0.01), np.ones(506))
+        atd = (np.arange(30, 50.05, 0.05), np.ones(401))
+        ms1 = (np.arange(50, 800, 1.), np.ones(750))
+        def target_results(mz, n_frags, store_blobs):
+            return (
+                None, 1, mz, 
+                12.34, 0.25, 1e5, 10., 
+                40., 2.5, 1e6, 10., 
+                (ms1, xic, atd), 
+                [100. + 10 * i for i in range(n_frags)], [1e4 for _ in range(n_frags)], 
+                [(True, 0.05, 0.06) for _ in range(n_frags)], 
+                [(xic, atd) for _ in range(n_frags)], 
+                store_blobs
+            )
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)  # STRICT!
+            queue = multiprocessing.Queue()
+            queue.put([target_results(400., 3, False), target_results(500., 2, False)])
+            queue.put([target_results(600., 4, True)])
+            queue.put(None)
+            # run the writer in this process, it should return once it gets None
+            results_writer(dbf, queue, _add_dia_results_batch)
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            self.assertListEqual(
+                cur.execute("SELECT mz, ms2_n_peaks FROM DIAPrecursors ORDER BY mz").fetchall(),
+                [(400., 3), (500., 2), (600., 4)]
+            )
+            # fragments should be associated with the right precursors
+            qry = """--beginsql
+                SELECT p.mz, COUNT(*) FROM DIAFragments JOIN DIAPrecursors AS p USING(dia_pre_id) 
+                GROUP BY p.mz ORDER BY p.mz
+            --endsql"""
+            self.assertListEqual(cur.execute(qry).fetchall(), [(400., 3), (500., 2), (600., 4)])
+            # raw data only stored for the last target: 3 for precursor + 2 for each fragment
+            self.assertEqual(cur.execute("SELECT COUNT(*) FROM Raw").fetchone()[0], 3 + 2 * 4)
+            con.close()
+
+
+class TestExtractDiaFeaturesMultiproc(unittest.TestCase):
+    """ tests for the extract_dia_features_multiproc function """
+
+    def test_mock_data(self):
+        """ use mock data to test extracting DIA features from multiple files with worker processes """
+        np.random.seed(420)
+        xic_rts = np.arange(12, 17.05, 0.01)
+        xic_iis = 1000 * np.random.normal(1, 0.2, size=xic_rts.shape) 
+        xic_iis += _gauss(xic_rts, 15, 1e5, 0.25) * np.random.normal(1, 0.1, size=xic_rts.shape) 
+        atd_ats = np.arange(30, 50.05, 0.05)
+        atd_iis = 1000 * np.random.normal(1, 0.2, size=atd_ats.shape) 
+        atd_iis += _gauss(atd_ats, 35, 1e5, 2.5) * np.random.normal(1, 0.1, size=atd_ats.shape)
+        ms2_mzs = np.arange(50, 800, 0.01)
+        ms2_iis = 1000 * np.random.normal(1, 0.2, size=ms2_mzs.shape) 
+        pkmzs = np.arange(100, 800, 25, dtype=np.float64)
+        noise2 = np.random.normal(1, 0.1, size=ms2_mzs.shape)
+        for pkmz in pkmzs:
+            ms2_iis += _gauss(ms2_mzs, pkmz, 1e5, 0.1) * noise2 
+        # NOTE: The worker processes get forked after the patch so they also make the mock reader, the 
+        #       results they send back to the writer process are real data so nothing mocked has to get 
+        #       passed between processes.
+        with patch('lipidimea.msms.dia.MZA') as MockReader, TemporaryDirectory() as tmp_dir:
+            rdr = MockReader.return_value
+            rdr.collect_xic_arrays_by_mz.return_value = (xic_rts, xic_iis)
+            rdr.collect_atd_arrays_by_rt_mz.return_value = (atd_ats, atd_iis)
+            rdr.collect_ms2_arrays_by_rt_dt.return_value = (ms2_mzs, ms2_iis)
+            # the results (including the MS1 spectra) get pickled to send them to the writer process
+            rdr.collect_ms1_arrays_by_rt_dt.return_value = (np.array([789.0123, 790.0156]), np.array([1e5, 4e4]))
+            _mock_ms2_data_frames(rdr, (xic_rts, xic_iis), (atd_ats, atd_iis), pkmzs, mz_spread=0.05)
+            rdr._scan_cache_hits, rdr._scan_cache_misses = 0, 0
+            # make the fake results database, with DDA feature extraction and consolidation done
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)  # STRICT!
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            update_analysis_log(cur, AnalysisStep.DDA_EXT)
+            update_analysis_log(cur, AnalysisStep.DDA_CONS)
+            cur.executemany("INSERT INTO DDAFragments VALUES (?,?,?,?)", [(None, 69420, fmz, 1e3) for fmz in pkmzs])
+            cur.execute("INSERT INTO DDAPrecursors VALUES (?,?,?,?,?,?,?,?,?);", 
+                        (69420, 1, 789.0123, 15., 0.1, 1e5, 20., 3, 25))
+            con.commit()
+            # test the function
+            dia_files = ["dia1.data.file", "dia2.data.file"]
+            feat_counts = extract_dia_features_multiproc(dia_files, dbf, _DIA_PARAMS, 2)
+            self.assertDictEqual(feat_counts, {dia_file: 1 for dia_file in dia_files})
+            # the writer process should have added one feature for each DIA data file, with its fragments
+            qry = """--beginsql
+                SELECT p.dfile_id, COUNT(*) FROM DIAPrecursors AS p JOIN DIAFragments USING(dia_pre_id) 
+                GROUP BY p.dia_pre_id ORDER BY p.dfile_id
+            --endsql"""
+            rows = cur.execute(qry).fetchall()
+            # (the DIA data files are the only ones in DataFiles so they get file IDs 1 and 2)
+            self.assertListEqual([dfile_id for dfile_id, _ in rows], [1, 2])
+            for _, n_frags in rows:
+                self.assertGreater(n_frags, 20)
+            # one analysis log entry for each DIA data file
+            qry = """--beginsql
+                SELECT COUNT(*) FROM AnalysisLog WHERE step=?
+            --endsql"""
+            self.assertEqual(cur.execute(qry, (AnalysisStep.DIA_EXT.value,)).fetchone()[0], 2)
+            con.close()
 
 
 class TestAddCalibratedCcsToDiaFeatures(unittest.TestCase):
@@ -626,10 +1337,22 @@ AllTestsDia.addTests([
     _loader.loadTestsFromTestCase(Test_SelectXicPeak),
     _loader.loadTestsFromTestCase(Test_LerpTogether),
     _loader.loadTestsFromTestCase(Test_DeconDistance),
+    _loader.loadTestsFromTestCase(Test_BinMs2Traces),
+    _loader.loadTestsFromTestCase(Test_DiaTargetSlab),
+    _loader.loadTestsFromTestCase(Test_Ms2PointsCache),
     _loader.loadTestsFromTestCase(Test_DeconvoluteMs2Peaks),
     _loader.loadTestsFromTestCase(Test_AddSingleTargetResultsToDb),
+    _loader.loadTestsFromTestCase(Test_MatchMs2Peaks),
+    _loader.loadTestsFromTestCase(Test_DdaFragmentIndex),
     _loader.loadTestsFromTestCase(Test_SingleTargetAnalysis),
     _loader.loadTestsFromTestCase(TestExtractDiaFeatures),
+    _loader.loadTestsFromTestCase(Test_SelectDiaTargets),
+    _loader.loadTestsFromTestCase(Test_ScheduleDiaTargets),
+    _loader.loadTestsFromTestCase(Test_ScanCache),
+    _loader.loadTestsFromTestCase(Test_DiaWorkUnits),
+    _loader.loadTestsFromTestCase(Test_ExtractDiaFeaturesWorker),
+    _loader.loadTestsFromTestCase(Test_DiaResultsWriter),
+    _loader.loadTestsFromTestCase(TestExtractDiaFeaturesMultiproc),
     _loader.loadTestsFromTestCase(TestAddCalibratedCcsToDiaFeatures),
 ])
 
@@ -96,9 +96,23 @@ def add_data_file_to_db(cur: ResultsDbCursor,
     return rowid
 
 
+def results_db_has_table(cur: ResultsDbCursor, 
+                         table: str
+                         ) -> bool :
+    """
+    check whether a table is in the results database, tables that were added to the schema later on 
+    are not in results databases that were created before that
+    """
+    qry = """--beginsql
+        SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=?
+    --endsql"""
+    return cur.execute(qry, (table,)).fetchone()[0] > 0
+
+
 class AnalysisStep(enum.Enum):
     DDA_EXT = "DDA feature extraction"
     DDA_CONS = "DDA feature consolidation"
+    DDA_CLUST = "DDA feature clustering"
     DIA_EXT = "DIA feature extraction"
     CCS_CAL = "CCS calibration"
     LIPID_ANN = "lipid annotation"